@@ -0,0 +1,103 @@
+"""
+Common utilities for the benchmarks: timing, writing results to JSON,
+and comparing results with an earlier run to detect regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def timeit(func, repeat=1, rounds=1):
+    """Get the mean time (in seconds) that it takes to call func. With
+    multiple rounds, the best round is used, to reduce noise.
+    """
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        best = min(best, (time.perf_counter() - t0) / repeat)
+    return best
+
+
+def get_arg_parser(description):
+    """Get an argument parser with the options that all benchmarks support."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--output", default="", help="Filename to write the results to, as JSON."
+    )
+    parser.add_argument(
+        "--compare",
+        default="",
+        help="Filename of earlier results (JSON) to compare with.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="Relative slowdown that counts as a regression (default 1.5).",
+    )
+    return parser
+
+
+def write_results(filename, name, results, **meta):
+    """Write results to a JSON file. The results are a dict that maps
+    case names to dicts of measurements.
+    """
+    import timetagger
+
+    meta.update(
+        benchmark=name,
+        timetagger_version=timetagger.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        timestamp=int(time.time()),
+    )
+    dirname = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(dirname, exist_ok=True)
+    with open(filename, "wb") as f:
+        f.write(json.dumps({"meta": meta, "results": results}, indent=2).encode())
+    print(f"\nResults written to {filename}")
+
+
+def compare_results(filename, results, threshold, noise=0.0002):
+    """Compare results with those in the given JSON file. Prints the
+    measurements that got slower, and returns the number of regressions.
+    Only measurements that are times (in seconds) are compared. Differences
+    smaller than the noise (in seconds) are ignored.
+    """
+    with open(filename, "rb") as f:
+        old_results = json.loads(f.read().decode())["results"]
+
+    regressions = 0
+    print(f"\nComparing with {filename}")
+    for case, measurements in results.items():
+        old_measurements = old_results.get(case, None)
+        if old_measurements is None:
+            continue
+        for key, value in measurements.items():
+            old_value = old_measurements.get(key, None)
+            if not isinstance(value, float) or not isinstance(old_value, float):
+                continue
+            elif key.endswith("_per_second"):
+                continue  # a rate, not a time
+            ratio = value / max(old_value, 1e-9)
+            if abs(value - old_value) < noise:
+                continue
+            elif ratio > threshold:
+                regressions += 1
+                print(f"  SLOWER {case} {key}: {old_value:.6f}s -> {value:.6f}s")
+            elif ratio < 1 / threshold:
+                print(f"  faster {case} {key}: {old_value:.6f}s -> {value:.6f}s")
+    if regressions:
+        print(f"{regressions} regression(s) beyond a factor {threshold}")
+    else:
+        print("No regressions")
+    return regressions
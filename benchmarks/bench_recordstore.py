@@ -0,0 +1,163 @@
+"""
+Benchmarks for the RecordStore and the algorithms used during sync, for
+synthetic histories: from 1k to 1M records, dense and sparse, and with few
+or many tag combinations.
+
+Run with ``invoke bench`` or ``python benchmarks/bench_recordstore.py`` from
+the repo root. Use ``--output`` to write the results to JSON, and
+``--compare`` to detect regressions relative to an earlier run.
+"""
+
+import sys
+import random
+
+from _common import timeit, get_arg_parser, write_results, compare_results
+
+from timetagger.app.stores import RecordStore
+
+
+DAY = 86400
+T0 = 1_600_000_000  # Sept 2020
+
+DENSITIES = {"dense": 40, "sparse": 1}  # records per day
+
+FEW_TAGS = ["#work", "#meeting", "#admin", "#email", "#client1", "#client2", "#lunch"]
+MANY_TAGS = [f"#project{i}" for i in range(200)] + [f"#task{i}" for i in range(50)]
+
+ZOOMS = [("day", DAY), ("week", 7 * DAY), ("month", 31 * DAY), ("year", 365 * DAY)]
+
+
+class DataStoreStub:
+    def _put(self, kind, *items):
+        pass
+
+
+def generate_history(n, records_per_day, tags, seed=0):
+    """Generate n records, on average records_per_day per day, each day
+    starting at 8am. Records are short and back-to-back when dense. With
+    many tags, most records have a unique combination of tags.
+    """
+    rng = random.Random(seed)
+    rs = RecordStore(DataStoreStub())
+    max_tags = 1 if len(tags) < 10 else 3
+    records = []
+    day = 0
+    while len(records) < n:
+        count = max(1, int(rng.expovariate(1 / records_per_day)))
+        t = T0 + day * DAY + 8 * 3600
+        duration = min(3600, 10 * 3600 // count)
+        for _ in range(min(count, n - len(records))):
+            ds = " ".join(rng.sample(tags, rng.randint(1, max_tags)))
+            record = rs.create(t, t + duration, ds + " some description")
+            record.st = 1.0 + len(records)  # as if it came from the server
+            records.append(record)
+            t += duration
+        day += 1
+    return records
+
+
+def bench_history(records, adaptive):
+    """Run the benchmarks for one history."""
+    rs = RecordStore(DataStoreStub())
+    rs.adaptive_bin_size = adaptive
+    rng = random.Random(1)
+    t_first, t_last = records[0].t1, records[-1].t2
+    results = {}
+
+    # Bulk load, as when the records are received from the server
+    records_copy = [r.copy() for r in records]
+    results["bulk_load"] = timeit(lambda: rs._put_received(*records_copy))
+
+    # Modify single records, as when the user edits a record
+    def incremental_put():
+        record = rng.choice(records).copy()
+        record.ds = rng.choice(FEW_TAGS)
+        rs._put(record)
+
+    results["incremental_put"] = timeit(incremental_put, 100, 5)
+
+    # Query records and stats at different zoom levels
+    for zoom_name, span in ZOOMS:
+
+        def query_records():
+            t1 = rng.randint(t_first, max(t_first, t_last - span))
+            rs.get_records(t1, t1 + span)
+
+        def query_stats():
+            t1 = rng.randint(t_first, max(t_first, t_last - span))
+            rs._stats_lru.clear()  # measure the tree walk, not the cache
+            rs.get_stats(t1, t1 + span)
+
+        results[f"get_records_{zoom_name}"] = timeit(query_records, 10, 5)
+        results[f"get_stats_{zoom_name}"] = timeit(query_stats, 20, 5)
+
+    # Merge what the server sends in a sync with what we have. Half of
+    # the items are newer, the others are what we already have.
+    incoming = []
+    for i, record in enumerate(records):
+        record = record.copy()
+        if i % 2:
+            record.st += 0.5
+        incoming.append(record)
+    results["filter_outdated"] = timeit(lambda: rs._filter_outdated(incoming), 1, 3)
+
+    # Drop records, as when the server does not accept them
+    keys = [r.key for r in rng.sample(records, min(200, len(records)))]
+    keys_iter = iter(keys)
+    results["drop"] = timeit(lambda: rs._drop(next(keys_iter)), len(keys))
+
+    results["bin_size"] = rs._bin_size
+    results["levels"] = len(rs._heap)
+    return results
+
+
+def print_results(case, results):
+    print(f"\n{case}")
+    for key, value in results.items():
+        if isinstance(value, float):
+            print(f"  {key:20} {value * 1000:12.3f}ms")
+        else:
+            print(f"  {key:20} {value:12}")
+
+
+def main():
+    parser = get_arg_parser(__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="Comma-separated numbers of records (default 1000,10000,100000). "
+        + "Add 1000000 for the largest histories.",
+    )
+    parser.add_argument(
+        "--fixed-bins",
+        action="store_true",
+        help="Use the fixed leaf bin size instead of the adaptive one.",
+    )
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    all_results = {}
+    for n in sizes:
+        for density, per_day in DENSITIES.items():
+            for tags_name, tags in [("few-tags", FEW_TAGS), ("many-tags", MANY_TAGS)]:
+                case = f"{n}-{density}-{tags_name}"
+                records = generate_history(n, per_day, tags)
+                results = bench_history(records, not args.fixed_bins)
+                print_results(case, results)
+                all_results[case] = results
+
+    if args.output:
+        write_results(
+            args.output,
+            "recordstore",
+            all_results,
+            sizes=sizes,
+            adaptive_bin_size=not args.fixed_bins,
+        )
+    if args.compare:
+        if compare_results(args.compare, all_results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""
+Load test for the API server, with a fleet of simulated clients.
+
+Each simulated user behaves like the TimeTagger app: it does a full sync at
+startup, polls /updates, pushes bursts of records with PUT /records,
+renews its webtoken, and now and then does a full resync. The requests go
+to ``timetagger.__main__.main_handler``, either in-process via ASGI (the
+default), or to a real uvicorn server over loopback (``--mode http``).
+Latency percentiles and throughput are reported per endpoint. Rate
+limiting and the cap on expensive requests are disabled, so that the
+results measure the server rather than the throttling. Responses with
+status 429 or 503 are counted separately, as "throttled".
+
+Run with ``invoke bench --name server`` or ``python benchmarks/bench_server.py``
+from the repo root. Use ``--help`` to see the options. Time can be
+compressed with a shorter ``--poll-interval``, e.g. a value of 1 makes
+each user behave like 10 real users.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import secrets
+import tempfile
+import subprocess
+from urllib.parse import urlsplit
+
+from _common import ROOT_DIR, get_arg_parser, write_results, compare_results
+
+
+# %% Clients
+
+
+class AsgiClient:
+    """Client that calls an ASGI application directly."""
+
+    def __init__(self, app):
+        self._app = app
+
+    async def request(self, method, url, headers, body=b""):
+        """Do a request and return (status, body)."""
+        parts = urlsplit(url)
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": parts.path,
+            "raw_path": parts.path.encode(),
+            "query_string": parts.query.encode(),
+            "root_path": "",
+            "headers": [(b"host", b"localhost")]
+            + [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+            "client": ("127.0.0.1", 40000),
+            "server": ("127.0.0.1", 8080),
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        response = {"status": 0, "body": []}
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+
+        await self._app(scope, receive, send)
+        return response["status"], b"".join(response["body"])
+
+    async def close(self):
+        pass
+
+
+class HttpClient:
+    """Minimal HTTP/1.1 client that keeps its connection alive."""
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._reader = self._writer = None
+
+    async def request(self, method, url, headers, body=b""):
+        """Do a request and return (status, body)."""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self._host, self._port
+            )
+        lines = [f"{method} {url} HTTP/1.1", f"Host: {self._host}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        lines.append(f"Content-Length: {len(body)}")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        try:
+            return await self._read_response()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            await self.close()
+            raise
+
+    async def _read_response(self):
+        status_line = await self._reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await self._reader.readuntil(b"\r\n")).decode().strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+        if response_headers.get("transfer-encoding", "") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).strip(), 16)
+                chunks.append(await self._reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            body = b"".join(chunk[:-2] for chunk in chunks)
+        else:
+            size = int(response_headers.get("content-length", "0"))
+            body = await self._reader.readexactly(size)
+        if response_headers.get("connection", "") == "close":
+            await self.close()
+        return status, body
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+# %% Simulated users
+
+
+API = "/timetagger/api/v2/"
+
+
+class Stats:
+    """Collect the latencies per endpoint."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.throttled = {}
+        self.recording = False
+
+    def add(self, endpoint, latency, status):
+        if not self.recording:
+            return
+        self.latencies.setdefault(endpoint, []).append(latency)
+        if status in (429, 503):
+            self.throttled[endpoint] = self.throttled.get(endpoint, 0) + 1
+        elif status != 200:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def get_results(self, duration):
+        results = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            n = len(latencies)
+            results[endpoint] = {
+                "count": n,
+                "errors": self.errors.get(endpoint, 0),
+                "throttled": self.throttled.get(endpoint, 0),
+                "requests_per_second": round(n / duration, 1),
+                "p50": latencies[int(0.50 * (n - 1))],
+                "p90": latencies[int(0.90 * (n - 1))],
+                "p99": latencies[int(0.99 * (n - 1))],
+                "max": latencies[-1],
+            }
+        return results
+
+
+def create_records(n, t0):
+    """Create n records, back to back, ending at t0."""
+    records = []
+    mt = int(time.time())
+    t = t0 - n * 1800
+    for _ in range(n):
+        key = secrets.token_urlsafe(6)
+        ds = f"#project{random.randint(1, 20)} doing some work"
+        records.append(dict(key=key, mt=mt, t1=t, t2=t + 1500, ds=ds))
+        t += 1800
+    return records
+
+
+class SimulatedUser:
+    """A client that syncs like the app does."""
+
+    def __init__(self, client, token, stats, args):
+        self._client = client
+        self._token = token
+        self._stats = stats
+        self._args = args
+        self._server_time = 0
+        self._rng = random.Random()
+
+    async def _request(self, endpoint, method, path, body=None):
+        headers = {"authtoken": self._token}
+        data = b""
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["content-type"] = "application/json"
+        t0 = time.perf_counter()
+        try:
+            status, response = await self._client.request(
+                method, API + path, headers, data
+            )
+        except Exception:
+            status, response = 0, b""
+        self._stats.add(endpoint, time.perf_counter() - t0, status)
+        if status != 200:
+            return None
+        return json.loads(response)
+
+    async def seed(self, n):
+        """Put the initial records. This is not measured."""
+        t0 = int(time.time())
+        records = create_records(n, t0)
+        for i in range(0, n, 1000):
+            await self._request("seed", "PUT", "records", records[i : i + 1000])
+
+    async def sync(self, full=False):
+        since = 0 if full else self._server_time
+        endpoint = "GET /updates (full)" if full else "GET /updates"
+        result = await self._request(endpoint, "GET", f"updates?since={since}")
+        if result is not None:
+            self._server_time = result["server_time"]
+
+    async def push(self):
+        n = self._rng.randint(1, self._args.burst_size)
+        records = create_records(n, int(time.time()))
+        await self._request("PUT /records", "PUT", "records", records)
+
+    async def renew_token(self):
+        result = await self._request("GET /webtoken", "GET", "webtoken")
+        if result is not None:
+            self._token = result["token"]
+
+    async def _sleep_until(self, t, end_time):
+        # Sleep until t, but not past the end time. Returns False if the
+        # end time is reached.
+        await asyncio.sleep(max(0, min(t, end_time) - time.perf_counter()))
+        return time.perf_counter() < end_time
+
+    async def run(self, end_time):
+        args = self._args
+        # Spread the users over the first poll interval
+        t = time.perf_counter() + self._rng.uniform(0, args.poll_interval)
+        if not await self._sleep_until(t, end_time):
+            return
+        await self.sync(True)
+        while True:
+            t = time.perf_counter()
+            t += args.poll_interval * self._rng.uniform(0.8, 1.2)
+            if not await self._sleep_until(t, end_time):
+                break
+            if self._rng.random() < args.push_probability:
+                await self.push()
+            if self._rng.random() < args.renew_probability:
+                await self.renew_token()
+            if self._rng.random() < args.resync_probability:
+                await self.sync(True)
+            else:
+                await self.sync()
+
+
+# %% Server
+
+
+async def start_http_server(datadir):
+    """Start the server in a subprocess, and wait until it's ready."""
+    port = 18080 + random.randint(0, 999)
+    cmd = [
+        sys.executable,
+        "-m",
+        "timetagger",
+        f"--bind=127.0.0.1:{port}",
+        f"--datadir={datadir}",
+        "--log_level=warning",
+        "--rate_limit=0",
+        "--max_expensive_requests=0",
+    ]
+    p = subprocess.Popen(cmd, cwd=ROOT_DIR)
+    client = HttpClient("127.0.0.1", port)
+    for _ in range(100):
+        try:
+            status, _ = await client.request("GET", "/timetagger/status", {})
+            if status == 200:
+                await client.close()
+                return p, port
+        except OSError:
+            await asyncio.sleep(0.2)
+    p.terminate()
+    raise RuntimeError("Could not start the server")
+
+
+async def run(args):
+    # The server module uses the config at import time. Asgineer sets
+    # its log level on import, so import it first to use the config's level.
+    import asgineer  # noqa: F401
+    from timetagger.server import get_webtoken_unsafe
+
+    process = None
+    if args.mode == "http":
+        process, port = await start_http_server(os.environ["TIMETAGGER_DATADIR"])
+
+        def create_client():
+            return HttpClient("127.0.0.1", port)
+
+    else:
+        from timetagger.__main__ import main_handler
+
+        def create_client():
+            return AsgiClient(main_handler)
+
+    try:
+        stats = Stats()
+        users = []
+        for i in range(args.users):
+            token = await get_webtoken_unsafe(f"loadtest{i}")
+            users.append(SimulatedUser(create_client(), token, stats, args))
+
+        print(f"Seeding {args.users} users with {args.records} records each ...")
+        await asyncio.gather(*[user.seed(args.records) for user in users])
+
+        print(f"Running {args.users} users for {args.duration}s ...")
+        stats.recording = True
+        t0 = time.perf_counter()
+        end_time = t0 + args.duration
+        await asyncio.gather(*[user.run(end_time) for user in users])
+        duration = time.perf_counter() - t0
+        stats.recording = False
+
+        for user in users:
+            await user._client.close()
+        # Let the databases close while the loop is still running
+        users = None
+        gc.collect()
+        await asyncio.sleep(0.5)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    return stats.get_results(duration), duration
+
+
+def print_results(results, duration):
+    print(f"\nResults over {duration:.1f}s")
+    print(
+        f"  {'endpoint':22} {'count':>7} {'errors':>7} {'thrott.':>7} {'req/s':>7}"
+        + f" {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}"
+    )
+    for endpoint, r in results.items():
+        times = "".join(
+            f" {r[key] * 1000:7.1f}ms" for key in ("p50", "p90", "p99", "max")
+        )
+        print(
+            f"  {endpoint:22} {r['count']:7} {r['errors']:7} {r['throttled']:7}"
+            + f" {r['requests_per_second']:7.1f}{times}"
+        )
+    total = sum(r["count"] for r in results.values())
+    print(f"  total: {total} requests, {total / duration:.1f} requests per second")
+
+
+def main():
+    parser = get_arg_parser(__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["asgi", "http"], default="asgi")
+    parser.add_argument("--users", type=int, default=50, help="Number of users.")
+    parser.add_argument(
+        "--duration", type=float, default=30, help="Duration in seconds."
+    )
+    parser.add_argument(
+        "--records", type=int, default=1000, help="Initial records per user."
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=10,
+        help="Seconds between syncs (the app uses 10).",
+    )
+    parser.add_argument(
+        "--push-probability",
+        type=float,
+        default=0.1,
+        help="Probability that a user pushes records before a sync.",
+    )
+    parser.add_argument(
+        "--burst-size", type=int, default=20, help="Max records per push."
+    )
+    parser.add_argument(
+        "--renew-probability",
+        type=float,
+        default=0.01,
+        help="Probability that a user renews its webtoken before a sync.",
+    )
+    parser.add_argument(
+        "--resync-probability",
+        type=float,
+        default=0.005,
+        help="Probability that a sync is a full resync.",
+    )
+    parser.add_argument(
+        "--datadir",
+        default="",
+        help="The data directory for the server. Default a temporary directory.",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        os.environ["TIMETAGGER_DATADIR"] = args.datadir or tempdir
+        os.environ["TIMETAGGER_LOG_LEVEL"] = "warning"
+        # Measure the server, not the throttling (also for asgi mode)
+        os.environ["TIMETAGGER_RATE_LIMIT"] = "0"
+        os.environ["TIMETAGGER_MAX_EXPENSIVE_REQUESTS"] = "0"
+        results, duration = asyncio.run(run(args))
+
+    print_results(results, duration)
+
+    if args.output:
+        settings = {
+            key: getattr(args, key)
+            for key in ("mode", "users", "duration", "records", "poll_interval")
+        }
+        write_results(args.output, "server", results, **settings)
+    if args.compare:
+        if compare_results(args.compare, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Benchmarks for the storage backends of the server: opening a user's
+storage, batched upserts, getting changes since a given time, range
+queries, and selecting by key. All backends run the same operations,
+including the per-file backend wrapped in the in-memory cache.
+
+Run with ``invoke bench --name storage`` or ``python benchmarks/bench_storage.py``
+from the repo root. Use ``--output`` to write the results to JSON, and
+``--compare`` to detect regressions relative to an earlier run.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+
+from _common import get_arg_parser, write_results, compare_results
+
+
+DAY = 86400
+T0 = 1_600_000_000  # Sept 2020
+
+
+def create_records(n, rng):
+    """Create n records, about 10 per day, with st in creation order."""
+    records = []
+    for i in range(n):
+        t1 = T0 + (i // 10) * DAY + (i % 10) * 3000
+        key = f"r{i:08d}"
+        ds = f"#project{rng.randint(1, 20)} doing some work"
+        records.append(dict(key=key, mt=t1, t1=t1, t2=t1 + 2400, ds=ds, st=i + 1.0))
+    return records
+
+
+async def timeit_async(func, repeat=1, rounds=1):
+    """Like _common.timeit, but for coroutine functions."""
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            await func()
+        best = min(best, (time.perf_counter() - t0) / repeat)
+    return best
+
+
+async def bench_backend(name, backend, users, n):
+    rng = random.Random(0)
+    records = create_records(n, rng)
+    usernames = [f"{name}_user{i}" for i in range(users)]
+    results = {}
+
+    # Open the storage of a user (the first time creates it)
+    t0 = time.perf_counter()
+    for username in usernames:
+        await backend.open_user(username)
+    results["create_user"] = (time.perf_counter() - t0) / users
+    results["open_user"] = await timeit_async(
+        lambda: backend.open_user(rng.choice(usernames)), 50, 3
+    )
+
+    # Fill the storage for all users, in batches as the client would push
+    async def put_all(db):
+        for i in range(0, n, 1000):
+            async with db:
+                await db.put_items("records", records[i : i + 1000])
+
+    dbs = [await backend.open_user(username) for username in usernames]
+    t0 = time.perf_counter()
+    for db in dbs:
+        await put_all(db)
+    results["bulk_put_per_user"] = (time.perf_counter() - t0) / users
+
+    db = dbs[0]
+
+    # Batched upsert of a few records, as in a typical PUT /records
+    async def upsert():
+        items = [dict(r, st=r["st"] + 0.5) for r in rng.sample(records, 20)]
+        existing = await db.get_items_by_key("records", [r["key"] for r in items])
+        assert len(existing) == 20
+        async with db:
+            await db.put_items("records", items)
+
+    results["upsert_20"] = await timeit_async(upsert, 20, 3)
+
+    # Get changes, as in GET /updates
+    results["get_since_recent"] = await timeit_async(
+        lambda: db.get_items("records", n - 10), 50, 3
+    )
+    results["get_all"] = await timeit_async(lambda: db.get_items("records"), 1, 3)
+
+    # Range queries, as in GET /records
+    for name, span in [("week", 7 * DAY), ("year", 365 * DAY)]:
+
+        async def query_range():
+            t1 = T0 + rng.randint(0, max(0, n // 10 * DAY - span))
+            await db.get_records_in_range(t1, t1 + span)
+
+        results[f"range_{name}"] = await timeit_async(query_range, 10, 3)
+
+    # The auth path reads the token seed
+    results["get_token_seed"] = await timeit_async(
+        lambda: db.get_token_seed("webtoken"), 50, 3
+    )
+    return results
+
+
+def print_results(case, results):
+    print(f"\n{case}")
+    for key, value in results.items():
+        print(f"  {key:20} {value * 1000:12.3f}ms")
+
+
+def main():
+    parser = get_arg_parser(__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="Number of users.")
+    parser.add_argument(
+        "--records", type=int, default=10000, help="Records per user (default 10000)."
+    )
+    args = parser.parse_args()
+
+    all_results = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        # The server module uses the config at import time
+        os.environ["TIMETAGGER_DATADIR"] = tempdir
+        os.environ["TIMETAGGER_LOG_LEVEL"] = "warning"
+        from timetagger.server import (
+            SqliteStorage,
+            SharedSqliteStorage,
+            CachedStorage,
+        )
+
+        backends = {
+            "sqlite": SqliteStorage(),
+            "sqlite_shared": SharedSqliteStorage(os.path.join(tempdir, "shared.db")),
+            "sqlite_cached": CachedStorage(SqliteStorage(), 2**30),
+        }
+        for name, backend in backends.items():
+            results = asyncio.run(
+                bench_backend(name, backend, args.users, args.records)
+            )
+            print_results(name, results)
+            all_results[name] = results
+
+    if args.output:
+        write_results(
+            args.output,
+            "storage",
+            all_results,
+            users=args.users,
+            records=args.records,
+        )
+    if args.compare:
+        if compare_results(args.compare, all_results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -37,6 +37,29 @@ def tests(ctx, cover=False):
         webbrowser.open(os.path.join(ROOT_DIR, "htmlcov", "index.html"))
 
 
+@task
+def bench(ctx, name="", output="", compare=""):
+    """Run the benchmarks. Use --output/--compare DIR for JSON results."""
+    bench_dir = os.path.join(ROOT_DIR, "benchmarks")
+    failed = False
+    for fname in sorted(os.listdir(bench_dir)):
+        if not (fname.startswith("bench_") and fname.endswith(".py")):
+            continue
+        bench_name = fname[6:-3]
+        if name and name != bench_name:
+            continue
+        cmd = [sys.executable, os.path.join(bench_dir, fname)]
+        if output:
+            cmd += ["--output", os.path.join(output, bench_name + ".json")]
+        if compare:
+            cmd += ["--compare", os.path.join(compare, bench_name + ".json")]
+        print(f"Running benchmark {bench_name} ...")
+        if subprocess.call(cmd, cwd=ROOT_DIR):
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
 @task
 def lint(ctx):
     """Validate the code style (e.g. undefined names)"""
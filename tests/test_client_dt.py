@@ -133,5 +133,50 @@ def test_duration_string():
     assert js6 == "2:01:05"
 
 
+CALENDAR_TEST_JS = """
+var results = {fast: [], slow: []};
+for (var first_day of [0, 1]) {
+    window.simplesettings = {first_day_of_week: first_day};
+    for (var name of ["fast", "slow"]) {
+        _calendar = new Calendar();
+        if (name == "slow") { _calendar._max_years = 0; }
+        var out = results[name];
+        var t = new Date(2017, 0, 1).getTime() / 1000;
+        var t_end = new Date(2020, 0, 1).getTime() / 1000;
+        while (t < t_end) {
+            for (var res of ["1D", "2D", "1W", "1M", "3M", "1Y", "5Y"]) {
+                out.push(floor(t, res));
+            }
+            var day = floor(t, "1D");
+            var month = floor(t, "1M");
+            for (var delta of ["1D", "-3D", "2W", "1M", "-1M", "1Y", "0.5D"]) {
+                out.push(add(day, delta), add(month, delta), add(t, delta));
+            }
+            out.push(get_weeknumber(t));
+            t += 7 * 3600 + 13;
+        }
+    }
+}
+"""
+
+
+def test_calendar_cache():
+    if not HAS_NODE:
+        print("skipping tests that use node")
+        return
+
+    js = py2js(open(dt.__file__, "rb").read().decode(), docstrings=False)
+
+    # Using the cache gives the same results, also around DST transitions
+    for tz in ["Europe/Amsterdam", "America/Sao_Paulo", "UTC"]:
+        code = f"process.env.TZ = '{tz}';\nwindow = {{}};\n" + js + CALENDAR_TEST_JS
+        out = evaljs(code, "results.fast.length")
+        assert int(out) > 10000
+        assert (
+            evaljs(code, "JSON.stringify(results.fast) == JSON.stringify(results.slow)")
+            == "true"
+        )
+
+
 if __name__ == "__main__":
     run_tests(globals())
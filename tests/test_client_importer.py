@@ -0,0 +1,126 @@
+"""
+Test the parsing of data to import, in chunks via the import worker.
+"""
+
+import os
+import json
+import tempfile
+import subprocess
+from importlib import resources
+
+import pscript
+
+from _common import run_tests
+from timetagger.server import create_assets_from_dir
+
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "import_samples")
+
+IMPORT_TEST_JS = """
+const fs = require("fs");
+const vm = require("vm");
+
+// Run the worker in its own global scope
+const wg = vm.createContext({console, crypto, Blob, TextDecoderStream});
+wg.self = wg;
+wg.importScripts = function (...names) {
+    for (const n of names) { vm.runInContext(fs.readFileSync(n, "utf8"), wg); }
+};
+vm.runInContext(fs.readFileSync("import_worker.js", "utf8"), wg);
+vm.runInContext("text_chunk_size = 37;", wg);  // many small chunks
+
+function parse(msg) {
+    return new Promise(function (resolve) {
+        const result = {logs: [], records: [], keys: [], batches: 0};
+        wg.postMessage = function (m) {
+            if (m.type == "log") { result.logs.push(m.text); }
+            else if (m.type == "records") {
+                result.batches += 1;
+                result.records.push(...m.records);
+                result.keys.push(...m.keys);
+            } else if (m.type == "done") { result.ok = m.ok; resolve(result); }
+        };
+        wg.onmessage({data: msg});
+    });
+}
+
+function strip(result) {
+    // Keys and mt are generated
+    result.records = result.records.map(r => [r.t1, r.t2, r.ds]);
+    return result;
+}
+
+(async () => {
+    const text = fs.readFileSync("sample.txt", "utf8");
+    const out = {};
+    // In one go, in the main thread
+    const parser = new wg.importer.ImportParser();
+    const logs = [];
+    const lines = text.trimStart().split("\\n");
+    out.header = parser.parse_header(lines[0].trim(), (s) => logs.push(s));
+    const result = parser.parse_rows(lines.slice(1).join("\\n"), true, (s) => logs.push(s));
+    out.direct = strip({logs: logs, records: result[0], keys: result[1]});
+    // In chunks, from text and from a file
+    out.text = strip(await parse({type: "parse", text: text}));
+    out.file = strip(await parse({type: "parse", file: new Blob([text])}));
+    // Errors are reported
+    out.bad = await parse({type: "parse", text: "foo,bar\\n1,2\\n"});
+    console.log(JSON.stringify(out));
+})();
+"""
+
+
+def _parse_sample(sample):
+    try:
+        node_exe = pscript.functions.get_node_exe()
+        subprocess.check_output([node_exe, "-v"])
+    except Exception:  # pragma: no cover
+        print("skipping test that uses node")
+        return None
+
+    assets = create_assets_from_dir(resources.files("timetagger.app"))
+    with tempfile.TemporaryDirectory() as dirname:
+        for fname in ("utils.js", "dt.js", "stores.js", "importer.js"):
+            with open(os.path.join(dirname, fname), "wb") as f:
+                f.write(assets[fname])
+        with open(os.path.join(dirname, "import_worker.js"), "wb") as f:
+            f.write(assets["import_worker.js"].encode())
+        with open(os.path.join(SAMPLE_DIR, sample), "rb") as f:
+            data = f.read()
+        with open(os.path.join(dirname, "sample.txt"), "wb") as f:
+            f.write(data)
+        with open(os.path.join(dirname, "test.js"), "wb") as f:
+            f.write(IMPORT_TEST_JS.encode())
+        out = subprocess.check_output([node_exe, "test.js"], cwd=dirname)
+    return json.loads(out.decode())
+
+
+def test_import_worker_yast():
+    out = _parse_sample("yast_sample.csv")
+    if out is None:  # pragma: no cover
+        return
+
+    assert out["header"] is True
+    direct = out["direct"]
+    assert direct["logs"][0] == "Looks like the separator is comma"
+    assert len(direct["records"]) > 10
+    assert all(r[1] > r[0] for r in direct["records"])
+    assert direct["records"][0][2] == "#paid/Company-A"
+
+    # Parsing in chunks gives the same result
+    for name in ("text", "file"):
+        result = out[name]
+        assert result["ok"] is True
+        assert result["logs"] == direct["logs"]
+        assert result["records"] == direct["records"]
+        assert result["keys"] == direct["keys"]
+    assert out["text"]["batches"] > 1
+
+    # Missing headers are reported
+    assert out["bad"]["ok"] is False
+    assert out["bad"]["logs"][-1] == "Missing required header for start time."
+    assert out["bad"]["records"] == []
+
+
+if __name__ == "__main__":
+    run_tests(globals())
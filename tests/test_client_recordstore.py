@@ -1,5 +1,8 @@
+import random
+
 from _common import run_tests
-from timetagger.app.stores import RecordStore, make_hidden
+from timetagger.app import dt
+from timetagger.app.stores import RecordStore, TextIndex, make_hidden
 
 
 class DataStoreStub:
@@ -265,6 +268,44 @@ def test_invalid_records():
     assert len(rs._items.keys()) == 1
 
 
+def test_put_many():
+    class CountingDataStore:
+        def __init__(self):
+            self.puts = []
+
+        def _put(self, kind, *items):
+            self.puts.append(len(items))
+
+    datastore = CountingDataStore()
+    rs = RecordStore(datastore)
+    t0 = dt.to_time_int("2018-04-20 10:00:00")
+
+    # Put many records at once, one is invalid
+    records = [rs.create(t0 + i * 100, t0 + i * 100 + 50, "#a") for i in range(100)]
+    records[3].pop("key")
+    rs.put_many(records)
+    assert datastore.puts == [99]
+    assert len(rs._items.keys()) == 99
+    assert rs.get_stats(0, 1e15) == {"#a": 99 * 50}
+    assert records[0].st == 0 and records[0].mt > 0
+
+    # Mass edit, the stored records are copies
+    records = [rs.get_by_key(key) for key in rs._items.keys()]
+    for record in records:
+        record.ds = "#b"
+    rs._items[records[0].key].mt += 10  # newer in store
+    rs.put_many(records)
+    assert datastore.puts == [99, 98]
+    assert rs.get_keys_for_tags(["#a"]) == [records[0].key]
+    assert len(rs.get_keys_for_tags(["#b"])) == 98
+    records[1].ds = "#c"
+    assert rs.get_by_key(records[1].key).ds == "#b"
+
+    # Nothing to put, nothing to sync
+    rs.put_many([])
+    assert datastore.puts == [99, 98]
+
+
 def test_record_running():
     datastore = DataStoreStub()
     rs1 = RecordStore(datastore)
@@ -297,6 +338,312 @@ def test_record_running():
     assert len(rs2.get_records(0, 1e15)) == 1
 
 
+def test_stats_cache():
+    datastore = DataStoreStub()
+    rs = RecordStore(datastore)
+
+    r1 = rs.create("2018-04-20 10:00:00", "2018-04-20 11:00:00", "#p1")
+    rs.put(r1)
+    r = rs.create("2018-04-01 00:00:00", "2018-05-01 00:00:00")
+    t1, t2 = r.t1, r.t2
+
+    # Second call is served from the cache
+    assert rs.get_stats(t1, t2) == {"#p1": 3600}
+    assert len(rs._stats_lru) == 1
+    assert rs.get_stats(t1, t2) == {"#p1": 3600}
+    assert len(rs._stats_lru) == 1
+
+    # The result is a copy
+    rs.get_stats(t1, t2)["#p1"] = 0
+    assert rs.get_stats(t1, t2) == {"#p1": 3600}
+
+    # Changes invalidate the cache
+    r2 = rs.create("2018-04-20 12:00:00", "2018-04-20 12:30:00", "#p2")
+    rs.put(r2)
+    assert rs.get_stats(t1, t2) == {"#p1": 3600, "#p2": 1800}
+    rs._drop(r2.key)
+    assert rs.get_stats(t1, t2) == {"#p1": 3600}
+
+    # Running records are added to the cached result
+    r3 = rs.create("2018-04-20 13:00:00", "2018-04-20 13:00:00", "#p3")
+    rs.put(r3)
+    stats1 = rs.get_stats(0, 1e15)
+    stats2 = rs.get_stats(0, 1e15)
+    assert stats1["#p1"] == stats2["#p1"] == 3600
+    assert 0 < stats1["#p3"] <= stats2["#p3"]
+
+    # The cache is limited in size
+    for i in range(100):
+        rs.get_stats(t1 + i, t2)
+    assert len(rs._stats_lru) == 16
+
+
+def test_readonly_records():
+    datastore = DataStoreStub()
+    rs = RecordStore(datastore)
+
+    r1 = rs.create("2018-04-20 10:00:00", "2018-04-20 11:00:00", "#p1")
+    r2 = rs.create("2018-04-20 12:00:00", "2018-04-20 12:00:00", "#p2")
+    rs.put(r1, r2)
+
+    # The normal methods return copies, the readonly methods do not
+    assert rs.get_by_key(r1.key) is not rs._items[r1.key]
+    assert rs.get_by_key_readonly(r1.key) is rs._items[r1.key]
+    assert rs.get_by_key_readonly("notakey") is None
+    records1 = rs.get_records(0, 1e15)
+    records2 = rs.get_records_readonly(0, 1e15)
+    assert records1 == records2 and len(records2) == 2
+    for key in records2.keys():
+        assert records1[key] is not rs._items[key]
+        assert records2[key] is rs._items[key]
+    running = rs.get_running_records_readonly()
+    assert len(running) == 1 and running[0] is rs._items[r2.key]
+
+    # By default, stored records are not frozen
+    rs.get_by_key_readonly(r1.key).ds = "oops"
+    assert rs.get_by_key(r1.key).ds == "oops"
+
+    # But they can be, to catch in-place modifications
+    rs.freeze_records = True
+    rs.put(rs.get_by_key(r1.key))
+    record = rs.get_by_key_readonly(r1.key)
+    for func in (
+        lambda: setattr(record, "ds", "oops"),
+        lambda: record.__setitem__("ds", "oops"),
+        lambda: record.update(ds="oops"),
+        lambda: record.pop("ds"),
+    ):
+        try:
+            func()
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("Expected TypeError")
+
+    # Copies of frozen records can be modified and put
+    record = rs.get_by_key(r1.key)
+    record.ds = "#p3"
+    rs.put(record)
+    assert rs.get_by_key_readonly(r1.key).ds == "#p3"
+    assert rs.get_stats(0, 1e15)["#p3"] == 3600
+
+
+def test_tag_index():
+    datastore = DataStoreStub()
+    rs = RecordStore(datastore)
+
+    def check_index():
+        tags_t2 = {}
+        for r in rs.get_dump():
+            for tag in rs.tags_from_record(r):
+                tags_t2[tag] = max(r.t2, tags_t2.get(tag, 0))
+        assert rs.get_tags_last_used() == tags_t2
+        for tags in [["#p1"], ["#p1", "#p2"], ["#p3"], ["#untagged"], ["#nope"]]:
+            keys = set()
+            for r in rs.get_dump():
+                if all(tag in rs.tags_from_record(r) for tag in tags):
+                    keys.add(r.key)
+            assert set(rs.get_keys_for_tags(tags)) == keys
+
+    r1 = rs.create("2018-04-20 10:00:00", "2018-04-20 11:00:00", "#p1")
+    r2 = rs.create("2018-04-21 10:00:00", "2018-04-21 11:00:00", "#p1 #p2")
+    r3 = rs.create("2018-04-22 10:00:00", "2018-04-22 11:00:00", "no tags")
+    rs.put(r1, r2, r3)
+    assert rs.get_keys_for_tags(["#p1", "#p2"]) == [r2.key]
+    assert rs.get_keys_for_tags([]) == []
+    assert rs.get_tags_last_used()["#p1"] == r2.t2
+    check_index()
+
+    # Changing tags and times
+    r2 = rs.get_by_key(r2.key)
+    r2.ds = "#p2 #p3"
+    rs.put(r2)
+    assert rs.get_tags_last_used()["#p1"] == r1.t2
+    check_index()
+    r1 = rs.get_by_key(r1.key)
+    r1.t2 += 3600
+    rs.put(r1)
+    check_index()
+
+    # Hidden records keep their tags
+    r3 = rs.get_by_key(r3.key)
+    make_hidden(r3)
+    rs.put(r3)
+    check_index()
+
+    # Dropping
+    rs._drop(r1.key)
+    assert "#p1" not in rs.get_tags_last_used()
+    check_index()
+
+    # Bulk puts rebuild the index lazily
+    records = []
+    for i in range(200):
+        t1 = random.randint(10**9, 2 * 10**9)
+        ds = " ".join(random.sample(["#p1", "#p2", "#p3", "foo"], 2))
+        records.append(rs.create(t1, t1 + 3600, ds))
+    rs.put(*records)
+    assert rs._tag_keys is None
+    check_index()
+    for record in records[:20]:
+        record = rs.get_by_key(record.key)
+        record.ds = "#p3"
+        rs.put(record)
+    for record in records[20:40]:
+        rs._drop(record.key)
+    check_index()
+
+
+def test_text_index():
+    index = TextIndex()
+    index.put("a", "Meeting with Bob #work")
+    index.put("b", "meet the team")
+    index.put("c", "bobsleigh  ")
+    assert sorted(index.get_keys(["meet"])) == ["a", "b"]
+    assert sorted(index.get_keys(["BOB"])) == ["a", "c"]
+    assert index.get_keys(["meet", "bob"]) == ["a"]
+    assert index.get_keys(["meet", "nope"]) == []
+    assert index.get_keys([]) == []
+    index.put("a", "lunch")
+    assert index.get_keys(["bob"]) == ["c"]
+    index.remove("c")
+    index.remove("notakey")
+    assert index.get_keys(["bob"]) == []
+    assert index._token2keys.keys() == {"lunch", "meet", "the", "team"}
+
+    # Via the record store
+    datastore = DataStoreStub()
+    rs = RecordStore(datastore)
+    words = ["foo", "bar", "spam", "eggs", "Foobar", "#p1"]
+
+    def check_index():
+        for search in [["foo"], ["foo", "bar"], ["oob"], ["am"], ["#p"], ["x"]]:
+            keys = set()
+            for r in rs.get_dump():
+                if all(word in r.ds.lower() for word in search):
+                    keys.add(r.key)
+            assert set(rs.get_keys_for_words(search)) == keys
+
+    records = []
+    for i in range(200):
+        t1 = random.randint(10**9, 2 * 10**9)
+        ds = " ".join(random.sample(words, 3))
+        records.append(rs.create(t1, t1 + 3600, ds))
+    rs.put(*records[:20])
+    check_index()
+    rs.put(*records[20:])
+    assert rs._text_index is None
+    check_index()
+    for record in records[:20]:
+        record = rs.get_by_key(record.key)
+        record.ds = random.choice(words)
+        rs.put(record)
+    for record in records[20:40]:
+        rs._drop(record.key)
+    check_index()
+
+
+def test_get_records_sorted():
+    datastore = DataStoreStub()
+    rs = RecordStore(datastore)
+
+    def check(t1, t2):
+        ref = list(rs.get_records(t1, t2).values())
+        for order in ("t1", "t2", "-t1", "-t2"):
+            what = order[-2:]
+            records = rs.get_records_sorted(t1, t2, order)
+            assert set(r.key for r in records) == set(r.key for r in ref)
+            times = [r[what] for r in records]
+            assert times == sorted(times, reverse=order.startswith("-"))
+
+    # A bulk put, and then a few single puts
+    t0 = rs.create("2018-04-20 00:00:00", "2018-04-20 00:00:00").t1
+    records = []
+    for i in range(100):
+        t1 = t0 + random.randint(0, 30 * 86400)
+        t2 = t1 + random.choice([1, 60, 3600, 4 * 86400])
+        records.append(rs.create(t1, t2, random.choice(["#p1", "#p2", ""])))
+    rs.put(*records)
+    for i in range(10):
+        t1 = t0 + random.randint(0, 30 * 86400)
+        rs.put(rs.create(t1, t1 + 7200, "#p3"))
+
+    for i in range(20):
+        t1 = t0 + random.randint(-86400, 30 * 86400)
+        check(t1, t1 + random.choice([3600, 86400, 7 * 86400]))
+    check(0, 1e15)
+
+    # Move, hide and drop records
+    for record in records[:10]:
+        record.t1 -= 86400
+        rs.put(record)
+    make_hidden(records[10])
+    rs.put(records[10])
+    rs._drop(records[11].key)
+    check(0, 1e15)
+    assert len(rs.get_records_sorted(0, 1e15)) == 110 - 2
+    for i in range(20):
+        t1 = t0 + random.randint(-86400, 30 * 86400)
+        check(t1, t1 + random.choice([3600, 86400, 7 * 86400]))
+
+    # Running records are included too
+    running = rs.create(t0 + 86400, t0 + 86400, "#running")
+    rs.put(running)
+    check(t0, t0 + 3 * 86400)
+    assert running.key in [r.key for r in rs.get_records_sorted(0, 1e15)]
+
+
+def test_adaptive_bin_size():
+    def check_store(rs, records, t1, t2):
+        stats = {}
+        for r in records:
+            t = min(r.t2, t2) - max(r.t1, t1)
+            if t > 0:
+                stats[r.ds] = stats.get(r.ds, 0) + t
+        assert rs.get_stats(t1, t2) == stats
+        keys = set(r.key for r in records if r.t2 > t1 and r.t1 < t2)
+        assert set(rs.get_records(t1, t2).keys()) == keys
+
+    datastore = DataStoreStub()
+    t0 = dt.to_time_int("2018-04-20 08:00:00")
+
+    # Dense: 2000 records of 5 minutes, back to back
+    rs = RecordStore(datastore)
+    assert rs._bin_size == 2**17
+    records = [
+        rs.create(t0 + i * 300, t0 + i * 300 + 300, f"#p{i % 3}") for i in range(2000)
+    ]
+    rs._put(*records)
+    assert rs._bin_size < 2**17
+    check_store(rs, records, t0 + 1000, t0 + 100000)
+    check_store(rs, records, t0 - 1000, t0 + 2000 * 300)
+
+    # Same for incremental puts
+    rs = RecordStore(datastore)
+    for record in records:
+        rs._put(record)
+    assert rs._bin_size < 2**17
+    check_store(rs, records, t0 + 1000, t0 + 100000)
+
+    # Unless disabled
+    rs = RecordStore(datastore)
+    rs.adaptive_bin_size = False
+    rs._put(*records)
+    assert rs._bin_size == 2**17
+    check_store(rs, records, t0 + 1000, t0 + 100000)
+
+    # Sparse: 300 records of an hour, two weeks apart
+    rs = RecordStore(datastore)
+    records = [
+        rs.create(t0 + i * 14 * 86400, t0 + i * 14 * 86400 + 3600, f"#p{i % 3}")
+        for i in range(300)
+    ]
+    rs._put(*records)
+    assert rs._bin_size > 2**17
+    check_store(rs, records, t0 + 1000, t0 + 100 * 86400)
+    check_store(rs, records, t0 - 1000, t0 + 300 * 14 * 86400)
+
+
 def test_deleting_records():
     datastore = DataStoreStub()
     rs = RecordStore(datastore)
@@ -2,10 +2,17 @@
 Test other stores.
 """
 
+import os
 import datetime
+import tempfile
+import subprocess
+from importlib import resources
+
+import pscript
 
 from _common import run_tests
 from timetagger.app import stores
+from timetagger.server import create_assets_from_dir
 
 
 class Stub:
@@ -44,5 +51,84 @@ def test_demo_record_store():
     print(stats)
 
 
+WORKER_TEST_JS = """
+const fs = require("fs");
+const vm = require("vm");
+
+// The worker gets its own global scope, and messages are cloned via JSON
+const wg = vm.createContext({console: console});
+wg.self = wg;
+wg.importScripts = function (...names) {
+    for (const n of names) { vm.runInContext(fs.readFileSync(n, "utf8"), wg); }
+};
+const wclone = vm.runInContext("(s) => JSON.parse(s)", wg);
+globalThis.window = globalThis;
+window.Worker = function (url) {
+    const w = this;
+    wg.postMessage = (d) => setTimeout(() => w.onmessage({data: JSON.parse(JSON.stringify(d))}));
+    this.postMessage = (d) => setTimeout(() => wg.onmessage({data: wclone(JSON.stringify(d))}));
+    this.terminate = () => {};
+    vm.runInContext(fs.readFileSync(url, "utf8"), wg);
+};
+for (const n of ["utils.js", "dt.js", "stores.js"]) { (0, eval)(fs.readFileSync(n, "utf8")); }
+
+(async () => {
+    const rs = new window.stores.RecordStoreProxy({_put: function () {}});
+    const r1 = rs.create(1000000, 1003600, "hi #foo");
+    rs._put(r1, rs.create(1100000, 1101000, "#bar"));
+    const out = [JSON.stringify(rs.get_stats(0, 2000000))];  // not yet known
+    await rs.prefetch(0, 2000000);
+    out.push(JSON.stringify(rs.get_stats(0, 2000000)));
+    out.push(JSON.stringify(rs.get_stats(0, 1050000)));  // not yet known
+    await rs.prefetch(0, 1050000);
+    out.push(JSON.stringify(rs.get_stats(0, 1050000)));
+    out.push(Object.keys(rs.get_records(0, 1050000)).length);
+    rs._drop(r1.key);
+    await rs.prefetch(0, 2000000);
+    out.push(JSON.stringify(rs.get_stats(0, 2000000)));
+    // If the worker fails, the stats are calculated in this thread
+    const waiting = rs.prefetch(0, 3000000);
+    rs._worker.onerror({message: "test"});
+    await waiting;
+    out.push(JSON.stringify(rs.get_stats(0, 3000000)));
+    rs._put(rs.create(2000000, 2000100, "#baz"));
+    out.push(JSON.stringify(rs.get_stats(0, 3000000)));
+    console.log(out.join("\\n"));
+})();
+"""
+
+
+def test_record_store_proxy():
+    try:
+        node_exe = pscript.functions.get_node_exe()
+        subprocess.check_output([node_exe, "-v"])
+    except Exception:  # pragma: no cover
+        print("skipping test that uses node")
+        return
+
+    assets = create_assets_from_dir(resources.files("timetagger.app"))
+    with tempfile.TemporaryDirectory() as dirname:
+        for fname in ("utils.js", "dt.js", "stores.js", "stores_worker.js"):
+            data = assets[fname]
+            if isinstance(data, str):
+                data = data.encode()
+            with open(os.path.join(dirname, fname), "wb") as f:
+                f.write(data)
+        with open(os.path.join(dirname, "test.js"), "wb") as f:
+            f.write(WORKER_TEST_JS.encode())
+        out = subprocess.check_output([node_exe, "test.js"], cwd=dirname)
+
+    assert out.decode().strip().splitlines() == [
+        "{}",
+        '{"#foo":3600,"#bar":1000}',
+        "{}",
+        '{"#foo":3600}',
+        "1",
+        '{"#bar":1000}',
+        '{"#bar":1000}',
+        '{"#bar":1000,"#baz":100}',
+    ]
+
+
 if __name__ == "__main__":
     run_tests(globals())
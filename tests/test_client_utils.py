@@ -9,6 +9,8 @@ from timetagger.app.utils import (
     get_tags_and_parts_from_string,
     get_better_tag_order_from_stats,
     timestr2tuple,
+    Picker,
+    TextWidthCache,
 )
 
 
@@ -310,5 +312,79 @@ def test_timestr2tuple():
     assert timestr2tuple("132s") == (0, 0, 132)
 
 
+def test_picker():
+    picker = Picker()
+    assert picker.pick(10, 10) is None
+
+    # Regions registered later are on top
+    picker.register(0, 0, 100, 100, "a")
+    picker.register(50, 50, 150, 150, "b")
+    assert picker.pick(10, 10) == "a"
+    assert picker.pick(60, 60) == "b"
+    assert picker.pick(120, 120) == "b"
+    assert picker.pick(160, 160) is None
+    assert picker.pick(0, 10) is None  # edges are excluded
+
+    # A large region, and a small region on top of that
+    picker.register(-1000, -1000, 5000, 5000, "c")
+    assert picker.pick(60, 60) == "c"
+    assert picker.pick(-500, 3000) == "c"
+    picker.register(55, 55, 65, 65, "d")
+    assert picker.pick(60, 60) == "d"
+    assert picker.pick(70, 70) == "c"
+
+    # Many small regions
+    for i in range(1000):
+        picker.register(i * 10, 5000, i * 10 + 10, 5010, i)
+    assert picker.pick(5, 5005) == 0
+    assert picker.pick(9995, 5005) == 999
+    assert picker.pick(9995, 4000) is None
+
+    picker.clear()
+    assert picker.pick(60, 60) is None
+
+
+class FakeTextMetrics:
+    def __init__(self, width):
+        self.width = width
+
+
+class FakeContext:
+    def __init__(self):
+        self.font = "10px sans"
+        self.count = 0
+
+    def measureText(self, text):
+        self.count += 1
+        size = int(self.font.split("px")[0])
+        return FakeTextMetrics(size * len(text))
+
+
+def test_text_width_cache():
+    ctx = FakeContext()
+    cache = TextWidthCache(4)
+
+    assert cache.measure(ctx, "foo") == 30
+    assert cache.measure(ctx, "foo") == 30
+    assert ctx.count == 1
+
+    # The font is part of the key
+    ctx.font = "20px sans"
+    assert cache.measure(ctx, "foo") == 60
+    assert ctx.count == 2
+
+    # Entries that are used survive, others are dropped
+    for text in ["a", "b", "c", "d", "e", "f"]:
+        cache.measure(ctx, text)
+        assert cache.measure(ctx, "foo") == 60
+    assert ctx.count == 8
+    cache.measure(ctx, "a")
+    assert ctx.count == 9
+
+    cache.clear()
+    assert cache.measure(ctx, "foo") == 60
+    assert ctx.count == 10
+
+
 if __name__ == "__main__":
     run_tests(globals())
@@ -11,6 +11,7 @@ def test_config():
     set_config([], {})
     assert config.bind == default_bind
     assert config.datadir == "~/_timetagger"
+    assert config.metrics_enabled is False
 
     # argv
     set_config(["--bind=localhost:8080"], {})
@@ -32,23 +33,26 @@ def test_config():
     set_config([], {"TIMETAGGER_BIND": "localhost:8081"})
     assert config.bind == "localhost:8081"
 
+    set_config([], {"TIMETAGGER_METRICS_ENABLED": "yes"})
+    assert config.metrics_enabled is True
+
     # env fails
     set_config([], {"BIND": "localhost:8080"})
     assert config.bind == default_bind
     set_config([], {"timetagger_bind": "localhost:8080"})
     assert config.bind == default_bind
 
-    # Test integer conv - disabled because all our config values are str
-    # set_config([], {})
-    # assert config.test == 3
-    # set_config(["--test=42"], {})
-    # assert config.test == 42
-    # set_config([], {"TIMETAGGER_TEST": "7"})
-    # assert config.test == 7
-    # with raises(RuntimeError):
-    #     set_config(["--test=notanumber"], {})
-    # with raises(RuntimeError):
-    #     set_config([], {"TIMETAGGER_TEST": "notanumber"})
+    # Test integer conv
+    set_config([], {})
+    assert config.cache_size == 0
+    set_config(["--cache_size=42"], {})
+    assert config.cache_size == 42
+    set_config([], {"TIMETAGGER_CACHE_SIZE": "7"})
+    assert config.cache_size == 7
+    with raises(RuntimeError):
+        set_config(["--cache_size=notanumber"], {})
+    with raises(RuntimeError):
+        set_config([], {"TIMETAGGER_CACHE_SIZE": "notanumber"})
 
     # Reset to normal (using sys.argv and os.environ)
     set_config()
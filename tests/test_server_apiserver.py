@@ -1,6 +1,8 @@
 import os
+import gzip
 import json
 import time
+import zlib
 import asyncio
 
 from asgineer.testutils import MockTestServer
@@ -13,6 +15,7 @@ from timetagger.server import (
     AuthException,
     api_handler_triage,
     get_webtoken_unsafe,
+    get_change_stats,
     user2filename,
 )
 
@@ -32,6 +35,8 @@ def clear_test_db():
     filename = user2filename(USER)
     if os.path.isfile(filename):
         os.remove(filename)
+    _apiserver.rate_limiter.reset()
+    _apiserver._change_stats.clear()
 
     HEADERS["authtoken"] = get_webtoken_unsafe_sync(USER)
 
@@ -177,7 +182,7 @@ def test_settings():
         )
         assert r.status == 200
         d = dejsonize(r)
-        assert set(d.keys()) == {"accepted", "failed", "errors"}
+        assert set(d.keys()) == {"accepted", "failed", "errors", "stored"}
 
         # Now there are two
         r = p.get("http://localhost/api/v2/settings", headers=HEADERS)
@@ -291,7 +296,7 @@ def test_records():
         )
         assert r.status == 200
         d = dejsonize(r)
-        assert set(d.keys()) == {"accepted", "failed", "errors"}
+        assert set(d.keys()) == {"accepted", "failed", "errors", "stored"}
         assert dejsonize(r)["accepted"] == ["r11", "r12"]
         assert dejsonize(r)["errors"] == []
 
@@ -677,6 +682,117 @@ def test_updates():
         assert "since needs a number" in r.body.decode() and "since" in r.body.decode()
 
 
+def test_updates_keys_only():
+    clear_test_db()
+    put = lambda what, items: p.put(
+        f"http://localhost/api/v2/{what}", json.dumps(items).encode(), headers=HEADERS
+    )
+    get = lambda path: dejsonize(
+        p.get(f"http://localhost/api/v2/{path}", headers=HEADERS)
+    )
+
+    with MockTestServer(our_api_handler) as p:
+        # Push records, the response has the st of the stored versions
+        records = [
+            dict(key="r1", mt=110, t1=100, t2=110, ds="A record 1!"),
+            dict(key="r2", mt=110, t1=200, t2=210, ds="A record 2!"),
+        ]
+        stored = dejsonize(put("records", records))["stored"]
+        assert set(stored.keys()) == {"r1", "r2"}
+        put("settings", [dict(key="s1", mt=110, value=1)])
+
+        # Keys-only update sends only the versions
+        d = get("updates?since=1&keys_only=1")
+        assert d["keys_only"] is True
+        assert sorted(x["key"] for x in d["records"]) == ["r1", "r2"]
+        assert set(d["records"][0].keys()) == {"key", "mt", "st"}
+        assert d["settings"] == [dict(key="s1", mt=110, st=d["settings"][0]["st"])]
+        assert {x["key"]: x["st"] for x in d["records"]} == stored
+        st_r1 = stored["r1"]
+        st1 = d["server_time"]
+
+        # The items can then be fetched by key
+        d = get("records?key=r1&key=x")
+        assert d["records"] == [dict(records[0], st=st_r1)]
+        d = get("settings?key=s1")
+        assert [x["key"] for x in d["settings"]] == ["s1"]
+
+        # Outdated and failed items are not reported as stored
+        records = [
+            dict(key="r1", mt=100, t1=100, t2=110, ds="Old"),
+            dict(key="r2", mt=120, t1=200, t2=210, ds="A record 2!"),
+            dict(key="r3", mt="xx", t1=200, t2=210),
+        ]
+        d = dejsonize(put("records", records))
+        assert list(d["stored"].keys()) == ["r2"]
+        d = get(f"updates?since={st1}&keys_only=1")
+        assert sorted(x["key"] for x in d["records"]) == ["r1", "r2"]
+        assert d["records"][0]["st"] > st_r1
+
+        # Normal mode, and reset, send all items
+        d = get(f"updates?since={st1}&keys_only=0")
+        assert "keys_only" not in d and "ds" in d["records"][0]
+        p.put("http://localhost/api/v2/forcereset", headers=HEADERS)
+        d = get(f"updates?since={st1}&keys_only=1")
+        assert d["reset"] is True and "keys_only" not in d
+        assert len(d["records"]) == 2 and "ds" in d["records"][0]
+
+        # Fails
+        query = "&".join(f"key=k{i}" for i in range(1001))
+        r = p.get(f"http://localhost/api/v2/records?{query}", headers=HEADERS)
+        assert r.status == 400
+
+    # Per-user statistics
+    stats = get_change_stats(USER)
+    assert stats["new"] == 3  # r1, r2, s1
+    assert "unchanged" not in stats and stats["changed"] == 1
+    assert stats["outdated"] == 1 and stats["failed"] == 1
+    assert stats["sent_keys"] == 5
+    assert get_change_stats("nobody") == {}
+
+
+def test_compressed_bodies():
+    clear_test_db()
+    url = "http://localhost/api/v2/records"
+    headers = lambda encoding: dict(HEADERS, **{"content-encoding": encoding})
+
+    records = [dict(key=f"r{i}", mt=110, t1=100, t2=150, ds="#p1") for i in range(100)]
+    body = json.dumps(records).encode()
+
+    with MockTestServer(our_api_handler) as p:
+        # Gzip and deflate
+        r = p.put(url, gzip.compress(body), headers=headers("gzip"))
+        assert r.status == 200
+        assert len(dejsonize(r)["accepted"]) == 100
+        r = p.put(url, zlib.compress(body), headers=headers("deflate"))
+        assert r.status == 200
+        assert len(dejsonize(r)["accepted"]) == 100
+        r = p.put(url, body, headers=headers("identity"))
+        assert r.status == 200
+
+        # Corrupt, truncated, and unsupported
+        r = p.put(url, body, headers=headers("gzip"))
+        assert r.status == 400
+        r = p.put(url, gzip.compress(body)[:-10], headers=headers("gzip"))
+        assert r.status == 400
+        r = p.put(url, gzip.compress(body) + b"xx", headers=headers("gzip"))
+        assert r.status == 400
+        r = p.put(url, body, headers=headers("br"))
+        assert r.status == 415
+
+        # The size limit applies after decompression. A decompression
+        # bomb is stopped without decompressing it all.
+        bomb = gzip.compress(b"[" + b" " * (100 * 2**20) + b"]")
+        assert len(bomb) < 200 * 2**10
+        t0 = time.perf_counter()
+        r = p.put(url, bomb, headers=headers("gzip"))
+        assert r.status == 500
+        assert "too large" in r.body.decode().lower()
+        assert time.perf_counter() - t0 < 1
+
+    assert len(get_from_db("records")) == 100
+
+
 def test_webtoken():
     clear_test_db()
     time.sleep(1.1)
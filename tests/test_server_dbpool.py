@@ -0,0 +1,71 @@
+import time
+import asyncio
+import threading
+
+from _common import run_tests
+from timetagger.server import DbThreadPool
+
+
+def run(co):
+    return asyncio.get_event_loop().run_until_complete(co)
+
+
+def test_dbpool_run():
+    pool = DbThreadPool(2)
+    assert pool.shards == 2
+
+    # Calls run in a worker thread
+    name = run(pool.run("user1", "fast", lambda: threading.current_thread().name))
+    assert name.startswith("timetagger_db_fast_")
+    name = run(pool.run("user1", "bulk", lambda: threading.current_thread().name))
+    assert name.startswith("timetagger_db_bulk_")
+
+    # Args are passed, and errors are raised
+    assert run(pool.run("user1", "fast", max, 3, 4)) == 4
+    try:
+        run(pool.run("user1", "fast", int, "notanumber"))
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected ValueError"
+
+    # Invalid lane
+    try:
+        run(pool.run("user1", "slow", max, 3, 4))
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected ValueError"
+
+    # Shards are at least one
+    assert DbThreadPool(0).shards == 1
+
+
+def test_dbpool_lanes():
+    pool = DbThreadPool(1)
+    event = threading.Event()
+    times = {}
+
+    def slow():
+        event.wait(2)
+        times["slow"] = time.perf_counter()
+
+    def fast():
+        times["fast"] = time.perf_counter()
+        event.set()
+
+    async def main():
+        # The slow bulk call does not block the fast lane of the same shard
+        task = asyncio.ensure_future(pool.run("user1", "bulk", slow))
+        await asyncio.sleep(0.01)
+        assert pool.get_queue_depths() == {"fast": 0, "bulk": 1}
+        await pool.run("user2", "fast", fast)
+        await task
+        assert pool.get_queue_depths() == {"fast": 0, "bulk": 0}
+
+    run(main())
+    assert times["fast"] < times["slow"]
+
+
+if __name__ == "__main__":
+    run_tests(globals())
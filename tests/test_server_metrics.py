@@ -0,0 +1,193 @@
+import asyncio
+
+import asgineer
+from asgineer.testutils import MockTestServer
+
+from _common import run_tests
+from timetagger.server import (
+    authenticate,
+    AuthException,
+    api_handler_triage,
+    get_webtoken_unsafe,
+    metrics,
+    metrics_handler,
+    instrument_asgi,
+)
+from timetagger.server._metrics import Metrics, get_endpoint
+
+
+async def our_api_handler(request):
+    if request.path == "/metrics":
+        return await metrics_handler(request)
+    path = request.path[len("/api/v2/") :]
+    try:
+        auth_info, db = await authenticate(request)
+    except AuthException as err:
+        return 401, {}, f"Auth failed: {err}"
+    return await api_handler_triage(request, path, auth_info, db)
+
+
+def test_metrics_render():
+    m = Metrics()
+
+    # Disabled by default, nothing is collected
+    m.inc("timetagger_requests_total", endpoint="app", method="GET", status=200)
+    m.observe("timetagger_request_seconds", 0.1, endpoint="app")
+    assert m.render() == "\n"
+
+    m.enabled = True
+    m.inc("timetagger_requests_total", endpoint="app", method="GET", status=200)
+    m.inc("timetagger_requests_total", endpoint="app", method="GET", status=200)
+    m.inc("timetagger_requests_total", endpoint="app", method="GET", status=304)
+    m.observe("timetagger_request_seconds", 0.002, endpoint="app")
+    m.observe("timetagger_request_seconds", 0.3, endpoint="app")
+    m.observe("timetagger_request_seconds", 100, endpoint="app")
+
+    assert m.get("timetagger_requests_total", endpoint="app", method="GET", status=200)
+    hist = m.get("timetagger_request_seconds", endpoint="app")
+    assert hist.count == 3
+    assert abs(hist.sum - 100.302) < 1e-9
+
+    lines = m.render().splitlines()
+    assert "# TYPE timetagger_requests_total counter" in lines
+    assert (
+        'timetagger_requests_total{endpoint="app",method="GET",status="200"} 2' in lines
+    )
+    assert (
+        'timetagger_requests_total{endpoint="app",method="GET",status="304"} 1' in lines
+    )
+    assert "# TYPE timetagger_request_seconds histogram" in lines
+    # Buckets are cumulative
+    assert 'timetagger_request_seconds_bucket{endpoint="app",le="0.001"} 0' in lines
+    assert 'timetagger_request_seconds_bucket{endpoint="app",le="0.0025"} 1' in lines
+    assert 'timetagger_request_seconds_bucket{endpoint="app",le="0.5"} 2' in lines
+    assert 'timetagger_request_seconds_bucket{endpoint="app",le="10.0"} 2' in lines
+    assert 'timetagger_request_seconds_bucket{endpoint="app",le="+Inf"} 3' in lines
+    assert 'timetagger_request_seconds_count{endpoint="app"} 3' in lines
+
+    # Gauges are set
+    m.set("timetagger_db_queue_depth", 3, lane="fast")
+    m.set("timetagger_db_queue_depth", 2, lane="fast")
+    lines = m.render().splitlines()
+    assert "# TYPE timetagger_db_queue_depth gauge" in lines
+    assert 'timetagger_db_queue_depth{lane="fast"} 2' in lines
+
+    m.reset()
+    assert m.render() == "\n"
+
+
+def test_metrics_endpoint_labels():
+    assert get_endpoint("/timetagger/api/v2/updates") == "api/updates"
+    assert get_endpoint("/timetagger/api/v2/records/") == "api/records"
+    assert get_endpoint("/timetagger/api/v2/foo/bar") == "api/other"
+    assert get_endpoint("/timetagger/app/") == "app"
+    assert get_endpoint("/timetagger/app/timetagger.js") == "app"
+    assert get_endpoint("/timetagger/status") == "status"
+    assert get_endpoint("/timetagger/metrics") == "metrics"
+    assert get_endpoint("/timetagger/login") == "web"
+    assert get_endpoint("/foo") == "other"
+
+
+def test_metrics_api():
+    loop = asyncio.get_event_loop()
+    token = loop.run_until_complete(get_webtoken_unsafe("test_metrics"))
+    headers = {"authtoken": token}
+    records = b'[{"key": "k1", "mt": 100, "t1": 100, "t2": 110, "ds": "x"}]'
+
+    metrics.reset()
+    try:
+        with MockTestServer(our_api_handler) as p:
+            # Disabled: nothing is collected, and the endpoint is not available
+            metrics.enabled = False
+            r = p.get("/api/v2/updates?since=0", headers=headers)
+            assert r.status == 200
+            r = p.get("/metrics")
+            assert r.status == 404
+
+            metrics.enabled = True
+            r = p.get("/api/v2/updates?since=0", headers=headers)
+            assert r.status == 200
+            r = p.put("/api/v2/records", records, headers=headers)
+            assert r.status == 200
+            r = p.get("/metrics")
+            assert r.status == 200
+            assert r.headers["content-type"].startswith("text/plain")
+            text = r.body.decode()
+    finally:
+        metrics.enabled = False
+
+    hist = metrics.get("timetagger_api_handler_seconds", route="updates", method="GET")
+    assert hist.count == 1
+    hist = metrics.get("timetagger_api_handler_seconds", route="records", method="PUT")
+    assert hist.count == 1
+    for phase in ("jwt", "db_open", "seed"):
+        assert metrics.get("timetagger_auth_seconds", phase=phase).count == 2
+    assert metrics.get("timetagger_db_query_seconds", op="get_token_seed").count == 2
+    assert metrics.get("timetagger_db_query_seconds", op="get_items_by_key").count == 1
+    assert metrics.get("timetagger_db_query_seconds", op="put_items").count == 1
+    assert metrics.get("timetagger_db_query_seconds", op="commit").count == 1
+    assert metrics.get("timetagger_json_seconds", what="records").count == 1
+
+    assert 'timetagger_auth_seconds_count{phase="jwt"} 2' in text
+    assert 'timetagger_db_query_seconds_count{op="put_items"} 1' in text
+
+
+def test_metrics_asgi():
+    @instrument_asgi
+    @asgineer.to_asgi
+    async def handler(request):
+        body = await request.get_body()
+        return 200, {}, body * 2
+
+    async def call(path, body):
+        scope = {
+            "type": "http",
+            "method": "PUT",
+            "path": path,
+            "query_string": b"",
+            "headers": [],
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await handler(scope, receive, send)
+        return sent
+
+    loop = asyncio.get_event_loop()
+    metrics.reset()
+    try:
+        metrics.enabled = False
+        sent = loop.run_until_complete(call("/timetagger/api/v2/records", b"abc"))
+        assert sent[0]["status"] == 200
+        assert metrics.render() == "\n"
+
+        metrics.enabled = True
+        sent = loop.run_until_complete(call("/timetagger/api/v2/records", b"abc"))
+        assert sent[0]["status"] == 200
+    finally:
+        metrics.enabled = False
+
+    assert (
+        metrics.get(
+            "timetagger_requests_total",
+            endpoint="api/records",
+            method="PUT",
+            status=200,
+        )
+        == 1
+    )
+    hist = metrics.get("timetagger_request_bytes", endpoint="api/records")
+    assert hist.count == 1 and hist.sum == 3
+    hist = metrics.get("timetagger_response_bytes", endpoint="api/records")
+    assert hist.count == 1 and hist.sum == 6
+    assert metrics.get("timetagger_request_seconds", endpoint="api/records").count == 1
+
+
+if __name__ == "__main__":
+    run_tests(globals())
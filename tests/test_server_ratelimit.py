@@ -0,0 +1,167 @@
+import asyncio
+
+from asgineer.testutils import MockTestServer
+
+from _common import run_tests
+from timetagger.server import (
+    authenticate,
+    api_handler_triage,
+    get_webtoken_unsafe,
+)
+from timetagger.server import _apiserver
+from timetagger.server._ratelimit import RateLimiter, AdmissionControl
+
+
+def run(co):
+    return asyncio.get_event_loop().run_until_complete(co)
+
+
+async def our_api_handler(request):
+    path = request.path[len("/api/v2/") :]
+    auth_info, db = await authenticate(request)
+    return await api_handler_triage(request, path, auth_info, db)
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1.0, {"poll": (0.5, 3), "full": (0.1, 1)})
+
+    # Burst
+    for i in range(3):
+        assert limiter.check("user1", "poll", 100) == 0
+    assert limiter.check("user1", "poll", 100) == 2
+    assert limiter.check("user1", "poll", 100) == 2
+
+    # Other users and kinds have their own bucket, unknown kinds are not limited
+    assert limiter.check("user2", "poll", 100) == 0
+    assert limiter.check("user1", "full", 100) == 0
+    assert limiter.check("user1", "full", 100) == 10
+    assert limiter.check("user1", "other", 100) == 0
+
+    # Refill
+    assert limiter.check("user1", "poll", 101) == 1
+    assert limiter.check("user1", "poll", 102) == 0
+    assert limiter.check("user1", "poll", 102) == 2
+    assert limiter.check("user1", "poll", 1000) == 0
+    assert limiter.check("user1", "poll", 1000) == 0
+    assert limiter.check("user1", "poll", 1000) == 0
+    assert limiter.check("user1", "poll", 1000) == 2
+
+    # Factor
+    limiter = RateLimiter(2.0, {"poll": (0.5, 3)})
+    for i in range(6):
+        assert limiter.check("user1", "poll", 100) == 0
+    assert limiter.check("user1", "poll", 100) == 1
+    limiter = RateLimiter(0, {"poll": (0.5, 3)})
+    for i in range(100):
+        assert limiter.check("user1", "poll", 100) == 0
+
+    # Prune buckets that are full
+    limiter = RateLimiter(1.0, {"poll": (0.5, 3)})
+    limiter.max_buckets = 3
+    for i in range(3):
+        limiter.check(f"user{i}", "poll", 100)
+    assert len(limiter._buckets) == 3
+    limiter.check("user3", "poll", 100)
+    assert len(limiter._buckets) == 4
+    limiter.check("user4", "poll", 200)
+    assert len(limiter._buckets) == 1
+
+
+def test_admission_control():
+    async def main():
+        ac = AdmissionControl(2, timeout=0.1)
+        assert await ac.acquire()
+        assert await ac.acquire()
+        assert ac.count == 2
+        # Timeout
+        assert not await ac.acquire()
+        # A waiter gets the slot when it's released
+        task = asyncio.ensure_future(ac.acquire())
+        await asyncio.sleep(0.01)
+        ac.release()
+        assert await task
+        assert ac.count == 2
+        ac.release()
+        ac.release()
+        assert ac.count == 0
+        # Disabled
+        ac = AdmissionControl(0)
+        for i in range(10):
+            assert await ac.acquire()
+
+    run(main())
+
+
+def test_rate_limit_api():
+    token = run(get_webtoken_unsafe("test_ratelimit"))
+    headers = {"authtoken": token}
+
+    ori_limiter = _apiserver.rate_limiter
+    ori_admission_control = _apiserver.admission_control
+    _apiserver.rate_limiter = RateLimiter(1.0, {"full": (0.01, 2), "poll": (1, 5)})
+    _apiserver.admission_control = AdmissionControl(1, timeout=0.1)
+    try:
+        with MockTestServer(our_api_handler) as p:
+            # Full syncs are limited
+            for i in range(2):
+                r = p.get("/api/v2/updates?since=0", headers=headers)
+                assert r.status == 200
+            r = p.get("/api/v2/updates?since=0", headers=headers)
+            assert r.status == 429
+            assert r.headers["retry-after"] == "100"
+            # But polls are not
+            r = p.get("/api/v2/updates?since=10", headers=headers)
+            assert r.status == 200
+
+            # Expensive requests are refused when busy
+            _apiserver.rate_limiter.reset()
+            assert run(_apiserver.admission_control.acquire())
+            r = p.get("/api/v2/updates?since=0", headers=headers)
+            assert r.status == 503
+            r = p.get("/api/v2/updates?since=10", headers=headers)
+            assert r.status == 200
+            _apiserver.admission_control.release()
+            r = p.get("/api/v2/updates?since=0", headers=headers)
+            assert r.status == 200
+    finally:
+        _apiserver.rate_limiter = ori_limiter
+        _apiserver.admission_control = ori_admission_control
+
+
+def test_request_kind():
+    class Request:
+        def __init__(self, method, querydict=None, headers=None):
+            self.method = method
+            self.querydict = querydict or {}
+            self.headers = headers or {}
+
+    get_request_kind = _apiserver.get_request_kind
+    assert get_request_kind(Request("GET", {"since": "0"}), "updates") == (
+        "full",
+        True,
+    )
+    assert get_request_kind(Request("GET", {"since": "10"}), "updates") == (
+        "poll",
+        False,
+    )
+    assert get_request_kind(Request("GET", {"since": "x"}), "updates") == (
+        "poll",
+        False,
+    )
+    assert get_request_kind(Request("GET"), "records") == ("read", False)
+    r = Request("PUT", headers={"content-length": "100"})
+    assert get_request_kind(r, "records") == ("write", False)
+    r = Request("PUT", headers={"content-length": str(2**20)})
+    assert get_request_kind(r, "records") == ("write", True)
+    headers = {"content-length": str(2**17), "content-encoding": "gzip"}
+    assert get_request_kind(Request("PUT", headers=headers), "records") == (
+        "write",
+        True,
+    )
+    assert get_request_kind(Request("PUT"), "settings") == ("write", True)
+    assert get_request_kind(Request("GET"), "webtoken") == ("token", False)
+    assert get_request_kind(Request("GET"), "foo") == ("other", False)
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,319 @@
+"""
+Conformance tests that run against all storage backends.
+"""
+
+import os
+import time
+import asyncio
+import tempfile
+
+from _common import run_tests
+from timetagger.server import (
+    UserStorage,
+    SqliteStorage,
+    SharedSqliteStorage,
+    CachedStorage,
+    DbThreadPool,
+    get_storage,
+    set_storage,
+    user2filename,
+)
+
+
+def get_backends():
+    dirname = tempfile.mkdtemp()
+    return [
+        SqliteStorage(),
+        SharedSqliteStorage(os.path.join(dirname, "timetagger.db")),
+        CachedStorage(SqliteStorage(), 2**20),
+        CachedStorage(SharedSqliteStorage(os.path.join(dirname, "cached.db")), 2**20),
+    ]
+
+
+def clear_user(username):
+    filename = user2filename(username)
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+
+def run(co):
+    return asyncio.get_event_loop().run_until_complete(co)
+
+
+def record(key, t1, t2, st, mt=100):
+    return dict(key=key, mt=mt, t1=t1, t2=t2, ds="", st=st)
+
+
+async def check_items(backend):
+    clear_user("storage_test1")
+    clear_user("storage_test2")
+    db1 = await backend.open_user("storage_test1")
+    db2 = await backend.open_user("storage_test2")
+    assert isinstance(db1, UserStorage)
+
+    # Empty
+    assert await db1.get_items("records") == []
+    assert await db1.get_items("settings", 0) == []
+    assert await db1.get_items_by_key("records", ["a", "b"]) == {}
+
+    # Put some records for two users, in a transaction
+    async with db1:
+        await db1.put_items("records", [record("a", 10, 20, 1), record("b", 30, 40, 2)])
+        await db1.put_items("records", [record("c", 50, 50, 3)])
+    async with db2:
+        await db2.put_items("records", [record("a", 10, 20, 5)])
+    async with db1:
+        await db1.put_items("settings", [dict(key="a", mt=1, value=[1, 2], st=4)])
+
+    # Get all or since
+    keys = sorted(r["key"] for r in await db1.get_items("records"))
+    assert keys == ["a", "b", "c"]
+    keys = sorted(r["key"] for r in await db1.get_items("records", 2))
+    assert keys == ["b", "c"]
+    assert await db1.get_items("records", 10) == []
+    assert await db2.get_items("records") == [record("a", 10, 20, 5)]
+    assert await db1.get_items("settings") == [dict(key="a", mt=1, value=[1, 2], st=4)]
+    assert await db2.get_items("settings") == []
+
+    # Range query includes overlapping records, and running records before t2
+    keys = sorted(r["key"] for r in await db1.get_records_in_range(15, 35))
+    assert keys == ["a", "b"]
+    keys = sorted(r["key"] for r in await db1.get_records_in_range(41, 100))
+    assert keys == ["c"]
+    keys = sorted(r["key"] for r in await db1.get_records_in_range(0, 5))
+    assert keys == []
+
+    # Get by key
+    items = await db1.get_items_by_key("records", ["a", "c", "x"])
+    assert sorted(items.keys()) == ["a", "c"]
+    assert items["a"] == record("a", 10, 20, 1)
+    keys = [f"k{i}" for i in range(1200)]
+    async with db2:
+        await db2.put_items("records", [record(k, 1, 2, 6) for k in keys])
+    items = await db2.get_items_by_key("records", keys + ["a"])
+    assert len(items) == 1201
+
+    # Replace
+    async with db1:
+        await db1.put_items("records", [record("a", 10, 25, 7, 200)])
+    items = await db1.get_items_by_key("records", ["a"])
+    assert items["a"] == record("a", 10, 25, 7, 200)
+    assert len(await db1.get_items("records")) == 3
+    assert len(await db2.get_items("records")) == 1201
+
+    # Writes need a transaction
+    for func, args in [
+        (db1.put_items, ("records", [record("d", 1, 2, 8)])),
+        (db1.set_reset_time, (8,)),
+        (db1.set_token_seed, ("webtoken", "x")),
+    ]:
+        try:
+            await func(*args)
+        except IOError:
+            pass
+        else:
+            assert False, "Expected IOError"
+
+    # A failed transaction is rolled back
+    try:
+        async with db1:
+            await db1.put_items("records", [record("d", 1, 2, 8)])
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert await db1.get_items_by_key("records", ["d"]) == {}
+
+    # Invalid kind of items
+    try:
+        await db1.get_items("userinfo")
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected ValueError"
+
+
+async def check_userinfo(backend):
+    clear_user("storage_test1")
+    clear_user("storage_test2")
+    db1 = await backend.open_user("storage_test1")
+    db2 = await backend.open_user("storage_test2")
+
+    assert await db1.get_reset_time() == -1
+    assert await db1.get_token_seed("webtoken") == ""
+
+    async with db1:
+        await db1.set_reset_time(123.5)
+        await db1.set_token_seed("webtoken", "seed1")
+        await db1.set_token_seed("apitoken", "seed2")
+
+    assert await db1.get_reset_time() == 123.5
+    assert await db1.get_token_seed("webtoken") == "seed1"
+    assert await db1.get_token_seed("apitoken") == "seed2"
+    assert await db2.get_reset_time() == -1
+    assert await db2.get_token_seed("webtoken") == ""
+
+    # Userinfo is not part of the items
+    assert await db1.get_items("settings") == []
+
+    # The data persists
+    db1 = await backend.open_user("storage_test1")
+    assert await db1.get_token_seed("webtoken") == "seed1"
+
+
+async def check_mtime(backend):
+    clear_user("storage_test1")
+    db = await backend.open_user("storage_test1")
+    async with db:
+        await db.put_items("records", [record("a", 10, 20, 1)])
+    t = time.time()
+    db = await backend.open_user("storage_test1")
+    assert db.mtime <= t + 0.2
+    time.sleep(0.05)
+    async with db:
+        await db.put_items("records", [record("b", 10, 20, 2)])
+    db = await backend.open_user("storage_test1")
+    assert db.mtime > t - 1
+
+
+def test_storage_items():
+    for backend in get_backends():
+        run(check_items(backend))
+
+
+def test_storage_userinfo():
+    for backend in get_backends():
+        run(check_userinfo(backend))
+
+
+def test_storage_mtime():
+    for backend in get_backends():
+        run(check_mtime(backend))
+
+
+async def check_concurrent_writes():
+    clear_user("storage_test1")
+    clear_user("storage_test2")
+    backend = SqliteStorage(DbThreadPool(1))
+    await backend.open_user("storage_test2")
+
+    async def write(i):
+        db = await backend.open_user("storage_test1")
+        async with db:
+            await db.get_items_by_key("records", [f"a{i}"])
+            await asyncio.sleep(0.05)
+            await db.put_items("records", [record(f"a{i}", 10, 20, i)])
+            await db.get_reset_time()
+
+    async def poll():
+        await asyncio.sleep(0.02)
+        db = await backend.open_user("storage_test2")
+        await db.get_items("records", 0)
+        return time.perf_counter()
+
+    # Transactions of the same user wait for each other, without
+    # blocking the shared worker thread
+    t0 = time.perf_counter()
+    results = await asyncio.gather(write(1), write(2), write(3), poll())
+    assert results[3] - t0 < 1
+    assert time.perf_counter() - t0 < 2
+    db = await backend.open_user("storage_test1")
+    assert len(await db.get_items("records")) == 3
+
+
+def test_storage_concurrent_writes():
+    run(check_concurrent_writes())
+
+
+async def check_cache():
+    clear_user("storage_test1")
+    clear_user("storage_test2")
+    backend = CachedStorage(SqliteStorage(), 10**6)
+    db1 = await backend.open_user("storage_test1")
+    db2 = await backend.open_user("storage_test2")
+
+    # Writes for users that are not cached don't load the cache
+    async with db1:
+        await db1.put_items("records", [record("a", 10, 20, 1)])
+    assert backend.nbytes == 0
+    assert await db1.get_token_seed("webtoken") == ""
+    assert backend.nbytes == 0
+
+    # Reading records loads the cache
+    assert len(await db1.get_items("records")) == 1
+    size1 = backend.nbytes
+    assert size1 > 0
+
+    # Writes via another UserStorage object update the cache
+    db1b = await backend.open_user("storage_test1")
+    async with db1b:
+        await db1b.put_items("records", [record("b", 30, 40, 2), record("c", 5, 5, 3)])
+        await db1b.set_reset_time(2.5)
+        await db1b.set_token_seed("webtoken", "seed1")
+    assert backend.nbytes > size1
+    keys = sorted(r["key"] for r in await db1.get_items("records", 2))
+    assert keys == ["b", "c"]
+    assert await db1.get_reset_time() == 2.5
+    assert await db1.get_token_seed("webtoken") == "seed1"
+
+    # Running records are included in range queries if they start before t2
+    keys = sorted(r["key"] for r in await db1.get_records_in_range(15, 35))
+    assert keys == ["a", "b", "c"]
+    keys = sorted(r["key"] for r in await db1.get_records_in_range(0, 4))
+    assert keys == []
+
+    # Replaced items are not returned twice, and the returned items are copies
+    async with db1:
+        await db1.put_items("records", [record("a", 10, 20, 4, 200)])
+    items = await db1.get_items("records", 0)
+    assert sorted(r["key"] for r in items) == ["a", "b", "c"]
+    items[0]["mt"] = 999
+    items = await db1.get_items_by_key("records", ["a"])
+    assert items["a"]["mt"] == 200
+
+    # A rolled back transaction does not change the cache
+    try:
+        async with db1:
+            await db1.put_items("records", [record("d", 1, 2, 5)])
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert await db1.get_items_by_key("records", ["d"]) == {}
+
+    # Least recently used users are evicted when over budget
+    async with db2:
+        await db2.put_items("records", [record(f"k{i}", 1, 2, 6) for i in range(100)])
+    assert len(await db2.get_items("records")) == 100
+    assert backend.nbytes > size1 * 10
+    backend._max_bytes = backend.nbytes - 1
+    backend._evict()
+    assert backend._get_cache("storage_test1") is None
+    assert backend._get_cache("storage_test2") is not None
+    # Users that are not cached are served by the wrapped backend
+    assert len(await db1.get_items("records")) == 3
+    assert backend._get_cache("storage_test1") is not None
+    assert backend._get_cache("storage_test2") is None
+
+
+def test_storage_cache():
+    run(check_cache())
+
+
+def test_storage_selection():
+    ori_storage = get_storage()
+    assert isinstance(ori_storage, SqliteStorage)
+    try:
+        backend = get_backends()[1]
+        set_storage(backend)
+        assert get_storage() is backend
+        try:
+            set_storage("sqlite")
+        except TypeError:
+            pass
+        else:
+            assert False, "Expected TypeError"
+    finally:
+        set_storage(ori_storage)
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -39,6 +39,9 @@ from timetagger.server import (
     get_webtoken_unsafe,
     create_assets_from_dir,
     enable_service_worker,
+    metrics,
+    metrics_handler,
+    instrument_asgi,
 )
 
 
@@ -73,6 +76,7 @@ app_asset_handler = asgineer.utils.make_asset_handler(app_assets, max_age=0)
 web_asset_handler = asgineer.utils.make_asset_handler(web_assets, max_age=0)
 
 
+@instrument_asgi
 @asgineer.to_asgi
 async def main_handler(request):
     """
@@ -88,15 +92,25 @@ async def main_handler(request):
     elif request.path.startswith("/timetagger/"):
         if request.path == "/timetagger/status":
             return 200, {}, "ok"
+        elif request.path == "/timetagger/metrics":
+            return await metrics_handler(request)
         elif request.path.startswith("/timetagger/api/v2/"):
             path = request.path[19:].strip("/")
             return await api_handler(request, path)
         elif request.path.startswith("/timetagger/app/"):
             path = request.path[16:].strip("/")
-            return await app_asset_handler(request, path)
+            response = await app_asset_handler(request, path)
+            metrics.inc(
+                "timetagger_asset_requests_total", group="app", status=response[0]
+            )
+            return response
         else:
             path = request.path[12:].strip("/")
-            return await web_asset_handler(request, path)
+            response = await web_asset_handler(request, path)
+            metrics.inc(
+                "timetagger_asset_requests_total", group="web", status=response[0]
+            )
+            return response
 
     else:
         return 404, {}, "only serving at /timetagger/"
@@ -16,6 +16,22 @@ class Config:
     * `bind (str)`: the address and port to bind on. Default "127.0.0.1:8080".
     * `datadir (str)`: the directory to store data. Default "~/_timetagger".
       The user db's are stored in `datadir/users`.
+    * `storage (str)`: the storage backend for the user data: "sqlite" to
+      store the data of each user in a separate SQLite file (in `datadir/users`),
+      or "sqlite_shared" to store all data in one SQLite database
+      (`datadir/timetagger.db`). Default "sqlite".
+    * `cache_size (int)`: the memory budget in MiB for keeping the records
+      and settings of active users in memory. Polling and range queries for
+      cached users need no disk I/O. Default 0 (disabled).
+    * `db_shards (int)`: the number of shards for the database threads.
+      Users are assigned to a shard, and each shard has one thread for cheap
+      calls and one for bulk calls. Used by the "sqlite" storage. Default 4.
+    * `rate_limit (float)`: a factor for the per-user rate limits of the API.
+      Requests over the limit get a 429 response. Use 0 to disable. Default 1.
+    * `max_expensive_requests (int)`: the max number of expensive API requests
+      (full syncs and large PUTs) that run at the same time. Other such
+      requests wait, or get a 503 response after 10 seconds. Use 0 to
+      disable. Default 8.
     * `log_level (str)`: the log level for timetagger and asgineer
       (not the asgi server). Default "info".
     * `credentials (str)`: login credentials for one or more users, in the
@@ -28,6 +44,9 @@ class Config:
       form "127.0.0.1,10.0.0.1,10.99.0.0/24,192.168/16". Default "127.0.0.1".
     * `proxy_auth_header (str)`: name of the proxy header which contains the
       username of the logged in user. Default "X-Remote-User".
+    * `metrics_enabled (bool)`: enables instrumentation of the server, and
+      serves the metrics in the Prometheus text format at
+      `/timetagger/metrics`. Default "False".
 
     The values can be configured using CLI arguments and environment variables.
     For CLI arguments, the following formats are supported:
@@ -45,11 +64,17 @@ class Config:
     _ITEMS = [
         ("bind", str, "127.0.0.1:8080"),
         ("datadir", str, "~/_timetagger"),
+        ("storage", str, "sqlite"),
+        ("cache_size", int, 0),
+        ("db_shards", int, 4),
+        ("rate_limit", float, 1.0),
+        ("max_expensive_requests", int, 8),
         ("log_level", str, "info"),
         ("credentials", str, ""),
         ("proxy_auth_enabled", to_bool, False),
         ("proxy_auth_trusted", str, "127.0.0.1"),
         ("proxy_auth_header", str, "X-Remote-User"),
+        ("metrics_enabled", to_bool, False),
     ]
     __slots__ = [name for name, _, _ in _ITEMS]
 
@@ -8,8 +8,6 @@ from pscript.stubs import (
     document,
     console,
     Math,
-    isFinite,
-    Date,
     Audio,
     Notification,
     isNaN,
@@ -21,6 +19,7 @@ if this_is_js():
     dt = window.dt
     utils = window.utils
     stores = window.stores
+    importer = window.importer
 
 # A stack of dialogs
 stack = []
@@ -149,75 +148,6 @@ def _browser_history_init():
 _browser_history_init()
 
 
-def csvsplit(s, sep, i=0):
-    """Split a string on the given sep, but take escaping with double-quotes
-    into account. Double-quotes themselves can be escaped by duplicating them.
-    The resuturned parts are whitespace-trimmed.
-    """
-    # https://www.iana.org/assignments/media-types/text/tab-separated-values
-    # The only case we fail on afaik is tab-seperated values with a value
-    # that starts with a quote. Spreadsheets seem not to escape these values.
-    # This would make sense if they'd simply never quote TSV as seems to be the
-    # "standard", but they *do* use quotes when the value has tabs or newlines :'(
-    # In our own exports, we don't allow tabs or newlines, nor quotes at the start,
-    # so we should be fine with our own data.
-    global RawJS
-    parts = []
-    RawJS(
-        """
-    var mode = 0; // 0: between fields, 1: unescaped, 2: escaped
-    var sepcode = sep.charCodeAt(0);
-    var lastsplit = i;
-    i -= 1;
-    while (i < s.length - 1) {
-        i += 1;
-        var cc = s.charCodeAt(i);
-        if (mode == 0) {
-            if (cc == 34) { // quote
-                mode = 2;
-            } else if (cc == sepcode) { // empty value
-                parts.push("");
-                lastsplit = i + 1;
-            } else if (cc == 9 || cc == 32 || cc == 13) {
-                // ignore whitespace
-            } else if (cc == 10) {
-                break;  // next line
-            } else {
-                mode = 1; // unescaped value
-            }
-        } else if (mode == 1) {
-            if (cc == sepcode) {
-                parts.push(s.slice(lastsplit, i).trim());
-                lastsplit = i + 1;
-                mode = 0;
-            } else if (cc == 10) {
-                mode = 0;
-                break;  // next line
-            }
-        } else { // if (mode == 2)
-            if (cc == 34) { // end of escape, unless next char is also a quote
-                if (i < s.length - 1 && s.charCodeAt(i + 1) == 34) {
-                    i += 1; // Skip over second quote
-                } else {
-                    mode = 1;
-                }
-            }
-        }
-    }
-    i += 1;
-    parts.push(s.slice(lastsplit, i).trim());
-    // Remove escape-quotes
-    for (var j=0; j<parts.length; j++) {
-        var val = parts[j];
-        if (val.length > 0 && val[0] == '"' && val[val.length-1] == '"') {
-            parts[j] = val.slice(1, val.length-1).replace('""', '"');
-        }
-    }
-    """
-    )
-    return parts, i
-
-
 class BaseDialog:
     """A dialog is widget that is shown as an overlay over the main application.
     Interaction with the application is disabled.
@@ -773,11 +703,10 @@ class StartStopEdit:
         t2 = dt.now()
         secs_earlier = 8 * 3600  # 8 hours
         running = window.store.records.get_running_records()
-        records = window.store.records.get_records(t2 - secs_earlier, t2).values()
+        records = window.store.records.get_records_sorted(t2 - secs_earlier, t2, "t2")
         if running:
             t1 = t2 - 300  # 5 min earlier
         elif len(records) > 0:
-            records.sort(key=lambda r: r.t2)
             t1 = records[-1].t2  # start time == last records stop time
             t1 = min(t1, t2 - 1)
         else:
@@ -1090,9 +1019,6 @@ class StartStopEdit:
             return self.render()
 
 
-completer_all_tags = None
-
-
 class Autocompleter:
     """Helper class to autocomplete tags."""
 
@@ -1458,18 +1384,11 @@ class Autocompleter:
         presets = (None if item is None else item.value) or []
         return [preset for preset in presets if preset]
 
-    def _get_suggested_tags_all_dict(self, force=False):
+    def _get_suggested_tags_all_dict(self):
         """Get *all* tags ever used."""
-        PSCRIPT_OVERLOAD = False  # noqa
-        global completer_all_tags
-        if force or completer_all_tags is None:
-            suggested_tags = {}
-            for r in window.store.records.get_dump():
-                tags, _ = utils.get_tags_and_parts_from_string(r.ds)
-                for tag in tags:
-                    suggested_tags[tag] = max(r.t2, suggested_tags[tag] | 0)
-            completer_all_tags = suggested_tags
-        return completer_all_tags
+        tags_dict = window.store.records.get_tags_last_used()
+        tags_dict.pop("#untagged", None)
+        return tags_dict
 
     def _get_suggested_recents(self):
         """Get recent tags and order by their usage/recent-ness."""
@@ -1508,7 +1427,7 @@ class Autocompleter:
         tags_dict = {}
         new_tags = []
         if self._mode_mask & 1:
-            tags_dict = self._get_suggested_tags_all_dict(self._mode_mask == 1).copy()
+            tags_dict = self._get_suggested_tags_all_dict()
         if self._mode_mask & 2:
             new_tags = self._suggested_tags_recent
         # Combine
@@ -2280,6 +2199,8 @@ class TagPresetsDialog(BaseDialog):
 
     def do_apply(self):
         """Normalize tags"""
+        global JSON
+
         # Process
         self._analysis_out.innerHTML = "Processing ..."
         lines1 = self._input_element.value.lstrip().splitlines()
@@ -2412,14 +2333,9 @@ class TagRenameDialog(BaseDialog):
             self._records = []
             return
         # Get list of records
-        for record in window.store.records.get_dump():
-            tags = window.store.records.tags_from_record(record)  # also #untagged
-            all_ok = True
-            for tag in self._tags1:
-                if tag not in tags:
-                    all_ok = False
-            if all_ok:
-                records.push([record.t1, record.key])
+        for key in window.store.records.get_keys_for_tags(self._tags1):
+            record = window.store.records.get_by_key_readonly(key)
+            records.push([record.t1, record.key])
 
         records.sort(key=lambda x: x[0])
         self._records = [x[1] for x in records]
@@ -2447,6 +2363,7 @@ class TagRenameDialog(BaseDialog):
         search_tags = self._tags1
         replacement_tags = self._tags2
 
+        records = []
         for key in self._records:
             record = window.store.records.get_by_key(key)
             _, parts = utils.get_tags_and_parts_from_string(record.ds)
@@ -2462,9 +2379,11 @@ class TagRenameDialog(BaseDialog):
                         new_parts.push(" ".join(replacement_tags))
                 else:
                     new_parts.push(part)
-            # Submit
             record.ds = "".join(new_parts)
-            window.store.records.put(record)
+            records.push(record)
+
+        # Submit all at once
+        window.store.records.put_many(records)
 
         # Also update tag info
         if len(search_tags) == 1 and len(replacement_tags) == 1:
@@ -2639,18 +2558,32 @@ class SearchDialog(BaseDialog):
         pos_words = self._current_pos_words
         neg_words = self._current_neg_words
 
-        is_hidden = window.stores.is_hidden
-
         if (
             len(pos_tags) > 0
             or len(neg_tags) > 0
             or len(pos_words) > 0
             or len(neg_words) > 0
         ):
-            # Get list of records
-            for record in window.store.records.get_dump():
-                if is_hidden(record):
-                    continue
+            # Get list of records, sorted from new to old. If there are
+            # tags or words to include, we only need to check the records
+            # that the indices give for these.
+            keys = None
+            if len(pos_tags) > 0:
+                keys = window.store.records.get_keys_for_tags(pos_tags)
+            if len(pos_words) > 0:
+                word_keys = window.store.records.get_keys_for_words(pos_words)
+                if keys is None or len(word_keys) < len(keys):
+                    keys = word_keys
+            if keys is not None:
+                candidates = []
+                for key in keys:
+                    record = window.store.records.get_by_key_readonly(key)
+                    if not stores.is_hidden(record):
+                        candidates.push(record)
+                candidates.sort(key=lambda r: -r.t1)
+            else:
+                candidates = window.store.records.get_records_sorted(0, 2**53, "-t1")
+            for record in candidates:
                 # Check tags
                 tags = window.store.records.tags_from_record(record)  # also #untagged
                 all_tags_ok = True
@@ -2678,10 +2611,9 @@ class SearchDialog(BaseDialog):
                 if not all_strings_ok:
                     continue
                 # All checks passed
-                records.push([record.t1, record.key])
+                records.push(record.key)
 
-        records.sort(key=lambda x: -x[0])
-        self._records = [x[1] for x in records]
+        self._records = records
         self._show_records()
         self._check_names()
 
@@ -2753,9 +2685,144 @@ class SearchDialog(BaseDialog):
             self._canvas.tag_combo_dialog.open(tagz, self._show_records)
 
 
+class VirtualTable:
+    """Helper to show a table with many rows, of which only the (nearly)
+    visible rows are put in the DOM. The table must be inside the given
+    scrollable container. The rows are converted to HTML as they are shown.
+    Rows can have different heights; these are measured as rows are shown,
+    and estimated with the average height for the other rows.
+    """
+
+    def __init__(self, table, container, row2html):
+        self._table = table
+        self._container = container
+        self._row2html = row2html
+        self._header = ""
+        self._rows = []
+        self._heights = {}  # row index -> measured height
+        self._row_height = 0  # average measured height, 0 until first render
+        self._shown = None  # the range of rows that is in the DOM
+        self._pending = False
+        # We correct the scroll position ourselves when the spacers change
+        self._container.style.overflowAnchor = "none"
+        self._container.addEventListener("scroll", self._on_scroll)
+        # Also render when the container is shown again after being hidden
+        self._observer = None
+        if window.ResizeObserver:
+            self._observer = window.ResizeObserver(self._on_scroll)
+            self._observer.observe(self._container)
+        else:
+            window.addEventListener("resize", self._on_scroll)
+
+    def close(self):
+        self._container.removeEventListener("scroll", self._on_scroll)
+        if self._observer is not None:
+            self._observer.disconnect()
+        else:
+            window.removeEventListener("resize", self._on_scroll)
+        self._rows = []
+
+    def set_rows(self, rows, header=""):
+        """Set the rows to show, and optionally the HTML for a header row."""
+        self._rows = rows
+        self._header = header
+        self._heights = {}
+        self._shown = None
+        self._render()
+
+    def _on_scroll(self):
+        if not self._pending:
+            self._pending = True
+            window.requestAnimationFrame(self._render)
+
+    def _get_offsets(self):
+        # The y position of each row (and the end), using measured heights
+        # where we have them.
+        PSCRIPT_OVERLOAD = False  # noqa
+        heights = self._heights
+        row_height = self._row_height
+        offsets = [0]
+        y = 0
+        for i in range(len(self._rows)):
+            y += heights[i] or row_height  # measured heights are > 0
+            offsets.push(y)
+        return offsets
+
+    def _render(self):
+        self._pending = False
+        n = len(self._rows)
+
+        # Don't render while hidden (e.g. when another dialog covers this
+        # one), since we cannot know what rows are visible.
+        rect = self._container.getBoundingClientRect()
+        if rect.width == 0 and rect.height == 0:
+            return
+
+        # Get the range of rows to show, with a margin
+        if self._row_height == 0:
+            i1, i2 = 0, min(n, 100)  # Until we know the row height
+        else:
+            offsets = self._get_offsets()
+            y1 = rect.top - self._table.getBoundingClientRect().top
+            y2 = y1 + rect.height
+            i1 = 0
+            while i1 < n and offsets[i1 + 1] <= y1:
+                i1 += 1
+            i2 = i1
+            while i2 < n and offsets[i2] < y2:
+                i2 += 1
+            i1 = max(0, i1 - 50)
+            i1 -= i1 % 2  # Keep the stripes in place
+            i2 = min(n, i2 + 50)
+        if self._shown is not None and self._shown[0] == i1 and self._shown[1] == i2:
+            return
+        self._shown = [i1, i2]
+
+        # Produce the rows, with spacers for the rows that are not shown
+        offsets = self._get_offsets()
+        spacer = "<tr style='height:{}px; background:none;'><td colspan='8' style='padding:0;'></td></tr>"
+        lines = [self._header, spacer.format(offsets[i1])]
+        for i in range(i1, i2):
+            lines.push(self._row2html(self._rows[i]))
+        lines.push(spacer.format(offsets[n] - offsets[i2]))
+        self._table.innerHTML = lines.join("")
+        if i2 == i1:
+            return
+
+        # Measure the shown rows, and update the average row height
+        trs = self._table.rows
+        first = len(trs) - 1 - (i2 - i1)
+        for i in range(i1, i2):
+            height = trs[first + i - i1].getBoundingClientRect().height
+            if height > 0:
+                self._heights[i] = height
+        total, count = 0, 0
+        for height in self._heights.values():
+            total += height
+            count += 1
+        if count == 0:
+            return
+        self._row_height = total / count
+
+        # Correct the spacers for the measured heights. Keep the shown rows
+        # in place, and render again if other rows should now be shown.
+        offsets2 = self._get_offsets()
+        trs[first - 1].style.height = offsets2[i1] + "px"
+        trs[len(trs) - 1].style.height = (offsets2[n] - offsets2[i2]) + "px"
+        if offsets2[i1] != offsets[i1]:
+            self._container.scrollTop += offsets2[i1] - offsets[i1]
+        if offsets2[n] != offsets[n]:
+            self._on_scroll()
+
+
 class ReportDialog(BaseDialog):
     """A dialog that shows a report of records, and allows exporting."""
 
+    def __init__(self, canvas):
+        super().__init__(canvas)
+        self._vtable = None
+        self._rows = []
+
     def open(self, t1=None, t2=None, tags=None):
         """Show/open the dialog ."""
 
@@ -2765,6 +2832,8 @@ class ReportDialog(BaseDialog):
             tags = self._canvas.widgets.AnalyticsWidget.selected_tags
 
         self._tags = tags or []
+        self._stage_cache = {}  # stage -> [key, result]
+        self._update_count = 0
 
         # Transform time int to dates.
         t1_date = dt.time2localstr(dt.round(t1, "1D")).split(" ")[0]
@@ -2826,6 +2895,11 @@ class ReportDialog(BaseDialog):
         self._table_element = self.maindiv.children[-1]
         form = self.maindiv.children[1]
 
+        if self._vtable is not None:
+            self._vtable.close()
+        self._vtable = VirtualTable(self._table_element, self.maindiv, self._row2html)
+        window._open_record_dialog = self._open_record
+
         # filter text = form.children[1]
         self._date_range = form.children[3]
         self._grouping_select = form.children[5]
@@ -2875,6 +2949,13 @@ class ReportDialog(BaseDialog):
         window.setTimeout(self._update_table)
         super().open(None)
 
+    def close(self):
+        if self._vtable is not None:
+            self._vtable.close()
+            self._vtable = None
+        self._rows = []
+        super().close()
+
     def _user_chose_date(self):
         self.close()
         self._canvas.timeselection_dialog.open(self.open)
@@ -2889,14 +2970,18 @@ class ReportDialog(BaseDialog):
         window.simplesettings.set("report_showrecords", self._showrecords_but.checked)
         self._update_table()
 
-    def _update_table(self):
+    async def _update_table(self):
         t1_date = self._t1_date
         t2_date = self._t2_date
         if not float(t1_date.split("-")[0]) > 1899:
-            self._table_element.innerHTML = ""
+            self._rows = []
+            if self._vtable is not None:
+                self._vtable.set_rows([])
             return
         elif not float(t2_date.split("-")[0]) > 1899:
-            self._table_element.innerHTML = ""
+            self._rows = []
+            if self._vtable is not None:
+                self._vtable.set_rows([])
             return
 
         t1 = str_date_to_time_int(t1_date)
@@ -2904,8 +2989,14 @@ class ReportDialog(BaseDialog):
         t2 = dt.add(t2, "1D")  # look until the end of the day
 
         self._last_t1, self._last_t2 = t1, t2
-        html = self._generate_table_html(self._generate_table_rows(t1, t2))
-        self._table_element.innerHTML = html
+        self._update_count += 1
+        update_count = self._update_count
+        await window.store.records.prefetch(t1, t2)
+        if update_count != self._update_count:
+            return  # A newer update is in progress
+        rows = self._generate_table_rows(t1, t2)
+        if self._vtable is None:
+            return  # Closed in the meantime
 
         # Configure the table ...
         if self._showrecords_but.checked:
@@ -2916,42 +3007,64 @@ class ReportDialog(BaseDialog):
         # Also apply in the app itself!
         window.canvas.range.animate_range(t1, t2, None, False)  # without snap
 
-    def _generate_table_rows(self, t1, t2):
-        showrecords = self._showrecords_but.checked
+        # Only the visible rows are put in the DOM, so that large reports
+        # don't block the UI. Copying and saving use the rows directly.
+        self._rows = rows
+        self._vtable.set_rows(rows)
 
-        format = self._format_but.value
-        if format == "h0":
-            round_duration = lambda t: Math.round(t / 3600) * 3600
-            duration2str = lambda t: f"{t/3600:0.0f}"
-        elif format == "h1":
-            round_duration = lambda t: Math.round(t / 360) * 360
-            duration2str = lambda t: f"{t/3600:0.1f}"
-        elif format == "h2":
-            round_duration = lambda t: Math.round(t / 36) * 36
-            duration2str = lambda t: f"{t/3600:0.2f}"
-        elif format == "h3":
-            round_duration = lambda t: Math.round(t / 3.6) * 3.6
-            duration2str = lambda t: f"{t/3600:0.3f}"
-        elif format == "h4":
-            round_duration = lambda t: Math.round(t / 0.36) * 0.36
-            duration2str = lambda t: f"{t/3600:0.4f}"
-        elif format == "hms":
-            round_duration = lambda t: Math.round(t)
-            duration2str = lambda t: dt.duration_string_colon(t, True)
-        else:  # fallback == "hm":
-            round_duration = lambda t: Math.round(t / 60) * 60
-            duration2str = lambda t: dt.duration_string_colon(t, False)
+    def _get_stage(self, stage, key, func):
+        """Get the result of a stage of the report generation. The result
+        is cached, and only recalculated when the given key changes.
+        """
+        entry = self._stage_cache.get(stage, None)
+        if entry is None or entry[0] != key:
+            entry = [key, func()]
+            self._stage_cache[stage] = entry
+        return entry[1]
+
+    def _generate_table_rows(self, t1, t2):
+        # The rows are generated in stages. Each stage is cached, and is
+        # only recalculated when its input or the settings it uses change.
+        # E.g. changing the duration format only regenerates the rows.
+        key = f"{t1} {t2} {window.store.records._version}"
+        # The duration of running records increases, so include the time
+        now = dt.now()
+        for record in window.store.records.get_running_records_readonly():
+            if record.t1 <= t2 and now >= t1:
+                key += " " + str(Math.floor(now))
+                break
+        stats, items = self._get_stage(
+            "records", key, lambda: self._stage_records(t1, t2)
+        )
+        # The names depend on the tag priorities, which are in the settings
+        key += " " + str(self._hidesecondary_but.checked)
+        key += " " + str(window.store.settings._version)
+        name_map, statobjects = self._get_stage(
+            "names", key, lambda: self._stage_names(stats)
+        )
+        key += " " + self._grouping_select.value + " " + self._groupperiod_select.value
+        groups = self._get_stage(
+            "groups", key, lambda: self._stage_groups(items, name_map, statobjects)
+        )
+        return self._stage_rows(groups)
 
+    def _stage_records(self, t1, t2):
+        """Get the stats and the records, with their duration and tags."""
         # Get stats and sorted records, this already excludes hidden records
-        stats = window.store.records.get_stats(t1, t2).copy()
-        records = window.store.records.get_records(t1, t2).values()
-        records.sort(key=lambda record: record.t1)
+        stats = window.store.records.get_stats(t1, t2)
+        records = window.store.records.get_records_sorted(t1, t2, "t1")
 
-        # Set (appropriately rounded) durations
+        # The records are not copied, so we store the extra info alongside
+        items = []
         for i in range(len(records)):
             record = records[i]
-            record.duration = round_duration(min(t2, record.t2) - max(t1, record.t1))
+            duration = min(t2, record.t2) - max(t1, record.t1)
+            tagz = window.store.records.tags_from_record(record).join(" ")
+            items.push([record, duration, tagz])
+        return stats, items
 
+    def _stage_names(self, stats):
+        """Get the mapping of tag combis to display names, and the ordered stats."""
         # Determine priorities
         priorities = {}
         for tagz in stats.keys():
@@ -2983,6 +3096,10 @@ class ReportDialog(BaseDialog):
         statobjects = statobjects.values()
         utils.order_stats_by_duration_and_name(statobjects)
 
+        return name_map, statobjects
+
+    def _stage_groups(self, items, name_map, statobjects):
+        """Group the records. Each group has a title and a list of items."""
         # Get how to group the records
         group_method = self._grouping_select.value
         group_period = self._groupperiod_select.value
@@ -2992,111 +3109,130 @@ class ReportDialog(BaseDialog):
         if group_method == "tagz":
             groups = {}
             for obj in statobjects:
-                groups[obj.tagz] = {
-                    "title": obj.tagz or empty_title,
-                    "duration": 0,
-                    "records": [],
-                }
-            for i in range(len(records)):
-                record = records[i]
-                tagz1 = window.store.records.tags_from_record(record).join(" ")
+                groups[obj.tagz] = {"title": obj.tagz or empty_title, "items": []}
+            for i in range(len(items)):
+                item = items[i]
+                tagz1 = item[2]
                 if tagz1 not in name_map:
                     continue
-                tagz2 = name_map[tagz1]
-                group = groups[tagz2]
-                group.records.push(record)
-                group.duration += record.duration
+                groups[name_map[tagz1]]["items"].push(item)
             group_list1 = groups.values()
 
         elif group_method == "ds":
             groups = {}
-            for i in range(len(records)):
-                record = records[i]
-                tagz1 = window.store.records.tags_from_record(record).join(" ")
-                if tagz1 not in name_map:
+            for i in range(len(items)):
+                item = items[i]
+                if item[2] not in name_map:
                     continue
-                ds = record.ds
+                ds = item[0].ds
                 if ds not in groups:
-                    groups[ds] = {"title": ds, "duration": 0, "records": []}
-                group = groups[ds]
-                group.records.push(record)
-                group.duration += record.duration
+                    groups[ds] = {"title": ds, "items": []}
+                groups[ds]["items"].push(item)
             group_list1 = groups.values()
             group_list1.sort(key=lambda x: x.title.lower())
 
         else:
-            group = {"title": "hidden", "duration": 0, "records": []}
+            group = {"title": "hidden", "items": []}
             group_list1 = [group]
-            for i in range(len(records)):
-                record = records[i]
-                tagz1 = window.store.records.tags_from_record(record).join(" ")
-                if tagz1 not in name_map:
+            for i in range(len(items)):
+                item = items[i]
+                if item[2] not in name_map:
                     continue
-                group.records.push(record)
+                group["items"].push(item)
 
         # Perform grouping for time ...
         if group_period == "none":
-            group_list2 = group_list1
-        else:
-            groups = {}
-            for group_index in range(len(group_list1)):
-                group_title = group_list1[group_index].title
-                for record in group_list1[group_index].records:
-                    # Get period string
-                    date = dt.time2localstr(record.t1).split(" ")[0]
-                    year = int(date.split("-")[0])
-                    if group_period == "day":
-                        period = dt.format_isodate(date)
-                    elif group_period == "week":
-                        week = dt.get_weeknumber(record.t1)
-                        period = f"{year}W{week}"
-                    elif group_period == "month":
-                        month = int(date.split("-")[1])
-                        period = dt.MONTHS_SHORT[month - 1] + f" {year}"
-                    elif group_period == "quarter":
-                        month = int(date.split("-")[1])
-                        q = "111222333444"[month - 1]
-                        period = f"{year}Q{q}"
-                    elif group_period == "year":
-                        period = f"{year}"
-                    else:
-                        period = date  # fallback
-                    # New title
-                    # Note: can turn around title and sortkey to make the period the secondary group
-                    if group_title == "hidden":
-                        title = period
-                        sortkey = date
-                    else:
-                        title = period + " / " + group_title
-                        sortkey = date + str(1000000 + group_index)
-                    if title not in groups:
-                        groups[title] = {
-                            "title": title,
-                            "duration": 0,
-                            "records": [],
-                            "sortkey": sortkey,
-                        }
-                    # Append
-                    group = groups[title]
-                    group.records.push(record)
-                    group.duration += record.duration
-
-            # Get new groups, sorted by period
-            group_list2 = groups.values()
-            group_list2.sort(key=lambda x: x.sortkey)
+            return group_list1
+
+        groups = {}
+        for group_index in range(len(group_list1)):
+            group_title = group_list1[group_index].title
+            for item in group_list1[group_index]["items"]:
+                record = item[0]
+                # Get period string
+                date = dt.time2localstr(record.t1).split(" ")[0]
+                year = int(date.split("-")[0])
+                if group_period == "day":
+                    period = dt.format_isodate(date)
+                elif group_period == "week":
+                    week = dt.get_weeknumber(record.t1)
+                    period = f"{year}W{week}"
+                elif group_period == "month":
+                    month = int(date.split("-")[1])
+                    period = dt.MONTHS_SHORT[month - 1] + f" {year}"
+                elif group_period == "quarter":
+                    month = int(date.split("-")[1])
+                    q = "111222333444"[month - 1]
+                    period = f"{year}Q{q}"
+                elif group_period == "year":
+                    period = f"{year}"
+                else:
+                    period = date  # fallback
+                # New title
+                # Note: can turn around title and sortkey to make the period the secondary group
+                if group_title == "hidden":
+                    title = period
+                    sortkey = date
+                else:
+                    title = period + " / " + group_title
+                    sortkey = date + str(1000000 + group_index)
+                if title not in groups:
+                    groups[title] = {"title": title, "items": [], "sortkey": sortkey}
+                # Append
+                groups[title]["items"].push(item)
+
+        # Get new groups, sorted by period
+        group_list2 = groups.values()
+        group_list2.sort(key=lambda x: x.sortkey)
+        return group_list2
+
+    def _stage_rows(self, groups):
+        """Generate the rows, using the current format."""
+        showrecords = self._showrecords_but.checked
+
+        format = self._format_but.value
+        if format == "h0":
+            round_duration = lambda t: Math.round(t / 3600) * 3600
+            duration2str = lambda t: f"{t/3600:0.0f}"
+        elif format == "h1":
+            round_duration = lambda t: Math.round(t / 360) * 360
+            duration2str = lambda t: f"{t/3600:0.1f}"
+        elif format == "h2":
+            round_duration = lambda t: Math.round(t / 36) * 36
+            duration2str = lambda t: f"{t/3600:0.2f}"
+        elif format == "h3":
+            round_duration = lambda t: Math.round(t / 3.6) * 3.6
+            duration2str = lambda t: f"{t/3600:0.3f}"
+        elif format == "h4":
+            round_duration = lambda t: Math.round(t / 0.36) * 0.36
+            duration2str = lambda t: f"{t/3600:0.4f}"
+        elif format == "hms":
+            round_duration = lambda t: Math.round(t)
+            duration2str = lambda t: dt.duration_string_colon(t, True)
+        else:  # fallback == "hm":
+            round_duration = lambda t: Math.round(t / 60) * 60
+            duration2str = lambda t: dt.duration_string_colon(t, False)
+
+        # Get (appropriately rounded) durations, per group the sum of its records
+        group_durations = []
+        total_duration = 0
+        for group in groups:
+            group_duration = 0
+            for item in group["items"]:
+                group_duration += round_duration(item[1])
+            group_durations.push(group_duration)
+            total_duration += group_duration
 
         # Generate rows
         rows = []
 
         # Include total
-        total_duration = 0
-        for group in group_list2:
-            total_duration += group.duration
         rows.append(["head", duration2str(total_duration), "Total", 0])
 
-        for group in group_list2:
+        for group_index in range(len(groups)):
+            group = groups[group_index]
             # Add row for total of this tag combi
-            duration = duration2str(group.duration)
+            duration = duration2str(group_durations[group_index])
             pad = 1
             if showrecords:
                 rows.append(["blank"])
@@ -3105,16 +3241,16 @@ class ReportDialog(BaseDialog):
 
             # Add row for each record
             if showrecords:
-                records = group.records
-                for i in range(len(records)):
-                    record = records[i]
+                items = group["items"]
+                for i in range(len(items)):
+                    record, record_duration, tagz = items[i]
                     sd1, st1 = dt.time2localstr(record.t1).split(" ")
                     sd2, st2 = dt.time2localstr(record.t2).split(" ")
                     if True:  # st1.endsWith(":00"):
                         st1 = st1[:-3]
                     if True:  # st2.endsWith(":00"):
                         st2 = st2[:-3]
-                    duration = duration2str(record.duration)
+                    duration = duration2str(round_duration(record_duration))
                     rows.append(
                         [
                             "record",
@@ -3124,40 +3260,48 @@ class ReportDialog(BaseDialog):
                             st1,
                             st2,
                             to_str(record.get("ds", "")),  # strip tabs and newlines
-                            window.store.records.tags_from_record(record).join(" "),
+                            tagz,
                         ]
                     )
 
         return rows
 
-    def _generate_table_html(self, rows):
-        window._open_record_dialog = self._open_record
-        blank_row = "<tr class='blank_row'><td></td><td></td><td></td><td></td><td></td><td></td><td></td></tr>"
-        lines = []
-        for row in rows:
-            if row[0] == "blank":
-                lines.append(blank_row)
-            elif row[0] == "head":
-                lines.append(
-                    f"<tr><th>{row[1]}</th><th class='pad{row[3]}'>{row[2]}</th><th></th>"
-                    + "<th></th><th></th><th></th><th></th></tr>"
-                )
-            elif row[0] == "record":
-                _, key, duration, sd1, st1, st2, ds, tagz = row
-                lines.append(
-                    f"<tr><td></td><td></td><td>{duration}</td>"
-                    + f"<td>{sd1}</td><td class='t1'>{st1}</td><td class='t2'>{st2}</td>"
-                    + f"<td><a onclick='window._open_record_dialog(\"{key}\")' style='cursor:pointer;'>"
-                    + f"{ds or '&nbsp;-&nbsp;'}</a></td></tr>"
-                )
-        return lines.join("")
+    def _row2html(self, row):
+        if row[0] == "blank":
+            return "<tr class='blank_row'><td></td><td></td><td></td><td></td><td></td><td></td><td></td></tr>"
+        elif row[0] == "head":
+            return (
+                f"<tr><th>{row[1]}</th><th class='pad{row[3]}'>{row[2]}</th><th></th>"
+                + "<th></th><th></th><th></th><th></th></tr>"
+            )
+        elif row[0] == "record":
+            _, key, duration, sd1, st1, st2, ds, tagz = row
+            return (
+                f"<tr><td></td><td></td><td>{duration}</td>"
+                + f"<td>{sd1}</td><td class='t1'>{st1}</td><td class='t2'>{st2}</td>"
+                + f"<td><a onclick='window._open_record_dialog(\"{key}\")' style='cursor:pointer;'>"
+                + f"{ds or '&nbsp;-&nbsp;'}</a></td></tr>"
+            )
+        return ""
 
     def _open_record(self, key):
         record = window.store.records.get_by_key(key)
         self._canvas.record_dialog.open("Edit", record, self._update_table)
 
-    def _copy_clipboard(self):
-        tools.copy_dom_node(self._table_element)
+    async def _copy_clipboard(self):
+        # Copy as tab-separated values, which can be pasted in a spreadsheet.
+        # Only part of the table is in the DOM, so we use the rows instead.
+        lines = []
+        for row in self._rows:
+            if row[0] == "blank":
+                lines.append("")
+            elif row[0] == "head":
+                lines.append(row[1] + "\t" + row[2])
+            elif row[0] == "record":
+                _, key, duration, sd1, st1, st2, ds, tagz = row
+                lines.append(["", "", duration, sd1, st1, st2, ds].join("\t"))
+        if not await tools.copy_blob(tools.lines2blob(lines)):
+            return
         self._copy_but.innerHTML = (
             f"<i class='fas'>\uf46c</i>&nbsp;&nbsp;{self._copybuttext}"
         )
@@ -3176,7 +3320,7 @@ class ReportDialog(BaseDialog):
         else:
             return f"timetagger-{date1}-{date2}.{ext}"
 
-    def _save_as_csv(self):
+    async def _save_as_csv(self):
         # This is all pretty straightforward. The most tricky bit it
         # the ds (description). It can have any Unicode, so it should
         # surrounded by double quotes. Any double-quotes inside the ds
@@ -3184,7 +3328,9 @@ class ReportDialog(BaseDialog):
         # after comma's, or tools like Excel may not be able to parse
         # the quoted string correctly. Note that in _generate_table_rows
         # the ds is stipped from \t\r\n.
+        global RawJS
 
+        await window.store.records.prefetch(self._last_t1, self._last_t2)
         rows = self._generate_table_rows(self._last_t1, self._last_t2)
 
         lines = []
@@ -3213,23 +3359,10 @@ class ReportDialog(BaseDialog):
                     )
                 )
 
-        # Get blob wrapped in an object url
-        obj_url = window.URL.createObjectURL(
-            window.Blob(["\r\n".join(lines)], {"type": "text/csv"})
-        )
-        # Create a element to attach the download to
-        a = document.createElement("a")
-        a.style.display = "none"
-        a.setAttribute("download", self._get_export_filename("csv"))
-        a.href = obj_url
-        document.body.appendChild(a)
-        # Trigger the download by simulating click
-        a.click()
-        # Cleanup
-        window.URL.revokeObjectURL(a.href)
-        document.body.removeChild(a)
-
-    def _save_as_pdf(self):
+        blob = tools.lines2blob(lines, "text/csv", "\r\n")
+        tools.download_blob(blob, self._get_export_filename("csv"))
+
+    async def _save_as_pdf(self):
         # Configure
         width, height = 210, 297  # A4
         margin = 20  # mm
@@ -3241,6 +3374,7 @@ class ReportDialog(BaseDialog):
 
         # Get row data and divide in chunks. This is done so that we
         # can break pages earlier to avoid breaking chunks.
+        await window.store.records.prefetch(self._last_t1, self._last_t2)
         rows = self._generate_table_rows(self._last_t1, self._last_t2)
         chunks = [[]]
         for row in rows:
@@ -3385,6 +3519,8 @@ class ExportDialog(BaseDialog):
         super().__init__(canvas)
         self._dtformat = "local"
         self._working = 0
+        self._vtable = None
+        self._rows = []
 
     def open(self, callback=None):
         self.maindiv.innerHTML = f"""
@@ -3403,18 +3539,26 @@ class ExportDialog(BaseDialog):
                 &nbsp;<input type="radio" name="dtformat" value="iso"> ISO 8601</input>
             </div>
             <button type='button'>Copy</button>
+            <button type='button'>Save export-table <i class='fas'>\uf019</i></button>
             <hr />
             <table id='export_table'></table>
             """
 
         self._table_element = self.maindiv.children[-1]
         self._table_element.classList.add("darkheaders")
+        if self._vtable is not None:
+            self._vtable.close()
+        self._vtable = VirtualTable(self._table_element, self.maindiv, self._row2html)
 
-        self._copy_but = self.maindiv.children[-3]
+        self._copy_but = self.maindiv.children[-4]
         self._copy_but.onclick = self._copy_clipboard
         self._copy_but.disabled = True
 
-        radio_buttons = self.maindiv.children[-4].children
+        self._save_but = self.maindiv.children[-3]
+        self._save_but.onclick = self._save_as_tsv
+        self._save_but.disabled = True
+
+        radio_buttons = self.maindiv.children[-5].children
         for i in range(1, len(radio_buttons)):
             but = radio_buttons[i]
             but.onchange = self._on_dtformat
@@ -3425,6 +3569,14 @@ class ExportDialog(BaseDialog):
 
         self.fill_records()
 
+    def close(self, e=None):
+        self._working += 1  # Cancel filling
+        if self._vtable is not None:
+            self._vtable.close()
+            self._vtable = None
+        self._rows = []
+        super().close(e)
+
     def _on_dtformat(self, e):
         self._dtformat = e.target.value
         self.fill_records()
@@ -3436,12 +3588,9 @@ class ExportDialog(BaseDialog):
 
         # Prepare
         self._copy_but.disabled = True
+        self._save_but.disabled = True
         itemsdict = window.store.records._items
-        lines = []
-
-        # Add header
-        lineparts = ["key", "start", "stop", "tags", "description"]
-        lines.append("<tr><th>" + lineparts.join("</th><th>") + "</th></tr>")
+        rows = []
 
         # Parse all items
         # Take care that description does not have newlines or tabs, using to_str
@@ -3454,42 +3603,67 @@ class ExportDialog(BaseDialog):
                     t1, t2 = dt.time2localstr(t1), dt.time2localstr(t2)
                 elif self._dtformat == "iso":
                     t1, t2 = dt.time2str(t1, 0), dt.time2str(t2, 0)
-                lineparts = [
-                    item.key,
-                    t1,
-                    t2,
-                    utils.get_tags_and_parts_from_string(item.ds)[0].join(" "),
-                    to_str(item.get("ds", "")),
-                ]
-                lines.append("<tr><td>" + lineparts.join("</td><td>") + "</td></tr>")
+                rows.append(
+                    [
+                        item.key,
+                        t1,
+                        t2,
+                        utils.get_tags_and_parts_from_string(item.ds)[0].join(" "),
+                        to_str(item.get("ds", "")),
+                    ]
+                )
             # Give feedback while processing
-            if len(lines) % 256 == 0:
-                self._copy_but.innerHTML = "Found " + len(lines) + " records"
-                # self._table_element.innerHTML = lines.join("\n")
+            if len(rows) % 256 == 0:
+                self._copy_but.innerHTML = "Found " + len(rows) + " records"
                 await window.tools.sleepms(1)
             if working != self._working:
                 return
 
-        # Done
-        self._copy_but.innerHTML = "Copy export-table <i class='fas'>\uf0ea</i>"
-        self._table_element.innerHTML = lines.join("\n")
+        # Done. Only the visible rows are put in the DOM.
+        self._rows = rows
+        header = "<tr><th>" + self._get_header().join("</th><th>") + "</th></tr>"
+        self._vtable.set_rows(rows, header)
+        self._reset_copy_but_text()
         self._copy_but.disabled = False
+        self._save_but.disabled = False
+
+    def _get_header(self):
+        return ["key", "start", "stop", "tags", "description"]
+
+    def _row2html(self, row):
+        return "<tr><td>" + row.join("</td><td>") + "</td></tr>"
 
-    def _copy_clipboard(self):
-        table = self.maindiv.children[-1]
-        tools.copy_dom_node(table)
+    def _get_blob(self, type):
+        """Get the table as tab-separated values, produced from the rows."""
+        lines = [self._get_header().join("\t")]
+        for row in self._rows:
+            lines.push(row.join("\t"))
+        return tools.lines2blob(lines, type)
+
+    async def _copy_clipboard(self):
+        if not await tools.copy_blob(self._get_blob("text/plain")):
+            return
         self._copy_but.innerHTML = "Copy export-table <i class='fas'>\uf46c</i>"
         window.setTimeout(self._reset_copy_but_text, 800)
 
     def _reset_copy_but_text(self):
         self._copy_but.innerHTML = "Copy export-table <i class='fas'>\uf0ea</i>"
 
+    def _save_as_tsv(self):
+        blob = self._get_blob("text/tab-separated-values")
+        tools.download_blob(blob, "timetagger-export.tsv")
+
 
 class ImportDialog(BaseDialog):
     """Dialog to import data."""
 
+    _preview_size = 2**16  # number of bytes of a dropped file to show
+
     def __init__(self, canvas):
         super().__init__(canvas)
+        self._file = None
+        self._worker = None
+        self._analyzing = False
 
     def open(self, callback=None):
         self.maindiv.innerHTML = f"""
@@ -3517,6 +3691,8 @@ class ImportDialog(BaseDialog):
         self._input_element.ondragexit = self._on_drop_stop
         self._input_element.ondragover = self._on_drop_over
         self._input_element.ondrop = self._on_drop
+        self._input_element.oninput = self._on_input
+        self._file = None
 
         if not (
             window.store.__name__.startswith("Demo")
@@ -3551,9 +3727,6 @@ class ImportDialog(BaseDialog):
         ev.preventDefault()
         self._on_drop_stop()
 
-        def apply_text(s):
-            self._input_element.value = s
-
         if ev.dataTransfer.items:
             for i in range(len(ev.dataTransfer.items)):
                 if ev.dataTransfer.items[i].kind == "file":
@@ -3565,12 +3738,23 @@ class ImportDialog(BaseDialog):
                             + f"copy the columns in Excel and paste here."
                         )
                         continue
-                    reader = window.FileReader()
-                    reader.onload = lambda: apply_text(reader.result)
-                    reader.readAsText(file)
-                    self._analysis_out.innerHTML = f"Read from <u>{file.name}</u>"
+                    self._show_file(file)
                     break  # only process first one
 
+    async def _show_file(self, file):
+        # The file is read in chunks during the analysis. Here we only
+        # show the first part, so that large files don't stall the UI.
+        self._file = None
+        text = await file.slice(0, self._preview_size).text()
+        self._input_element.value = text
+        self._file = file
+        self._analysis_out.innerHTML = f"Read from <u>{file.name}</u>"
+        if file.size > self._preview_size:
+            self._analysis_out.innerHTML += " (showing the first part)"
+
+    def _on_input(self):
+        self._file = None  # the user edited the text, so use that instead
+
     async def do_analyse(self):
         """Analyze incoming data ..."""
         if self._analyzing:
@@ -3581,11 +3765,15 @@ class ImportDialog(BaseDialog):
         self._import_but.disabled = True
         self._import_but.innerHTML = "Import"
         self._records2import = []
+        self._new_record_count = 0
         # Run
         try:
-            await self._do_analyse()
+            ok = await self._do_analyse()
         except Exception as err:
             console.warn(str(err))
+            ok = False
+        if not ok:
+            self._records2import = []
         # Restore
         self._analyzing = False
         self._import_but.innerHTML = "Import"
@@ -3593,234 +3781,112 @@ class ImportDialog(BaseDialog):
             self._import_but.disabled = False
 
     async def _do_analyse(self):
-        global JSON
-
         def log(s):
             self._analysis_out.innerHTML += s + "<br />"
 
         # Init
         self._analysis_out.innerHTML = ""
-        text = self._input_element.value.lstrip()
-        header, text = text.lstrip().split("\n", 1)
-        header = header.strip()
-        text = text or ""
-
-        # Parse header to get sepator
-        sep, sepname, sepcount = "", "", 0
-        for x, name in [("\t", "tab"), (",", "comma"), (";", "semicolon")]:
-            if header.count(x) > sepcount:
-                sep, sepname, sepcount = x, name, header.count(x)
-        if not header:
-            log("No data")
-            return
-        elif not sepcount or not sep:
-            log("Could not determine separator (tried tab, comma, semicolon)")
-            return
-        else:
-            log("Looks like the separator is " + sepname)
-
-        # Get mapping to parse header names
-        M = {
-            "key": ["id", "identifier"],
-            "projectkey": ["project key", "project id"],
-            "projectname": ["project", "pr", "proj", "project name"],
-            "tags": ["tags", "tag"],
-            "t1": ["start", "begin", "start time", "begin time"],
-            "t2": ["stop", "end", "stop time", "end time"],
-            "description": ["summary", "comment", "title", "ds"],
-            "projectpath": ["project path"],
-            "date": [],
-            "duration": [
-                "duration h:m",
-                "duration h:m:s",
-                "duration hh:mm",
-                "duration hh:mm:ss",
-            ],
-        }
-        namemap = {}
-        for key, options in M.items():
-            namemap[key] = key
-            for x in options:
-                namemap[x] = key
-
-        # Parse header to get names
-        headerparts1 = csvsplit(header, sep)[0]
-        headerparts2 = []
-        headerparts_unknown = []
-        for name in headerparts1:
-            name = name.lower().replace("-", " ").replace("_", " ")
-            if name in namemap:
-                headerparts2.append(namemap[name])
-            elif not name:
-                headerparts2.append(None)
-            else:
-                headerparts_unknown.append(name)
-                headerparts2.append(None)
-        while headerparts2 and headerparts2[-1] is None:
-            headerparts2.pop(-1)
-        if headerparts_unknown:
-            log("Ignoring some headers: " + headerparts_unknown.join(", "))
+        file = self._file
+        text = None
+        if file is not None:
+            log(f"Reading from <u>{file.name}</u>")
         else:
-            log("All headers names recognized")
-
-        # All required names headers present?
-        if "t1" not in headerparts2:
-            log("Missing required header for start time.")
-            return
-        elif "t2" not in headerparts2 and "duration" not in headerparts2:
-            log("Missing required header for stop time or duration.")
-            return
+            text = self._input_element.value
 
         # Get dict to map (t1, t2) to record key
         timemap = {}  # t1_t2 -> key
         for key, record in window.store.records._items.items():
             timemap[record.t1 + "_" + record.t2] = key
 
-        # Now parse!
-        year_past_epoch = 31536000  # So we can test that a timestamp is not a hh.mm
-        records = []
-        new_record_count = 0
-        index = 0
-        row = 0
-        while index < len(text):
-            row += 1
-            try:
-                # Get parts on this row
-                lineparts, index = csvsplit(text, sep, index)
-                if len("".join(lineparts).trim()) == 0:
-                    continue  # skip empty rows
-                # Build raw object
-                raw = {}
-                for j in range(min(len(lineparts), len(headerparts2))):
-                    key = headerparts2[j]
-                    if key is not None:
-                        raw[key] = lineparts[j].strip()
-                raw.more = lineparts[len(headerparts2) :]
-                # Build record
-                record = window.store.records.create(0, 0)
-                record_key = None
-                if raw.key:
-                    record_key = raw.key  # dont store at record yet
-                if raw.date:
-                    # Prep date. Support both dd-mm-yyyy and yyy-mm-dd
-                    date = raw.date.replace(".", "-")  # Some tools use dots
-                    if len(date) == 10 and date.count("-") == 2:
-                        if len(date.split("-")[-1]) == 4:
-                            date = "-".join(reversed(date.split("-")))
-                        raw.date_ok = date
-                if True:  # raw.t1 always exists
-                    record.t1 = float(raw.t1)
-                    if not (isFinite(record.t1) and record.t1 > year_past_epoch):
-                        record.t1 = Date(raw.t1).getTime() / 1000
-                    if not isFinite(record.t1) and raw.date_ok:
-                        # Try use date, Yast uses dots, reverse if needed
-                        tme = raw.t1.replace(".", ":")
-                        if 4 <= len(tme) <= 8 and 1 <= tme.count(":") <= 2:
-                            # Note: on IOS, Date needs to be "yyyy-mm-ddThh:mm:ss"
-                            # but people are unlikely to import on an ios device ... I hope.
-                            record.t1 = Date(raw.date_ok + " " + tme).getTime() / 1000
-                    record.t1 = Math.floor(record.t1)
-                if True:  # raw.t2 or duration exists -
-                    record.t2 = float(raw.t2)
-                    if not (isFinite(record.t2) and record.t2 > year_past_epoch):
-                        record.t2 = Date(raw.t2).getTime() / 1000
-                    if not isFinite(record.t2) and raw.duration:
-                        # Try use duration
-                        duration = float(raw.duration)
-                        if ":" in raw.duration:
-                            duration_parts = raw.duration.split(":")
-                            if len(duration_parts) == 2:
-                                duration = float(duration_parts[0]) * 3600
-                                duration += float(duration_parts[1]) * 60
-                            elif len(duration_parts) == 3:
-                                duration = float(duration_parts[0]) * 3600
-                                duration += float(duration_parts[1]) * 60
-                                duration += float(duration_parts[2])
-                        record.t2 = record.t1 + float(duration)
-                    if not isFinite(record.t2) and raw.date_ok:
-                        # Try use date
-                        tme = raw.t2.replace(".", ":")
-                        if 4 <= len(tme) <= 8 and 1 <= tme.count(":") <= 2:
-                            record.t2 = Date(raw.date_ok + " " + tme).getTime() / 1000
-                    record.t2 = Math.ceil(record.t2)
-                if raw.tags:  # If tags are given, use that
-                    raw_tags = raw.tags.replace(",", " ").split()
-                    tags = []
-                    for tag in raw_tags:
-                        tag = utils.convert_text_to_valid_tag(tag.trim())
-                        if len(tag) > 2:
-                            tags.push(tag)
-                else:  # If no tags are given, try to derive tags from project name
-                    project_name = raw.projectname or raw.projectkey or ""
-                    if raw.projectpath:
-                        project_parts = [raw.projectpath]
-                        if raw.more and headerparts2[-1] == "projectpath":  # Yast
-                            project_parts = [raw.projectpath.replace("/", " | ")]
-                            for j in range(len(raw.more)):
-                                if len(raw.more[j]) > 0:
-                                    project_parts.append(
-                                        raw.more[j].replace("/", " | ")
-                                    )
-                        project_parts.append(raw.projectname.replace("/", " | "))
-                        project_name = "/".join(project_parts)
-                    project_name = to_str(project_name)  # normalize
-                    tags = []
-                    if project_name:
-                        tags = [utils.convert_text_to_valid_tag(project_name)]
-                if True:
-                    tags_dict = {}
-                    for tag in tags:
-                        tags_dict[tag] = tag
-                    if raw.description:
-                        tags, parts = utils.get_tags_and_parts_from_string(
-                            raw.description
+        if window.Worker:
+            # Parse in a worker. It reads the file in chunks and sends
+            # the records in batches, so the UI stays responsive.
+            def executor(resolve):
+                def on_message(event):
+                    msg = event.data
+                    if msg.type == "log":
+                        log(msg.text)
+                    elif msg.type == "records":
+                        self._add_records(msg.records, msg.keys, timemap)
+                    elif msg.type == "progress":
+                        percentage = Math.round(100 * msg.fraction)
+                        self._import_but.innerHTML = (
+                            f"Found {msg.count} records ({percentage}%)"
                         )
-                        for tag in tags:
-                            tags_dict.pop(tag, None)
-                        tagz = " ".join(tags_dict.values())
-                        record.ds = to_str(tagz + " " + raw.description)
-                    else:
-                        tagz = " ".join(tags_dict.values())
-                        record.ds = tagz
-                # Validate record
-                if record.t1 == 0 or record.t2 == 0:
-                    log(f"Item on row {row} has invalid start/stop times")
-                    return
-                if len(window.store.records._validate_items([record])) == 0:
-                    log(
-                        f"Item on row {row} does not pass validation: "
-                        + JSON.stringify(record)
-                    )
-                    return
-                record.t2 = max(record.t2, record.t1 + 1)  # no running records
-                # Assign the right key based on given key or t1_t2
-                if record_key is not None:
-                    record.key = record_key
-                else:
-                    existing_key = timemap.get(record.t1 + "_" + record.t2, None)
-                    if existing_key is not None:
-                        record.key = existing_key
-                # Add
-                records.append(record)
-                if window.store.records.get_by_key(record.key) is None:
-                    new_record_count += 1
-                # Keep giving feedback / dont freeze
-                if row % 100 == 0:
-                    self._import_but.innerHTML = f"Found {len(records)} records"
-                    await window.tools.sleepms(1)
-            except Exception as err:
-                log(f"Error at row {row}: {err}")
-                return
+                    elif msg.type == "done":
+                        resolve(msg.ok)
+                        self._stop_worker()
+
+                def on_error(event):
+                    # E.g. the worker failed to load, or a stream API failed
+                    err = event.message or "worker error"
+                    console.warn("Import worker failed: " + err)
+                    log("Could not parse the data: " + err)
+                    self._stop_worker()  # resolves with False
+
+                self._worker = window.Worker("import_worker.js")
+                self._worker.onmessage = on_message
+                self._worker.onerror = on_error
+                self._worker.onmessageerror = on_error
+                self._worker_resolve = resolve
+                self._worker.postMessage({"type": "parse", "file": file, "text": text})
+
+            ok = await window.Promise(executor)
+        else:
+            if file is not None:
+                text = await file.text()
+            parser = importer.ImportParser()
+            header, _, text = text.lstrip().partition("\n")
+            ok = False
+            if parser.parse_header(header.strip(), log):
+                result = parser.parse_rows(text, True, log)
+                if result is not None:
+                    self._add_records(result[0], result[1], timemap)
+                    ok = True
+
+        # Give summary
+        if ok:
+            count = len(self._records2import)
+            log(f"Found {count} ({self._new_record_count} new)")
+        return ok
+
+    def _add_records(self, records, keys, timemap):
+        for i in range(len(records)):
+            record = records[i]
+            # Assign the right key based on given key or t1_t2
+            if keys[i] is not None:
+                record.key = keys[i]
+            else:
+                existing_key = timemap.get(record.t1 + "_" + record.t2, None)
+                if existing_key is not None:
+                    record.key = existing_key
+            # Add
+            self._records2import.push(record)
+            if window.store.records.get_by_key_readonly(record.key) is None:
+                self._new_record_count += 1
+
+    def _stop_worker(self):
+        if self._worker is not None:
+            self._worker.terminate()
+            self._worker = None
+            self._worker_resolve(False)  # no-op if already resolved
 
-        # Store and give summary
-        self._records2import = records
-        log(f"Found {len(records)} ({new_record_count} new)")
+    def close(self, e=None):
+        self._stop_worker()
+        super().close(e)
 
-    def do_import(self):
+    async def do_import(self):
         """Do the import!"""
-        window.store.records.put(*self._records2import)
+        records = self._records2import
         self._records2import = []
         self._import_but.disabled = True
+        # Put the records in batches, to give feedback and not freeze the UI
+        batch_size = 1000
+        for i in range(0, len(records), batch_size):
+            window.store.records.put(*records.slice(i, i + batch_size))
+            n = min(i + batch_size, len(records))
+            self._import_but.innerHTML = f"Imported {n} of {len(records)}"
+            await window.tools.sleepms(1)
         self._import_but.innerHTML = "Import done"
 
 
@@ -3964,6 +4030,10 @@ class SettingsDialog(BaseDialog):
             <label>
                 <input type='checkbox' checked='false'></input>
                 Enable pomodoro (experimental) </label>
+            <h2><i class='fas'>\uf0e4</i>&nbsp;&nbsp;Performance</h2>
+            <label>
+                <input type='checkbox' checked='false'></input>
+                Calculate stats in a background worker (experimental, applies after reload) </label>
 
             <hr style='margin-top: 1em;' />
 
@@ -3994,6 +4064,8 @@ class SettingsDialog(BaseDialog):
             self._notification_label,
             _,  # Pomodoro header
             self._pomodoro_label,
+            _,  # Performance header
+            self._record_worker_label,
             _,  # hr
             _,  # Section: info
             _,  # Timezone header
@@ -4084,6 +4156,12 @@ class SettingsDialog(BaseDialog):
         self._pomodoro_check.checked = pomo_enabled
         self._pomodoro_check.onchange = self._on_pomodoro_check
 
+        # Record worker
+        record_worker = window.simplesettings.get("record_worker")
+        self._record_worker_check = self._record_worker_label.children[0]
+        self._record_worker_check.checked = record_worker
+        self._record_worker_check.onchange = self._on_record_worker_check
+
         # Static settings
 
         # Set timezone info
@@ -4144,6 +4222,10 @@ class SettingsDialog(BaseDialog):
         pomo_enabled = bool(self._pomodoro_check.checked)
         window.simplesettings.set("pomodoro_enabled", pomo_enabled)
 
+    def _on_record_worker_check(self):
+        record_worker = bool(self._record_worker_check.checked)
+        window.simplesettings.set("record_worker", record_worker)
+
     def _on_stopwatch_check(self):
         show_stopwatch = bool(self._stopwatch_check.checked)
         window.simplesettings.set("show_stopwatch", show_stopwatch)
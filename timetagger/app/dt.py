@@ -188,6 +188,160 @@ def format_isodate(date, fmt=None):
         return date
 
 
+class Calendar:
+    """Cache of the (local) timestamps at which days, months and years
+    start, for a span of years. This allows floor() and add() to do a
+    binary search instead of creating Date objects, for the calendar
+    resolutions. The span grows as needed, up to a maximum number of years.
+    """
+
+    _max_years = 60
+
+    def __init__(self):
+        self._year1 = 0
+        self._year2 = -1  # inclusive
+        self._t1 = 0
+        self._t2 = 0
+        self._days = []  # start times of consecutive days
+        self._days_clean = []  # whether the day starts at 00:00 (not so for some DST)
+        self._weekday1 = 0  # the weekday of the first day
+        self._months = []  # start times of consecutive months
+        self._months_clean = []
+        self._years = []  # start times of consecutive years
+        self._years_clean = []
+        self._weeknumbers = {}
+
+    def _ensure(self, t):
+        """Make sure that the given time is covered. Returns False if
+        that would make the span too large.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+        if self._t1 <= t < self._t2:
+            return True
+        year = Date(t * 1000).getFullYear()
+        if isNaN(year):
+            return False
+        year1, year2 = year - 1, year + 1
+        if self._year2 >= self._year1:
+            year1, year2 = min(year1, self._year1), max(year2, self._year2)
+        if year2 - year1 + 1 > self._max_years:
+            return False
+        self._build(year1, year2)
+        return True
+
+    def _build(self, year1, year2):
+        PSCRIPT_OVERLOAD = False  # noqa
+        days, days_clean = [], []
+        months, months_clean = [], []
+        years, years_clean = [], []
+        for year in range(year1, year2 + 1):
+            for month in range(12):
+                ndays = Date(year, month + 1, 0).getDate()
+                for day in range(1, ndays + 1):
+                    d = Date(year, month, day)
+                    t = d.getTime() / 1000
+                    clean = d.getHours() == 0 and d.getMinutes() == 0
+                    days.append(t)
+                    days_clean.append(clean)
+                    if day == 1:
+                        months.append(t)
+                        months_clean.append(clean)
+                        if month == 0:
+                            years.append(t)
+                            years_clean.append(clean)
+        self._year1, self._year2 = year1, year2
+        self._t1 = years[0]
+        self._t2 = Date(year2 + 1, 0, 1).getTime() / 1000
+        self._days, self._days_clean = days, days_clean
+        self._weekday1 = Date(year1, 0, 1).getDay()
+        self._months, self._months_clean = months, months_clean
+        self._years, self._years_clean = years, years_clean
+        self._weeknumbers = {}
+
+    def _index(self, boundaries, t):
+        """Get the index of the last boundary <= t."""
+        PSCRIPT_OVERLOAD = False  # noqa
+        lo, hi = 0, len(boundaries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if boundaries[mid] <= t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
+
+    def floor(self, t, res_name, res_factor):
+        """Like floor(), for resolutions of a day or more.
+        Returns None if the result cannot be obtained from the cache.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+        if res_factor < 1 or res_factor != Math.floor(res_factor):
+            return None
+        elif not self._ensure(t):
+            return None
+        if res_name == "D":
+            i = self._index(self._days, t)
+            if res_factor != 1:
+                # Days are counted from the start of the month
+                j = self._index(self._days, self._months[self._index(self._months, t)])
+                i = j + int((i - j) / res_factor) * res_factor
+            return self._days[i]
+        elif res_name == "W":
+            i = self._index(self._days, t)
+            weekday = (self._weekday1 + i) % 7
+            i -= (weekday + 7 - get_first_day_of_week()) % 7  # Align to a sunday/monday
+            return self._days[i] if i >= 0 else None
+        elif res_name == "M":
+            i = self._index(self._months, t)
+            return self._months[i - (i % 12) + int((i % 12) / res_factor) * res_factor]
+        elif res_name == "Y":
+            year = self._year1 + self._index(self._years, t)
+            i = int(year / res_factor) * res_factor - self._year1
+            return self._years[i] if i >= 0 else None
+        return None
+
+    def add(self, t, delta_name, delta_factor):
+        """Like add(), for a whole number of days, weeks, months or years,
+        when t is the start of such a period. Returns None otherwise.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+        if delta_factor != Math.floor(delta_factor) or not self._ensure(t):
+            return None
+        if delta_name == "D" or delta_name == "W":
+            boundaries, clean = self._days, self._days_clean
+            if delta_name == "W":
+                delta_factor *= 7
+        elif delta_name == "M":
+            boundaries, clean = self._months, self._months_clean
+        elif delta_name == "Y":
+            boundaries, clean = self._years, self._years_clean
+        else:
+            return None
+        i = self._index(boundaries, t)
+        if boundaries[i] != t or not clean[i]:
+            return None
+        i += delta_factor
+        if i < 0 or i >= len(boundaries):
+            return None
+        return boundaries[i]
+
+    def get_weeknumber(self, t):
+        """Like get_weeknumber(), but cached per day."""
+        PSCRIPT_OVERLOAD = False  # noqa
+        day = self.floor(t, "D", 1)
+        if day is None:
+            return None
+        key = get_first_day_of_week() + "_" + day
+        weeknumber = self._weeknumbers.get(key, None)
+        if weeknumber is None:
+            weeknumber = _get_weeknumber(t)
+            self._weeknumbers[key] = weeknumber
+        return weeknumber
+
+
+_calendar = Calendar()
+
+
 def round(t, res):
     """Round the given date to the nearest resolution step."""
     PSCRIPT_OVERLOAD = False  # noqa
@@ -202,6 +356,11 @@ def floor(t, res):
     resName = res[-1]
     resFactor = float(res[:-1])
 
+    if resName == "D" or resName == "W" or resName == "M" or resName == "Y":
+        result = _calendar.floor(t, resName, resFactor)
+        if result is not None:
+            return result
+
     d = Date(t * 1000)
     tup = (
         d.getFullYear(),
@@ -226,8 +385,8 @@ def floor(t, res):
         day_offset = 7 - get_first_day_of_week()
         d.setHours(0, 0, 0, 0)
         daysoff = (d.getDay() + day_offset) % 7  # Align to a sunday/monday
-        d = Date(d.getTime() - 86_400_000 * daysoff)
-        tup = d.getFullYear(), d.getMonth(), d.getDate()
+        # Subtract days in the calendar, not 24h periods, which fail across DST
+        tup = d.getFullYear(), d.getMonth(), d.getDate() - daysoff
     elif resName == "M":
         tup = tup[:2]  # Note that it is zero-based (jan is zero)
         tup[-1] = int(tup[-1] / resFactor) * resFactor
@@ -261,6 +420,11 @@ def add(t, delta):
     if isNaN(deltaFactor):
         raise RuntimeError(f"Cannot create delta from {delta!r}")
 
+    if deltaName == "D" or deltaName == "W" or deltaName == "M" or deltaName == "Y":
+        result = _calendar.add(t, deltaName, deltaFactor)
+        if result is not None:
+            return result
+
     d = Date(t * 1000)
     tup = (
         d.getFullYear(),
@@ -400,6 +564,13 @@ def get_first_day_of_week():
 
 def get_weeknumber(t):
     """Get the ISO 8601 week number."""
+    weeknumber = _calendar.get_weeknumber(t)
+    if weeknumber is None:
+        weeknumber = _get_weeknumber(t)
+    return weeknumber
+
+
+def _get_weeknumber(t):
     # From https://weeknumber.net/how-to/javascript
     date = Date(t * 1000)  # noqa
     day_offfset = 7 - get_first_day_of_week()  # noqa
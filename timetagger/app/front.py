@@ -144,7 +144,7 @@ def draw_tag(ctx, tag, x, y):
     ori_color = ctx.fillStyle
     ctx.fillStyle = window.store.settings.get_color_for_tag(tag)
     ctx.fillText(tag[0], x, y)
-    x += ctx.measureText(tag[0]).width
+    x += utils.measure_text(ctx, tag[0])
     ctx.fillStyle = ori_color
     ctx.fillText(tag[1:], x, y)
 
@@ -187,6 +187,11 @@ class TimeTaggerCanvas(BaseCanvas):
             "TopWidget": TopWidget(self),
         }
 
+        # Each widget is drawn to its own offscreen canvas (a layer). On the
+        # one-second tick, only the layers that depend on the time are redrawn.
+        self._layers = {}  # widget name -> layer
+        self._data_key = ""
+
         self.node.addEventListener("blur", self.on_blur)
 
     def _pick_widget(self, x, y):
@@ -209,6 +214,56 @@ class TimeTaggerCanvas(BaseCanvas):
             return self._now
         return dt.now()
 
+    def on_tick(self):
+        # Schedule a draw, but only redraw the layers that depend on time
+        self._schedule_draw()
+
+    def pick_tooltip(self, x, y):
+        for name in reversed(self.widgets.keys()):
+            layer = self._layers.get(name, None)
+            if layer is not None:
+                ob = layer.tooltips.pick(x, y)
+                if ob is not None:
+                    return ob
+        return self._tooltips.pick(x, y)
+
+    def _get_data_key(self):
+        # Changes to the data or settings, e.g. via a dialog, affect all layers
+        return f"{window.store.records._version}_{window.store.settings._version}_{window.simplesettings._version}_{len(dialogs.stack)}"
+
+    def _get_layer(self, name):
+        layer = self._layers.get(name, None)
+        if layer is None:
+            layer = {
+                "canvas": window.document.createElement("canvas"),
+                "tooltips": utils.Picker(),
+                "tick_key": None,
+            }
+            self._layers[name] = layer
+        layer.resized = False
+        if layer.canvas.width != self.node.width:
+            layer.canvas.width = self.node.width
+            layer.resized = True
+        if layer.canvas.height != self.node.height:
+            layer.canvas.height = self.node.height
+            layer.resized = True
+        return layer
+
+    def _draw_layer(self, layer, widget):
+        ctx = layer.canvas.getContext("2d")
+        ctx.setTransform(self.pixel_ratio, 0, 0, self.pixel_ratio, 0, 0)
+        ctx.clearRect(0, 0, self.w, self.h)
+        # The tooltips are kept per layer, so they remain when the layer is reused
+        layer.tooltips.clear()
+        canvas_tooltips = self._tooltips
+        self._tooltips = layer.tooltips
+        ctx.save()
+        try:
+            widget.on_draw(ctx)
+        finally:
+            ctx.restore()
+            self._tooltips = canvas_tooltips
+
     def on_resize(self):
         """Perform layout; set sizes of widgets. We can go all responsive here."""
 
@@ -306,14 +361,33 @@ class TimeTaggerCanvas(BaseCanvas):
                 self.widgets["TopWidget"].on_draw(ctx, True)  # menu only
             finally:
                 ctx.restore()
+            self._full_draw = True  # the layers are not up to date
         else:
-            # Draw child widgets
-            for widget in self.widgets.values():
-                ctx.save()
-                try:
-                    widget.on_draw(ctx)
-                finally:
-                    ctx.restore()
+            # Determine whether all layers must be redrawn
+            data_key = self._get_data_key()
+            redraw_all = self._full_draw or data_key != self._data_key
+            self._full_draw = False
+            self._data_key = data_key
+            # Draw child widgets to their layer if needed, and compose
+            for name, widget in self.widgets.items():
+                layer = self._get_layer(name)
+                tick_key = widget.get_tick_key()
+                if (
+                    redraw_all
+                    or layer.resized
+                    or widget._layer_dirty
+                    or tick_key != layer.tick_key
+                ):
+                    layer.tick_key = tick_key
+                    widget._layer_dirty = False
+                    self._draw_layer(layer, widget)
+                ctx.drawImage(layer.canvas, 0, 0, self.w, self.h)
+            # The now-marker moves on each tick, so it is not part of a layer
+            ctx.save()
+            try:
+                self.widgets["RecordsWidget"].on_draw_overlay(ctx)
+            finally:
+                ctx.restore()
 
         self._now = None  # Use real "now" in between draws
 
@@ -761,12 +835,20 @@ class Widget:
     def __init__(self, canvas):
         self._canvas = canvas
         self.rect = 0, 0, 0, 0  # (x1, y1, x2, y2) - Layout is done by the canvas
+        self._layer_dirty = False
         self.on_init()
 
     def update(self):
         """Invoke a new draw."""
         self._canvas.update()
 
+    def update_layer(self):
+        """Invoke a new draw in which only this widget is redrawn,
+        e.g. for an animation that does not affect other widgets.
+        """
+        self._layer_dirty = True
+        self._canvas._schedule_draw()
+
     def on_init(self):
         pass
 
@@ -782,6 +864,12 @@ class Widget:
     def on_draw(self, ctx):
         pass
 
+    def get_tick_key(self):
+        """Get a value that changes when the widget must be redrawn
+        because time has passed. By default this changes every minute.
+        """
+        return int(self._canvas.now() / 60)
+
     def _draw_button(self, ctx, x, y, given_w, h, text, action, tt, options):
         PSCRIPT_OVERLOAD = False  # noqa
 
@@ -818,7 +906,7 @@ class Widget:
             else:
                 font = fontsize + "px " + opt.font
             ctx.font = font
-            width = ctx.measureText(text).width
+            width = utils.measure_text(ctx, text)
             texts2.push(text)
             fonts.push(font)
             widths.push(width)
@@ -925,6 +1013,12 @@ class TopWidget(Widget):
         window.addEventListener("keydown", self._on_key, 0)
         self._canvas.node.addEventListener("keydown", self._on_key, 0)
 
+    def get_tick_key(self):
+        # The stopwatch of a running record shows seconds
+        if len(window.store.records.get_running_records_readonly()) > 0:
+            return int(self._canvas.now())
+        return super().get_tick_key()
+
     def on_draw(self, ctx, menu_only=False):
         self._picker.clear()
         x1, y1, x2, y2 = self.rect
@@ -1256,7 +1350,7 @@ class TopWidget(Widget):
 
         # Define stop summary
         running_summary = ""
-        records = window.store.records.get_running_records()
+        records = window.store.records.get_running_records_readonly()
         has_running = False
         running_tag_color = None
         if len(records) > 0:
@@ -1434,8 +1528,8 @@ class TopWidget(Widget):
         else:
             # Two parts next to each-other
             text1 += "  "
-            w1 = ctx.measureText(text1).width
-            w2 = ctx.measureText(text2).width
+            w1 = utils.measure_text(ctx, text1)
+            w2 = utils.measure_text(ctx, text2)
             w = w1 + w2
             ctx.textAlign = "left"
             ctx.fillStyle = COLORS.acc_clr
@@ -1553,10 +1647,9 @@ class TopWidget(Widget):
                 record = window.store.records.create(now, now)
                 records = window.store.records.get_running_records()
                 if not records:
-                    records = window.store.records.get_records(
-                        now - 7 * 86400, now
-                    ).values()
-                    records.sort(key=lambda r: r.t2)
+                    records = window.store.records.get_records_sorted(
+                        now - 7 * 86400, now, "t2"
+                    )
                 if records:
                     prev_record = records[-1]
                     record.ds = prev_record.ds
@@ -1648,6 +1741,15 @@ class RecordsWidget(Widget):
         self._selected_record = None
         self._can_interact_with_records = False
         self._record_times = {}  # For snapping
+        self._layout_cache = {
+            "layout_key": "",
+            "has_running": False,
+            "version": -1,
+            "t1": 0,
+            "t2": 0,
+        }
+        self._label_cache = {}  # ds -> tags and words, see _get_record_label
+        self._label_cache_size = 0
 
         # Stuff related to interaction
         self._interaction_mode = 0
@@ -1655,6 +1757,7 @@ class RecordsWidget(Widget):
         self._last_pointer_down_event = None
 
         self._arrow_state = 0, 0  # last_timestamp, last_alpha
+        self._now_marker_bounds = None  # x1, x2, y1, y2
         self._last_scale_scroll = 0
         self._last_trans_scroll = 0
         self._pointer_pos = {}
@@ -1662,9 +1765,22 @@ class RecordsWidget(Widget):
         self._pointer_startrange = 0, 0
         self._pointer_inertia = []  # track last n move events
 
+    def get_tick_key(self):
+        # Running records end at "now", so while one is visible, the
+        # records change when "now" moves a pixel.
+        t1, t2 = self._canvas.range.get_range()
+        now = self._canvas.now()
+        for record in window.store.records.get_running_records_readonly():
+            if record.t1 <= t2 and now >= t1:
+                x1, y1, x2, y2 = self.rect
+                pixel = Math.round((now - t1) * (y2 - y1) / (t2 - t1))
+                return f"{super().get_tick_key()}_{pixel}"
+        return super().get_tick_key()
+
     def on_draw(self, ctx):
         x1, y1, x2, y2 = self.rect
         self._picker.clear()
+        self._now_marker_bounds = None
 
         # Guard for small screen space during resize
         if y2 - y1 < 20:
@@ -1990,9 +2106,24 @@ class RecordsWidget(Widget):
                 ctx.closePath()
                 ctx.fill()
 
-        # Draw "now" - also if drawing stats
+        # "now" is drawn in on_draw_overlay - also if drawing stats
+        self._now_marker_bounds = x1, x2, y1, y2
+
+    def on_draw_overlay(self, ctx):
+        """Draw the "now" marker over the layer with the records. This
+        is repainted on each tick, so the marker moves and animates
+        without redrawing the records.
+        """
+        if not self._now_marker_bounds:
+            return
+        x1, x2, y1, y2 = self._now_marker_bounds
+        t1, t2 = self._canvas.range.get_range()
         t = self._canvas.now()
-        y = y1 + (t - t1) * pps
+        y = y1 + (t - t1) * (y2 - y1) / (t2 - t1)
+        # Only draw within the record area, not over the covers
+        ctx.beginPath()
+        ctx.rect(x1, y1, x2 - x1, y2 - y1)
+        ctx.clip()
         ctx.strokeStyle = COLORS.record_text
         ctx.lineWidth = 3  # Pretty thick so it sticks over other edges like week bounds
         ctx.setLineDash([4, 4])
@@ -2001,8 +2132,6 @@ class RecordsWidget(Widget):
         ctx.moveTo(x1, y)
         ctx.lineTo(x2, y)
         ctx.stroke()
-        ctx.setLineDash([])
-        ctx.lineDashOffset = 0
 
     def _draw_records(self, ctx, x1, x2, x3, y1, y2):
         PSCRIPT_OVERLOAD = False  # noqa
@@ -2025,27 +2154,89 @@ class RecordsWidget(Widget):
         nsecs = t2 - t1
         npixels = y3 - y0
 
-        # Select all records in this range. Sort so that smaller records are drawn on top.
-        records = window.store.records.get_records(t1, t2).values()
+        # Get records in this range, and the positions of their descriptions.
+        # Note that these records are not copies; they must not be modified.
+        records, positions_map = self._get_record_layout(
+            t1, t2, y0, y1, y2, npixels, nsecs
+        )
 
         # if len(records) > 0:
         #     self._help_text = "click a record to edit it"
 
-        # Sort records by size, so records cannot be completely overlapped by another
-        # Or ... by t2, which works better when the labels are made to overlap in a cluster,
-        # see the distance = ref_distance - ... below
-        # records.sort(key=lambda r: r.t1 - (now if (r.t1 == r.t2) else r.t2))
-        records.sort(key=lambda r: -r.t2)
-
-        # Prepare by collecting stuff per record, and determine selected record
+        # Collect times per record, and determine selected record
         self._record_times = {}
-        positions_map = {}
         selected_record = None
         for record in records:
             self._record_times[record.key] = record.t1, record.t2
             if self._selected_record is not None:
                 if record.key == self._selected_record[0].key:
                     selected_record = record
+
+        # Draw records
+        for record in records:
+            pos = positions_map[record.key]
+            self._draw_one_record(
+                ctx, record, t1, x1, x2, x3, y0, y1, y2, npixels, nsecs, pos.y
+            )
+
+        # Draw the selected record, again, and with extra stuff to allow
+        # manipulating it. This is mostly for the timeline
+        # representation. Though we also re-draw the representation
+        # next to the timeline to make its shadow thicker :)
+        if selected_record is not None:
+            record = selected_record
+            pos = positions_map[record.key]
+            self._draw_one_record(
+                ctx, record, t1, x1, x2, x3, y0, y1, y2, npixels, nsecs, pos.y
+            )
+            self._draw_selected_record_extras(
+                ctx, record, t1, x1, x2, x3, y0, y1, y2, npixels, nsecs
+            )
+
+    def _get_record_layout(self, t1, t2, y0, y1, y2, npixels, nsecs):
+        """Get the records in the given range, and the positions of their
+        descriptions, clustered so that they don't overlap. The layout is
+        cached until the records, range or size change. Records are fetched
+        for a wider range, so that panning does not need to query the store.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        store = window.store.records
+        cache = self._layout_cache
+        now = self._canvas.now()
+
+        # Use the cached layout if nothing changed. Running records move with time.
+        layout_key = f"{store._version}_{t1}_{t2}_{y0}_{y1}_{y2}_{npixels}"
+        time_key = "_" + Math.floor(now)
+        if cache.has_running:
+            if layout_key + time_key == cache.layout_key:
+                return cache.records, cache.positions_map
+        elif layout_key == cache.layout_key:
+            return cache.records, cache.positions_map
+
+        # Get records for a wider range, unless the cached records cover the range
+        if not (cache.version == store._version and cache.t1 <= t1 and t2 <= cache.t2):
+            cache.version = store._version
+            cache.t1 = t1 - nsecs
+            cache.t2 = t2 + nsecs
+            # Sort records by t2, which works better when the labels are made
+            # to overlap in a cluster, see the distance = ref_distance - ... below
+            cache.all_records = store.get_records_sorted(cache.t1, cache.t2, "-t2")
+
+        # Select the records in this range (the order is maintained)
+        records = []
+        has_running = False
+        for record in cache.all_records:
+            if record.t1 == record.t2:
+                if now > t1 and record.t1 < t2:
+                    records.append(record)
+                    has_running = True
+            elif t2 > record.t1 and t1 < record.t2:
+                records.append(record)
+
+        # Determine preferred positions
+        positions_map = {}
+        for record in records:
             pos = self._determine_record_preferred_pos(
                 record, t1, y0, y1, y2, npixels, nsecs
             )
@@ -2103,26 +2294,38 @@ class RecordsWidget(Widget):
                     for i, pos in enumerate(cluster):
                         pos.y = ref_y + (i + 0.5 - len(cluster) / 2) * distance
 
-        # Draw records
-        for record in records:
-            pos = positions_map[record.key]
-            self._draw_one_record(
-                ctx, record, t1, x1, x2, x3, y0, y1, y2, npixels, nsecs, pos.y
-            )
+        # Store the layout
+        cache.layout_key = layout_key + time_key if has_running else layout_key
+        cache.has_running = has_running
+        cache.records = records
+        cache.positions_map = positions_map
+        return records, positions_map
 
-        # Draw the selected record, again, and with extra stuff to allow
-        # manipulating it. This is mostly for the timeline
-        # representation. Though we also re-draw the representation
-        # next to the timeline to make its shadow thicker :)
-        if selected_record is not None:
-            record = selected_record
-            pos = positions_map[record.key]
-            self._draw_one_record(
-                ctx, record, t1, x1, x2, x3, y0, y1, y2, npixels, nsecs, pos.y
-            )
-            self._draw_selected_record_extras(
-                ctx, record, t1, x1, x2, x3, y0, y1, y2, npixels, nsecs
-            )
+    def _get_record_label(self, ds):
+        """Get the tags and the words of the description of a record. This
+        is cached (per ds), so that the text is not parsed on each draw.
+        """
+        label = self._label_cache.get(ds, None)
+        if label is None:
+            if self._label_cache_size >= 5000:
+                self._label_cache = {}
+                self._label_cache_size = 0
+            tags, ds_parts = utils.get_tags_and_parts_from_string(ds)
+            if len(tags) == 0:
+                tags = ["#untagged"]
+            words = []
+            for part in ds_parts:
+                if part.startswith("#"):
+                    texts = [part]
+                else:
+                    texts = part.split(" ")
+                for text in texts:
+                    if len(text) > 0:
+                        words.append(text)
+            label = {"tags": tags, "words": words}
+            self._label_cache[ds] = label
+            self._label_cache_size += 1
+        return label
 
     def _determine_record_preferred_pos(self, record, t1, y0, y1, y2, npixels, nsecs):
         PSCRIPT_OVERLOAD = False  # noqa
@@ -2188,9 +2391,8 @@ class RecordsWidget(Widget):
         ty2 = yy + 20
 
         # Get tag info, and determine if this record is selected in the overview
-        tags, ds_parts = utils.get_tags_and_parts_from_string(record.ds)
-        if len(tags) == 0:
-            tags = ["#untagged"]
+        label = self._get_record_label(record.ds)
+        tags = label.tags
         tags_selected = True
         selected_tags = self._canvas.widgets.AnalyticsWidget.selected_tags
         if len(selected_tags):
@@ -2387,28 +2589,22 @@ class RecordsWidget(Widget):
         ctx.font = (SMALLER * FONT.size) + "px " + FONT.default
         ctx.textAlign = "left"
         max_x = x6 - 4
-        space_width = ctx.measureText(" ").width + 2
+        space_width = utils.measure_text(ctx, " ") + 2
         x = x5 + 55
         ctx.fillStyle = COLORS.record_text if tags_selected else faded_clr
-        for part in ds_parts:
-            if part.startswith("#"):
-                texts = [part]
-            else:
-                texts = part.split(" ")
-            for text in texts:
-                if len(text) == 0:
-                    continue
-                if x > max_x:
-                    continue
-                new_x = x + ctx.measureText(text).width + space_width
-                if new_x <= max_x:
-                    if tags_selected and text.startswith("#"):
-                        draw_tag(ctx, text, x, text_ypos)
-                    else:
-                        ctx.fillText(text, x, text_ypos, max_x - x)
+        for i in range(len(label.words)):
+            if x > max_x:
+                break
+            text = label.words[i]
+            new_x = x + utils.measure_text(ctx, text) + space_width
+            if new_x <= max_x:
+                if tags_selected and text.startswith("#"):
+                    draw_tag(ctx, text, x, text_ypos)
                 else:
-                    ctx.fillText("…", x, text_ypos, max_x - x)
-                x = new_x
+                    ctx.fillText(text, x, text_ypos, max_x - x)
+            else:
+                ctx.fillText("…", x, text_ypos, max_x - x)
+            x = new_x
 
     def _draw_selected_record_extras(
         self, ctx, record, t1, x1, x4, x6, y0, y1, y2, npixels, nsecs, yy
@@ -3071,6 +3267,15 @@ class AnalyticsWidget(Widget):
         self.tagzmap = {}  # public map of tagz -> tagz
         self._tag_bars_dict = {}  # tagz -> bar-info
 
+    def get_tick_key(self):
+        # The bars of running records show seconds if "now" is in range
+        now = self._canvas.now()
+        t1, t2 = self._canvas.range.get_range()
+        if t1 < now < t2:
+            if len(window.store.records.get_running_records_readonly()) > 0:
+                return int(now)
+        return super().get_tick_key()
+
     def on_draw(self, ctx):
         x1, y1, x2, y2 = self.rect
 
@@ -3123,7 +3328,7 @@ class AnalyticsWidget(Widget):
 
         if self._need_more_drawing_flag:
             self._time_since_last_draw = 1
-            self.update()
+            self.update_layer()
         else:
             self._time_since_last_draw = 0
 
@@ -3295,7 +3500,7 @@ class AnalyticsWidget(Widget):
 
         # Prepare some more
         self._running_tagz = []
-        for record in window.store.records.get_running_records():
+        for record in window.store.records.get_running_records_readonly():
             self._running_tagz.append(
                 window.store.records.tags_from_record(record).join(" ")
             )
@@ -3698,11 +3903,11 @@ class AnalyticsWidget(Widget):
             if not tag:  # no tagz
                 text = "General"
                 ctx.fillText(text, tx, ty)
-                tx += ctx.measureText(text).width + 12
+                tx += utils.measure_text(ctx, text) + 12
             elif tag in self.selected_tags:
                 text = tag
                 draw_tag(ctx, text, tx, ty)
-                tx += ctx.measureText(text).width + 12
+                tx += utils.measure_text(ctx, text) + 12
             else:
                 tt = dt.duration_string(self._time_per_tag.get(tag, 0))
                 tt += " in total"
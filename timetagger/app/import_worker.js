@@ -0,0 +1,85 @@
+// Web Worker for the TimeTagger app to parse data for the import dialog.
+// The data is read in chunks, from a dropped File (via its stream) or from
+// pasted text, so that large files don't need to be loaded in full, and
+// don't block the UI while being parsed.
+//
+// The main thread sends {type: "parse", file, text}. The worker responds
+// with "log" messages, "records" messages holding batches of parsed
+// records, "progress" messages, and finally a "done" message that says
+// whether all data was parsed successfully.
+
+self.window = self;  // the pscript modules attach themselves to window
+importScripts("utils.js", "dt.js", "stores.js", "importer.js");
+
+var text_chunk_size = 2**16;
+
+function log(text) {
+    self.postMessage({type: "log", text: text});
+}
+
+async function* read_chunks(file, text) {
+    if (file) {
+        var reader = file.stream().pipeThrough(new TextDecoderStream()).getReader();
+        while (true) {
+            var result = await reader.read();
+            if (result.done) { break; }
+            yield result.value;
+        }
+    } else {
+        for (var i = 0; i < text.length; i += text_chunk_size) {
+            yield text.slice(i, i + text_chunk_size);
+        }
+    }
+}
+
+async function parse(file, text) {
+    var parser = new window.importer.ImportParser();
+    var total = file ? file.size : text.length;
+    var done = 0;
+    var count = 0;
+    var buffer = "";
+    var header_ok = false;
+
+    function feed(is_last) {
+        if (!header_ok) {
+            buffer = buffer.trimStart();
+            var i = buffer.indexOf("\n");
+            if (i < 0 && !is_last) { return true; }  // wait for more
+            i = i < 0 ? buffer.length : i;
+            if (!parser.parse_header(buffer.slice(0, i).trim(), log)) { return false; }
+            header_ok = true;
+            buffer = buffer.slice(i + 1);
+        }
+        var result = parser.parse_rows(buffer, is_last, log);
+        if (result === null) { return false; }
+        buffer = buffer.slice(result[2]);
+        count += result[0].length;
+        if (result[0].length > 0) {
+            self.postMessage({type: "records", records: result[0], keys: result[1]});
+        }
+        self.postMessage({type: "progress", count: count, fraction: Math.min(1, done / total)});
+        return true;
+    }
+
+    for await (var chunk of read_chunks(file, text)) {
+        done += chunk.length;  // characters, approximately bytes for a file
+        buffer += chunk;
+        if (!feed(false)) { return false; }
+    }
+    return feed(true);
+}
+
+self.onmessage = async function (event) {
+    var msg = event.data;
+    if (msg.type == "parse") {
+        var ok = false;
+        try {
+            ok = await parse(msg.file, msg.text);
+        } catch (err) {
+            log("Error: " + err.message);
+        }
+        self.postMessage({type: "done", ok: ok});
+    } else {
+        console.warn("[import_worker] invalid message type: " + msg.type);
+    }
+};
@@ -0,0 +1,309 @@
+"""
+Parsing of table data (CSV, TSV) into records, for the import dialog.
+
+This module does not touch the DOM or the data store, so it can run in
+a Web Worker (see import_worker.js). The text can be fed in chunks, so
+that large files can be parsed while they are being read.
+"""
+
+from pscript import this_is_js
+from pscript.stubs import window, JSON, Math, isFinite, Date
+
+
+if this_is_js():
+    utils = window.utils
+    stores = window.stores
+
+
+def to_str(x):
+    return window.stores.to_str(x)
+
+
+def csvsplit(s, sep, i=0):
+    """Split a string on the given sep, but take escaping with double-quotes
+    into account. Double-quotes themselves can be escaped by duplicating them.
+    The resuturned parts are whitespace-trimmed.
+    """
+    # https://www.iana.org/assignments/media-types/text/tab-separated-values
+    # The only case we fail on afaik is tab-seperated values with a value
+    # that starts with a quote. Spreadsheets seem not to escape these values.
+    # This would make sense if they'd simply never quote TSV as seems to be the
+    # "standard", but they *do* use quotes when the value has tabs or newlines :'(
+    # In our own exports, we don't allow tabs or newlines, nor quotes at the start,
+    # so we should be fine with our own data.
+    global RawJS
+    parts = []
+    RawJS(
+        """
+    var mode = 0; // 0: between fields, 1: unescaped, 2: escaped
+    var sepcode = sep.charCodeAt(0);
+    var lastsplit = i;
+    i -= 1;
+    while (i < s.length - 1) {
+        i += 1;
+        var cc = s.charCodeAt(i);
+        if (mode == 0) {
+            if (cc == 34) { // quote
+                mode = 2;
+            } else if (cc == sepcode) { // empty value
+                parts.push("");
+                lastsplit = i + 1;
+            } else if (cc == 9 || cc == 32 || cc == 13) {
+                // ignore whitespace
+            } else if (cc == 10) {
+                break;  // next line
+            } else {
+                mode = 1; // unescaped value
+            }
+        } else if (mode == 1) {
+            if (cc == sepcode) {
+                parts.push(s.slice(lastsplit, i).trim());
+                lastsplit = i + 1;
+                mode = 0;
+            } else if (cc == 10) {
+                mode = 0;
+                break;  // next line
+            }
+        } else { // if (mode == 2)
+            if (cc == 34) { // end of escape, unless next char is also a quote
+                if (i < s.length - 1 && s.charCodeAt(i + 1) == 34) {
+                    i += 1; // Skip over second quote
+                } else {
+                    mode = 1;
+                }
+            }
+        }
+    }
+    i += 1;
+    parts.push(s.slice(lastsplit, i).trim());
+    // Remove escape-quotes
+    for (var j=0; j<parts.length; j++) {
+        var val = parts[j];
+        if (val.length > 0 && val[0] == '"' && val[val.length-1] == '"') {
+            parts[j] = val.slice(1, val.length-1).replace('""', '"');
+        }
+    }
+    """
+    )
+    return parts, i
+
+
+# Mapping of record fields to the header names that we recognize for it
+HEADER_NAMES = {
+    "key": ["id", "identifier"],
+    "projectkey": ["project key", "project id"],
+    "projectname": ["project", "pr", "proj", "project name"],
+    "tags": ["tags", "tag"],
+    "t1": ["start", "begin", "start time", "begin time"],
+    "t2": ["stop", "end", "stop time", "end time"],
+    "description": ["summary", "comment", "title", "ds"],
+    "projectpath": ["project path"],
+    "date": [],
+    "duration": [
+        "duration h:m",
+        "duration h:m:s",
+        "duration hh:mm",
+        "duration hh:mm:ss",
+    ],
+}
+
+
+class ImportParser:
+    """Parser to turn table data into records. First call parse_header(),
+    then parse_rows() for each chunk of text. Both methods report via the
+    given log function, and return None on failure.
+    """
+
+    def __init__(self):
+        self._records = stores.RecordStore(None)  # to create and validate records
+        self.sep = ""
+        self.headerparts = []  # column index -> field name or None
+        self.row = 0
+
+    def parse_header(self, header, log):
+        """Parse the header (the first line) to obtain the separator and
+        column names. Returns True if the data can be imported.
+        """
+        # Parse header to get sepator
+        sep, sepname, sepcount = "", "", 0
+        for x, name in [("\t", "tab"), (",", "comma"), (";", "semicolon")]:
+            if header.count(x) > sepcount:
+                sep, sepname, sepcount = x, name, header.count(x)
+        if not header:
+            log("No data")
+            return None
+        elif not sepcount or not sep:
+            log("Could not determine separator (tried tab, comma, semicolon)")
+            return None
+        else:
+            log("Looks like the separator is " + sepname)
+
+        # Get mapping to parse header names
+        namemap = {}
+        for key, options in HEADER_NAMES.items():
+            namemap[key] = key
+            for x in options:
+                namemap[x] = key
+
+        # Parse header to get names
+        headerparts1 = csvsplit(header, sep)[0]
+        headerparts2 = []
+        headerparts_unknown = []
+        for name in headerparts1:
+            name = name.lower().replace("-", " ").replace("_", " ")
+            if name in namemap:
+                headerparts2.append(namemap[name])
+            elif not name:
+                headerparts2.append(None)
+            else:
+                headerparts_unknown.append(name)
+                headerparts2.append(None)
+        while headerparts2 and headerparts2[-1] is None:
+            headerparts2.pop(-1)
+        if headerparts_unknown:
+            log("Ignoring some headers: " + headerparts_unknown.join(", "))
+        else:
+            log("All headers names recognized")
+
+        # All required names headers present?
+        if "t1" not in headerparts2:
+            log("Missing required header for start time.")
+            return None
+        elif "t2" not in headerparts2 and "duration" not in headerparts2:
+            log("Missing required header for stop time or duration.")
+            return None
+
+        self.sep = sep
+        self.headerparts = headerparts2
+        return True
+
+    def parse_rows(self, text, is_last, log):
+        """Parse the rows in the given text. Unless is_last is True, the
+        last row may be incomplete; it is then left unparsed. Returns
+        (records, keys, index), where keys holds the key given in the data
+        for each record (or None), and index is where parsing stopped.
+        """
+        records = []
+        keys = []
+        index = 0
+        while index < len(text):
+            lineparts, index2 = csvsplit(text, self.sep, index)
+            if index2 >= len(text) and not is_last:
+                break  # the row may continue in the next chunk
+            index = index2
+            self.row += 1
+            if len("".join(lineparts).trim()) == 0:
+                continue  # skip empty rows
+            try:
+                record, record_key = self._parse_row(lineparts)
+            except Exception as err:
+                log(f"Error at row {self.row}: {err}")
+                return None
+            # Validate record
+            if record.t1 == 0 or record.t2 == 0:
+                log(f"Item on row {self.row} has invalid start/stop times")
+                return None
+            if len(self._records._validate_items([record])) == 0:
+                log(
+                    f"Item on row {self.row} does not pass validation: "
+                    + JSON.stringify(record)
+                )
+                return None
+            record.t2 = max(record.t2, record.t1 + 1)  # no running records
+            records.append(record)
+            keys.append(record_key)
+        return records, keys, index
+
+    def _parse_row(self, lineparts):
+        headerparts2 = self.headerparts
+        year_past_epoch = 31536000  # So we can test that a timestamp is not a hh.mm
+        # Build raw object
+        raw = {}
+        for j in range(min(len(lineparts), len(headerparts2))):
+            key = headerparts2[j]
+            if key is not None:
+                raw[key] = lineparts[j].strip()
+        raw.more = lineparts[len(headerparts2) :]
+        # Build record
+        record = self._records.create(0, 0)
+        record_key = None
+        if raw.key:
+            record_key = raw.key  # dont store at record yet
+        if raw.date:
+            # Prep date. Support both dd-mm-yyyy and yyy-mm-dd
+            date = raw.date.replace(".", "-")  # Some tools use dots
+            if len(date) == 10 and date.count("-") == 2:
+                if len(date.split("-")[-1]) == 4:
+                    date = "-".join(reversed(date.split("-")))
+                raw.date_ok = date
+        if True:  # raw.t1 always exists
+            record.t1 = float(raw.t1)
+            if not (isFinite(record.t1) and record.t1 > year_past_epoch):
+                record.t1 = Date(raw.t1).getTime() / 1000
+            if not isFinite(record.t1) and raw.date_ok:
+                # Try use date, Yast uses dots, reverse if needed
+                tme = raw.t1.replace(".", ":")
+                if 4 <= len(tme) <= 8 and 1 <= tme.count(":") <= 2:
+                    # Note: on IOS, Date needs to be "yyyy-mm-ddThh:mm:ss"
+                    # but people are unlikely to import on an ios device ... I hope.
+                    record.t1 = Date(raw.date_ok + " " + tme).getTime() / 1000
+            record.t1 = Math.floor(record.t1)
+        if True:  # raw.t2 or duration exists -
+            record.t2 = float(raw.t2)
+            if not (isFinite(record.t2) and record.t2 > year_past_epoch):
+                record.t2 = Date(raw.t2).getTime() / 1000
+            if not isFinite(record.t2) and raw.duration:
+                # Try use duration
+                duration = float(raw.duration)
+                if ":" in raw.duration:
+                    duration_parts = raw.duration.split(":")
+                    if len(duration_parts) == 2:
+                        duration = float(duration_parts[0]) * 3600
+                        duration += float(duration_parts[1]) * 60
+                    elif len(duration_parts) == 3:
+                        duration = float(duration_parts[0]) * 3600
+                        duration += float(duration_parts[1]) * 60
+                        duration += float(duration_parts[2])
+                record.t2 = record.t1 + float(duration)
+            if not isFinite(record.t2) and raw.date_ok:
+                # Try use date
+                tme = raw.t2.replace(".", ":")
+                if 4 <= len(tme) <= 8 and 1 <= tme.count(":") <= 2:
+                    record.t2 = Date(raw.date_ok + " " + tme).getTime() / 1000
+            record.t2 = Math.ceil(record.t2)
+        if raw.tags:  # If tags are given, use that
+            raw_tags = raw.tags.replace(",", " ").split()
+            tags = []
+            for tag in raw_tags:
+                tag = utils.convert_text_to_valid_tag(tag.trim())
+                if len(tag) > 2:
+                    tags.push(tag)
+        else:  # If no tags are given, try to derive tags from project name
+            project_name = raw.projectname or raw.projectkey or ""
+            if raw.projectpath:
+                project_parts = [raw.projectpath]
+                if raw.more and headerparts2[-1] == "projectpath":  # Yast
+                    project_parts = [raw.projectpath.replace("/", " | ")]
+                    for j in range(len(raw.more)):
+                        if len(raw.more[j]) > 0:
+                            project_parts.append(raw.more[j].replace("/", " | "))
+                project_parts.append(raw.projectname.replace("/", " | "))
+                project_name = "/".join(project_parts)
+            project_name = to_str(project_name)  # normalize
+            tags = []
+            if project_name:
+                tags = [utils.convert_text_to_valid_tag(project_name)]
+        if True:
+            tags_dict = {}
+            for tag in tags:
+                tags_dict[tag] = tag
+            if raw.description:
+                tags, parts = utils.get_tags_and_parts_from_string(raw.description)
+                for tag in tags:
+                    tags_dict.pop(tag, None)
+                tagz = " ".join(tags_dict.values())
+                record.ds = to_str(tagz + " " + raw.description)
+            else:
+                tagz = " ".join(tags_dict.values())
+                record.ds = tagz
+        return record, record_key
@@ -66,6 +66,9 @@ if this_is_js():  # pragma: no cover
     def to_jsonable(x):
         return x
 
+    def _freeze(record):
+        return window.Object.freeze(record)
+
 else:
     from random import random
     from . import dt
@@ -114,8 +117,27 @@ else:
             d.update(kwargs)
             return d
 
+    class _frozen_dict(dict):
+        """A read-only dict, to detect in-place changes of stored records."""
+
+        __slots__ = []
+
+        def _readonly(self, *args, **kwargs):
+            raise TypeError("This record is read-only, make a copy to modify it.")
 
-_min_heap_bin_size = 2**17  # about 1.5 day
+        __setitem__ = __delitem__ = __setattr__ = _readonly
+        pop = popitem = clear = update = setdefault = _readonly
+
+    def _freeze(record):
+        return _frozen_dict(record)
+
+
+# The size of the leaf bins of the record pyramid. It starts at the default,
+# and is adapted to the density of the records as the store grows.
+_default_heap_bin_size = 2**17  # about 1.5 day
+_min_heap_bin_size = 2**12  # about 1 hour
+_max_heap_bin_size = 2**22  # about 7 weeks
+_heap_bin_target_count = 32  # preferred number of records per leaf bin
 
 
 # At the client:
@@ -163,6 +185,21 @@ def generate_uid():
         return "".join([chars[int(random() * nchars)] for i in range(n)])
 
 
+def _bisect(index, t):
+    """Get the position of the first [t, key] pair in a sorted index that
+    has a time >= t.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    lo, hi = 0, len(index)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if index[mid][0] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
 def is_hidden(item):
     """Get whether the given item is hidden."""
     return item.get("ds", "").startswith("HIDDEN")
@@ -173,6 +210,91 @@ def make_hidden(item):
     item.ds = "HIDDEN " + item.get("ds", "").split("HIDDEN")[-1].strip()
 
 
+class TextIndex:
+    """An index to find the keys of items whose text contains certain words.
+    A word matches like ``word in text.lower()``, so it can be part of a
+    longer word. A word without spaces can only occur inside one of the
+    space-separated tokens of a text, so we index the tokens, and search the
+    (much smaller) set of unique tokens for the words.
+    """
+
+    def __init__(self):
+        self._key2tokens = {}  # key -> list of unique tokens
+        self._token2keys = {}  # token -> dict of keys (a set)
+        self._token_counts = {}  # token -> number of keys
+
+    def put(self, key, text):
+        """Set the text for the given key, replacing its previous text."""
+        self.remove(key)
+        tokens = {}
+        for token in text.lower().split(" "):
+            if token:
+                tokens[token] = True
+        tokens = list(tokens.keys())
+        self._key2tokens[key] = tokens
+        for token in tokens:
+            keys = self._token2keys.get(token, None)
+            if keys is None:
+                keys = {}
+                self._token2keys[token] = keys
+                self._token_counts[token] = 0
+            keys[key] = True
+            self._token_counts[token] += 1
+
+    def remove(self, key):
+        """Remove the given key from the index."""
+        tokens = self._key2tokens.pop(key, None)
+        if tokens is None:
+            return
+        for token in tokens:
+            self._token2keys[token].pop(key)
+            self._token_counts[token] -= 1
+            if self._token_counts[token] == 0:
+                self._token2keys.pop(token)
+                self._token_counts.pop(token)
+
+    def get_keys(self, words):
+        """Get a list of the keys for which the text contains all of the
+        given words (case insensitive).
+        """
+        if len(words) == 0:
+            return []
+
+        # Get the matching tokens for each word
+        matches = []  # list of [count, word, tokens]
+        for word in words:
+            word = word.lower()
+            tokens = []
+            count = 0
+            for token in self._token2keys.keys():
+                if word in token:
+                    tokens.append(token)
+                    count += self._token_counts[token]
+            if count == 0:
+                return []
+            matches.append([count, word, tokens])
+        matches.sort(key=lambda m: m[0])
+
+        # Collect the keys for the most selective word ...
+        keys = {}
+        for token in matches[0][2]:
+            for key in self._token2keys[token].keys():
+                keys[key] = True
+        keys = list(keys.keys())
+
+        # ... and check the other words for just these keys
+        for i in range(1, len(matches)):
+            word = matches[i][1]
+            keys2 = []
+            for key in keys:
+                for token in self._key2tokens[key]:
+                    if word in token:
+                        keys2.append(key)
+                        break
+            keys = keys2
+        return keys
+
+
 # %% Sub stores
 
 
@@ -187,18 +309,33 @@ class BaseStore:
         is made to avoid accidentally in-place changes, and records
         can be normalized and even dropped if invalid.
         """
-        # Mark as modified
+        self.put_many(items)
+
+    def put_many(self, items):
+        """Like put(), but takes a list of items. Each item is marked
+        as modified, validated, filtered and normalized in a single pass.
+        The resulting items are then stored, and queued for syncing, at once.
+        Use this for mass edits.
+        """
+        spec = SPECS[self.store_type]
+        req = REQS[self.store_type]
+        mt = int(dt.now())
+        items2 = []
         for i in range(len(items)):
             item = items[i]
+            # Mark as modified
             item.st = 0
-            item.mt = int(dt.now())
-        # Do validation and drops corrupt items
-        items = self._validate_items(items)
-        items = self._filter_outdated(items)
-        items = self._normalize_more(items)
+            item.mt = mt
+            # Validate (and copy), drop corrupt and outdated items
+            item = self._validate_item(item, spec, req)
+            if item is None or self._is_outdated(item):
+                continue
+            items2.append(self._normalize_item(item))
+        if len(items2) == 0:
+            return
         # Actually store and send to main store to sync with server
-        self._put(*items)
-        self._datastore._put(self.store_type, *items)
+        self._put(*items2)
+        self._datastore._put(self.store_type, *items2)
 
     def _put_received(self, *items):
         """Called by the main store to put items received from the server.
@@ -218,55 +355,57 @@ class BaseStore:
         req = REQS[self.store_type]
 
         items2 = []  # filtered
-
-        identity = lambda x: x
         for i in range(len(items)):
-            item = items[i]
-            try:
-                # Check that all required keys are present
-                keys = item.keys()
-                for key in req:
-                    if key not in keys:
-                        raise ValueError(f"Missing key {key}")
-                # Check keys that we know
-                item2 = dict()
-                for key, val in item.items():
-                    normfunc = spec.get(key, identity)
-                    item2[key] = normfunc(val)  # Can raise
-            except Exception as err:
-                print("Item dropped: " + str(err))  # not console.warn because Py
-                continue
-
-            items2.append(item2)
-
+            item = self._validate_item(items[i], spec, req)
+            if item is not None:
+                items2.append(item)
         return items2
 
+    def _validate_item(self, item, spec, req):
+        """Validate an item and return a normalized copy, or None if invalid."""
+        identity = lambda x: x
+        try:
+            # Check that all required keys are present
+            keys = item.keys()
+            for key in req:
+                if key not in keys:
+                    raise ValueError(f"Missing key {key}")
+            # Check keys that we know
+            item2 = dict()
+            for key, val in item.items():
+                normfunc = spec.get(key, identity)
+                item2[key] = normfunc(val)  # Can raise
+        except Exception as err:
+            print("Item dropped: " + str(err))  # not console.warn because Py
+            return None
+        return item2
+
     def _filter_outdated(self, items):
         items2 = []  # filtered
+        for i in range(len(items)):
+            if not self._is_outdated(items[i]):
+                items2.append(items[i])
+        return items2
 
+    def _is_outdated(self, new_item):
+        """Get whether the given item is older than the one in the store."""
         # It's crucial for this code to match-up with the server logic to
         # keep correctly synchronized.
-
-        for i in range(len(items)):
-            new_item = items[i]
-            cur_item = self._items.get(new_item.key, None)
-            if cur_item is None:
-                # An actual new item
-                items2.append(new_item)
-            elif new_item.st > 0 and cur_item.st > 0:
-                # Both items come from the server. Use what the server does.
-                # Note that the server guarantees unique st's (between
-                # different versions of an item)
-                if new_item.st > cur_item.st:
-                    items2.append(new_item)
-            elif new_item.mt >= cur_item.mt:
-                # Cases include:
-                # - we update an item that was updated less than a sec ago
-                # - the item that we send to server gets back (with new st)
-                # - we get an item from the server that was updated at same mt.
-                items2.append(new_item)
-
-        return items2
+        cur_item = self._items.get(new_item.key, None)
+        if cur_item is None:
+            # An actual new item
+            return False
+        elif new_item.st > 0 and cur_item.st > 0:
+            # Both items come from the server. Use what the server does.
+            # Note that the server guarantees unique st's (between
+            # different versions of an item)
+            return not (new_item.st > cur_item.st)
+        else:
+            # Cases include:
+            # - we update an item that was updated less than a sec ago
+            # - the item that we send to server gets back (with new st)
+            # - we get an item from the server that was updated at same mt.
+            return not (new_item.mt >= cur_item.mt)
 
     def get_by_key(self, key):
         """Get (a copy of) an item given its key, or None."""
@@ -275,11 +414,23 @@ class BaseStore:
             item = item.copy()
         return item
 
+    def get_by_key_readonly(self, key):
+        """Get an item given its key, or None. This is not a copy,
+        so it must not be modified.
+        """
+        return self._items.get(key, None)
+
     def _normalize_more(self, items):
+        """Apply _normalize_item() to a list of items."""
+        for i in range(len(items)):
+            items[i] = self._normalize_item(items[i])
+        return items
+
+    def _normalize_item(self, item):
         """Subclasses CAN implement this do additional normalization.
         Don't drop items here!
         """
-        return items
+        return item
 
     def _put(self, *items):
         """Subclasses MUST implement this."""
@@ -302,6 +453,7 @@ class SettingsStore(BaseStore):
     def __init__(self, datastore):
         self._datastore = datastore  # This object will handle sync and storage
         self._items = {}  # key -> setting
+        self._version = 0  # Bumped on each change, to invalidate caches
 
     def create(self, key, value):
         """Create a new setting from a key and value. Does not put it in the store."""
@@ -309,9 +461,11 @@ class SettingsStore(BaseStore):
 
     def _drop(self, key):
         # Called by datastore to discard items that were not accepted by the server
+        self._version += 1
         self._items.pop(key, None)
 
     def _put(self, *settings):
+        self._version += 1
         for item in settings:
             self._items[item.key] = item
 
@@ -378,6 +532,14 @@ class RecordStore(BaseStore):
 
     store_type = "records"
 
+    # The read-only methods return the stored records themselves. Set this
+    # to True (e.g. during development) to freeze the stored records, so
+    # that modifying them raises an error.
+    freeze_records = False
+
+    # Whether to adapt the size of the leaf bins to the density of the records.
+    adaptive_bin_size = True
+
     def __init__(self, datastore):
         self._datastore = datastore
         self.put_count = 0  # Handy to detect new users
@@ -385,6 +547,16 @@ class RecordStore(BaseStore):
         self._running_records = {}  # Should be 0, 1, or occasionally maybe a few.
         self._heap = [{}]  # list of layers, each layer is binNr -> stats
         self._heap0_bin2record_keys = {}  # binNr -> dict-of-record-keys (i.e. a set)
+        self._bin_size = _default_heap_bin_size  # size of the bins in layer 0
+        self._bin_size_check_count = 256  # put_count at which to check the bin size
+        self._version = 0  # Bumped on each change, to invalidate caches
+        self._stats_lru = {}  # "t1 t2" -> [version, stats], without running records
+        self._sorted_index = {}  # "t1"/"t2" -> sorted list of [t, key], built lazily
+        self._sorted_max_duration = 0  # Upper bound for t2 - t1 of indexed records
+        self._tag_keys = {}  # tag -> dict of record keys (a set), None to rebuild
+        self._tag_counts = {}  # tag -> number of records with that tag
+        self._tag_t2 = {}  # tag -> most recent t2 of its records, added lazily
+        self._text_index = TextIndex()  # for the descriptions, None to rebuild
 
     def create(self, t1, t2, ds=""):
         """Create a new record from t1, t2 and maybe ds.
@@ -412,13 +584,11 @@ class RecordStore(BaseStore):
         else:
             return tags
 
-    def _normalize_more(self, items):
+    def _normalize_item(self, item):
         """Ensure that t1 <= t2"""
-        for i in range(len(items)):
-            item = items[i]
-            item.t1 = min(item.t1, item.t2)
-            item.t2 = max(item.t1, item.t2)
-        return items
+        item.t1 = min(item.t1, item.t2)
+        item.t2 = max(item.t1, item.t2)
+        return item
 
     def _drop(self, key):
         # Called by datastore to discard items that were not accepted by the server
@@ -426,12 +596,16 @@ class RecordStore(BaseStore):
         cur_record = self._items.get(key, None)
 
         if cur_record is not None:
+            self._version += 1
             self._running_records.pop(key, None)
             self._items.pop(key, None)
+            self._update_sorted_index(cur_record, None)
+            self._update_tag_index(cur_record, None)
+            self._update_text_index(cur_record, None)
             changed_bins = {}  # Poor mans's set
             bin2record_keys = self._heap0_bin2record_keys
-            nr1 = cur_record.t1 // _min_heap_bin_size
-            nr2 = cur_record.t2 // _min_heap_bin_size
+            nr1 = cur_record.t1 // self._bin_size
+            nr2 = cur_record.t2 // self._bin_size
             for nr in range(nr1, nr2 + 1):
                 changed_bins[nr] = True
                 bin2record_keys[nr].pop(key)
@@ -442,24 +616,46 @@ class RecordStore(BaseStore):
         PSCRIPT_OVERLOAD = False  # noqa
 
         # Init
+        self._version += 1
         changed_bins = {}  # Poor mans's set
         bin2record_keys = self._heap0_bin2record_keys
+        if len(records) > 64:
+            self._sorted_index = {}  # Cheaper to rebuild when needed
+            self._tag_keys = None
+            self._text_index = None
+
+        # Check the bin size every time the number of puts has doubled.
+        # For a large batch, use the batch itself, before it's added.
+        check_bin_size = False
+        if self.put_count + len(records) >= self._bin_size_check_count:
+            self._bin_size_check_count = 2 * (self.put_count + len(records))
+            if self.adaptive_bin_size:
+                check_bin_size = True
+                if len(records) > self.put_count:
+                    self._check_bin_size(records)
+                    check_bin_size = False
+                    bin2record_keys = self._heap0_bin2record_keys
 
         # Add each record ...
         # We already know that the new record must overwrite the old
         for i in range(len(records)):
             new_record = records[i]
+            if self.freeze_records:
+                new_record = _freeze(new_record)
             key = new_record.key
             cur_record = self._items.get(key, None)
 
             # Store the record in our flat dict
             self._items[key] = new_record
             self.put_count += 1
+            self._update_sorted_index(cur_record, new_record)
+            self._update_tag_index(cur_record, new_record)
+            self._update_text_index(cur_record, new_record)
 
             # Remove cur_record from bins in layer 0
             if cur_record is not None:
-                nr1 = cur_record.t1 // _min_heap_bin_size
-                nr2 = cur_record.t2 // _min_heap_bin_size
+                nr1 = cur_record.t1 // self._bin_size
+                nr2 = cur_record.t2 // self._bin_size
                 for nr in range(nr1, nr2 + 1):
                     if bin2record_keys.get(nr, None) is not None:
                         bin2record_keys[nr].pop(key, None)
@@ -470,8 +666,8 @@ class RecordStore(BaseStore):
             # Hidden records are not put in the heap. That way they consume
             # space but not performance.
             if new_record is not None and not is_hidden(new_record):
-                nr1 = new_record.t1 // _min_heap_bin_size
-                nr2 = new_record.t2 // _min_heap_bin_size
+                nr1 = new_record.t1 // self._bin_size
+                nr2 = new_record.t2 // self._bin_size
                 for nr in range(nr1, nr2 + 1):
                     changed_bins[nr] = True
                     if bin2record_keys.get(nr, None) is None:
@@ -483,6 +679,179 @@ class RecordStore(BaseStore):
         # Bubble the changes up the heap
         self._update_bins(0, changed_bins)
 
+        # Check the bin size of large stores after adding the records
+        if check_bin_size:
+            self._check_bin_size(list(self._items.values()))
+
+    def _check_bin_size(self, records):
+        """Select a bin size for layer 0 based on the density of the given
+        records, and rebuild the pyramid if it differs from the current.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        # Get the number of bins and entries for the current bin size
+        bin_size = self._bin_size
+        bins = {}  # Poor mans's set
+        nentries = 0
+        nr_min, nr_max = 2**53, -(2**53)
+        for i in range(len(records)):
+            record = records[i]
+            if not is_hidden(record):
+                nr1 = record.t1 // bin_size
+                nr2 = record.t2 // bin_size
+                for nr in range(nr1, nr2 + 1):
+                    bins[nr] = True
+                nentries += nr2 - nr1 + 1
+                nr_min, nr_max = min(nr_min, nr1), max(nr_max, nr2)
+        nbins = len(bins.keys())
+        if nbins == 0:
+            return
+        count_per_bin = nentries / nbins  # for the bins that have records
+        count_per_sec = nentries / ((nr_max - nr_min + 1) * bin_size)
+
+        # Dense data needs smaller bins, so that updating a bin is cheap.
+        # Very sparse data can use larger bins, so that the pyramid is less
+        # deep, but not too large, because partial bins are walked per record.
+        target = _heap_bin_target_count
+        if count_per_bin > 2 * target:
+            while count_per_bin > target and bin_size > _min_heap_bin_size:
+                bin_size //= 2
+                count_per_bin /= 2
+        elif count_per_bin < target / 16:
+            while bin_size * count_per_sec < target / 8:
+                if bin_size >= _max_heap_bin_size:
+                    break
+                bin_size *= 2
+
+        if bin_size != self._bin_size:
+            self._rebuild_heap(bin_size)
+
+    def _rebuild_heap(self, bin_size):
+        """Rebuild the pyramid with the given bin size for layer 0."""
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        self._bin_size = bin_size
+        self._heap = [{}]
+        self._heap0_bin2record_keys = bin2record_keys = {}
+        changed_bins = {}
+        for key, record in self._items.items():
+            if not is_hidden(record):
+                nr1 = record.t1 // bin_size
+                nr2 = record.t2 // bin_size
+                for nr in range(nr1, nr2 + 1):
+                    changed_bins[nr] = True
+                    if bin2record_keys.get(nr, None) is None:
+                        bin2record_keys[nr] = {}
+                    bin2record_keys[nr][key] = True
+        self._update_bins(0, changed_bins)
+
+    def _update_sorted_index(self, cur_record, new_record):
+        """Update the sorted indices for a record that is replaced or removed.
+        Hidden and running records are not in these indices.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        for what, index in self._sorted_index.items():
+            # Remove the current record
+            if cur_record is not None:
+                t = cur_record[what]
+                i = _bisect(index, t)
+                while i < len(index) and index[i][0] == t:
+                    if index[i][1] == cur_record.key:
+                        index.pop(i)
+                        break
+                    i += 1
+            # Insert the new record
+            if new_record is not None:
+                if new_record.t1 < new_record.t2 and not is_hidden(new_record):
+                    t = new_record[what]
+                    index.insert(_bisect(index, t), [t, new_record.key])
+                    duration = new_record.t2 - new_record.t1
+                    if duration > self._sorted_max_duration:
+                        self._sorted_max_duration = duration
+
+    def _get_sorted_index(self, what):
+        """Get the index for "t1" or "t2", (re)building it if necessary."""
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        index = self._sorted_index.get(what, None)
+        if index is None:
+            index = []
+            max_duration = 0
+            for record in self._items.values():
+                if record.t1 < record.t2 and not is_hidden(record):
+                    index.append([record[what], record.key])
+                    max_duration = max(max_duration, record.t2 - record.t1)
+            index.sort(key=lambda x: x[0])
+            self._sorted_index[what] = index
+            self._sorted_max_duration = max_duration
+        return index
+
+    def _update_tag_index(self, cur_record, new_record):
+        """Update the tag index for a record that is replaced or removed."""
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        tag_keys = self._tag_keys
+        if tag_keys is None:
+            return  # The index is rebuilt when needed
+        tag_counts = self._tag_counts
+        tag_t2 = self._tag_t2
+
+        if cur_record is not None:
+            key = cur_record.key
+            for tag in self.tags_from_record(cur_record):
+                keys = tag_keys.get(tag, None)
+                if keys is not None and keys.pop(key, None) is not None:
+                    tag_counts[tag] -= 1
+                    if tag_counts[tag] == 0:
+                        tag_keys.pop(tag)
+                        tag_counts.pop(tag)
+                        tag_t2.pop(tag, None)
+                    elif tag_t2.get(tag, None) == cur_record.t2:
+                        tag_t2.pop(tag)  # Recalculated when needed
+
+        if new_record is not None:
+            key = new_record.key
+            for tag in self.tags_from_record(new_record):
+                keys = tag_keys.get(tag, None)
+                if keys is None:
+                    keys = {}
+                    tag_keys[tag] = keys
+                    tag_counts[tag] = 0
+                    tag_t2[tag] = new_record.t2
+                if keys.get(key, None) is None:
+                    keys[key] = True
+                    tag_counts[tag] += 1
+                    if tag_t2.get(tag, None) is not None:
+                        tag_t2[tag] = max(tag_t2[tag], new_record.t2)
+
+    def _get_tag_index(self):
+        """Get the tag index (tag -> dict of record keys), rebuilding it if needed."""
+        if self._tag_keys is None:
+            self._tag_keys, self._tag_counts, self._tag_t2 = {}, {}, {}
+            for record in self._items.values():
+                self._update_tag_index(None, record)
+        return self._tag_keys
+
+    def _update_text_index(self, cur_record, new_record):
+        """Update the text index for a record that is replaced or removed."""
+        if self._text_index is None:
+            return  # The index is rebuilt when needed
+        elif new_record is None:
+            self._text_index.remove(cur_record.key)
+        else:
+            ds = new_record.get("ds", "")
+            if cur_record is None or cur_record.get("ds", "") != ds:
+                self._text_index.put(new_record.key, ds)
+
+    def _get_text_index(self):
+        """Get the text index, rebuilding it if needed."""
+        if self._text_index is None:
+            self._text_index = TextIndex()
+            for record in self._items.values():
+                self._text_index.put(record.key, record.get("ds", ""))
+        return self._text_index
+
     def _update_bins(self, level, changed_bins):
         """Update bins of the given layer."""
         # This uses a loop to avoid eaching the recursion depth limit
@@ -501,7 +870,7 @@ class RecordStore(BaseStore):
 
         # Init
         heaplayer = self._heap[level]
-        binsize = _min_heap_bin_size * 2**level
+        binsize = self._bin_size * 2**level
         empty_bins = []
 
         # Iterate over all bins to update
@@ -567,11 +936,26 @@ class RecordStore(BaseStore):
         """Get a list of (copies of) the running records."""
         return [item.copy() for item in self._running_records.values()]
 
+    def get_running_records_readonly(self):
+        """Get a list of the running records. These are not copies,
+        so they must not be modified.
+        """
+        return list(self._running_records.values())
+
     def get_records(self, t1, t2):
         """Get the records that lay (completely or partially) in the range t1-t2.
         The returned dict contains copies, and can safely be modified. The records
         are not sorted (because the best sorting depends on the use-case).
         """
+        records = self.get_records_readonly(t1, t2)
+        for key in records.keys():
+            records[key] = records[key].copy()
+        return records
+
+    def get_records_readonly(self, t1, t2):
+        """Like get_records(), but the returned dict contains the stored
+        records rather than copies, so they must not be modified.
+        """
 
         # Prepare
         t1, t2 = dt.to_time_int(t1), dt.to_time_int(t2)
@@ -593,16 +977,12 @@ class RecordStore(BaseStore):
                 # it might already be present if t1 < record.t1 < t2
                 records[record.key] = record
 
-        # Make copies to prevent in-place mutations
-        for key in records.keys():
-            records[key] = records[key].copy()
-
         return records
 
     def _get_records(self, t1, t2, level, nr, records):
         PSCRIPT_OVERLOAD = False  # noqa
 
-        binsize = _min_heap_bin_size * 2**level
+        binsize = self._bin_size * 2**level
         bin_t1 = binsize * (nr + 0.0)
         bin_t2 = binsize * (nr + 1.0)
 
@@ -640,6 +1020,106 @@ class RecordStore(BaseStore):
                     if subheaplayer.get(sub_nr, None) is not None:
                         self._get_records(t1, t2, level - 1, sub_nr, records)
 
+    def get_records_sorted(self, t1, t2, order="t1"):
+        """Get the records that lay (completely or partially) in the range t1-t2,
+        as a list sorted by "t1", "t2", "-t1" or "-t2". Unlike get_records(),
+        this does not make copies, so the records must not be modified.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        # Prepare
+        t1, t2 = dt.to_time_int(t1), dt.to_time_int(t2)
+        what = order[-2:]
+        if what != "t1" and what != "t2":
+            raise ValueError(f"Invalid order for sorting records: {order}")
+        index = self._get_sorted_index(what)
+        if t1 > t2:
+            return []
+
+        # Select the part of the index that may overlap with the range
+        if what == "t1":
+            i1 = _bisect(index, t1 - self._sorted_max_duration)
+            i2 = _bisect(index, t2)
+        else:
+            i1 = _bisect(index, t1 + 1)
+            i2 = _bisect(index, t2 + self._sorted_max_duration)
+
+        # Collect records
+        records = []
+        for i in range(i1, i2):
+            record = self._items[index[i][1]]
+            if t2 > record.t1 and t1 < record.t2:
+                records.append(record)
+
+        # Insert running records (usually zero or one)
+        now = dt.now()
+        for record in self._running_records.values():
+            if now > t1 and record.t1 < t2:
+                i = len(records)
+                while i > 0 and records[i - 1][what] > record[what]:
+                    i -= 1
+                records.insert(i, record)
+
+        if order[0] == "-":
+            records.reverse()
+        return records
+
+    def get_keys_for_tags(self, tags):
+        """Get a list of the keys of the records that have all of the given
+        tags. Use "#untagged" to get the records without tags. Note that
+        hidden records are included.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        tag_keys = self._get_tag_index()
+        if len(tags) == 0:
+            return []
+        for tag in tags:
+            if tag_keys.get(tag, None) is None:
+                return []
+
+        # Iterate over the smallest set, and check the others
+        smallest = tags[0]
+        for tag in tags:
+            if self._tag_counts[tag] < self._tag_counts[smallest]:
+                smallest = tag
+        result = []
+        for key in tag_keys[smallest].keys():
+            all_ok = True
+            for tag in tags:
+                if tag_keys[tag].get(key, None) is None:
+                    all_ok = False
+                    break
+            if all_ok:
+                result.append(key)
+        return result
+
+    def get_keys_for_words(self, words):
+        """Get a list of the keys of the records whose description contains
+        all of the given words (case insensitive). Note that hidden records
+        are included.
+        """
+        return self._get_text_index().get_keys(words)
+
+    def get_tags_last_used(self):
+        """Get a dict that maps each tag that is in use to the most recent
+        t2 of its records. Includes "#untagged" and tags of hidden records.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        tag_keys = self._get_tag_index()
+        tag_t2 = self._tag_t2
+        result = {}
+        for tag in tag_keys.keys():
+            t2 = tag_t2.get(tag, None)
+            if t2 is None:
+                t2 = 0
+                for key in tag_keys[tag].keys():
+                    t2 = max(t2, self._items[key].t2)
+                tag_t2[tag] = t2
+            result[tag] = t2
+        return result
+
     def get_stats(self, t1, t2):
         """Get the aggregate stats for the time range t1-t2. Returns a dict
         mapping tags to time in seconds.
@@ -654,9 +1134,17 @@ class RecordStore(BaseStore):
             return {}
         nr = int(nrs[0])
 
-        # Collect stats
-        stats = {}
-        self._get_stats(t1, t2, level, nr, stats)
+        # Collect stats. The result of the tree walk only changes when
+        # the store changes, so we cache it. The running records are
+        # added afterwards, since they depend on the current time.
+        qkey = f"{t1} {t2}"
+        entry = self._stats_lru.get(qkey, None)
+        if entry is None or entry[0] != self._version:
+            stats = {}
+            self._get_stats(t1, t2, level, nr, stats)
+            entry = [self._version, stats]
+        self._lru_set(self._stats_lru, qkey, entry, 16)
+        stats = entry[1].copy()
 
         # Post-processing
         now = dt.now()
@@ -670,7 +1158,7 @@ class RecordStore(BaseStore):
     def _get_stats(self, t1, t2, level, nr, stats):
         PSCRIPT_OVERLOAD = False  # noqa
 
-        binsize = _min_heap_bin_size * 2**level
+        binsize = self._bin_size * 2**level
         bin_t1 = binsize * (nr + 0.0)
         bin_t2 = binsize * (nr + 1.0)
 
@@ -701,6 +1189,217 @@ class RecordStore(BaseStore):
                     if subheaplayer.get(sub_nr, None) is not None:
                         self._get_stats(t1, t2, level - 1, sub_nr, stats)
 
+    async def prefetch(self, t1, t2):
+        """Make sure that get_stats() gives an exact result for the given
+        range. This store can always do that.
+        """
+        pass
+
+    def _lru_set(self, cache, key, value, maxsize):
+        """Set an entry in a dict used as an LRU cache."""
+        cache.pop(key, None)
+        cache[key] = value  # the most recently used key is last
+        keys = list(cache.keys())
+        if len(keys) > maxsize:
+            cache.pop(keys[0])
+
+
+class RecordStoreProxy(RecordStore):
+    """A record store that keeps the bin pyramid in a Web Worker (see
+    stores_worker.js), so that updating the pyramid and calculating stats
+    do not block drawing. The records themselves (and the sorted indices)
+    are also kept here, so that getting records remains synchronous. Stats
+    are served from a cache. On a miss, the last result for the same range
+    (or an empty result) is returned while the worker calculates the real
+    one, after which the canvas is redrawn. If the worker fails, the stats
+    are calculated in this thread instead.
+    """
+
+    def __init__(self, datastore):
+        super().__init__(datastore)
+        self._stats_cache = {}  # "t1 t2" -> [version, time, t1, t2, stats]
+        self._stats_pending = {}  # Poor mans's set
+        self._stats_waiters = []  # list of [qkey, resolve]
+        self._fallback = None  # a RecordStore, if the worker failed
+        self._worker = window.Worker("stores_worker.js")
+        self._worker.onmessage = self._on_worker_message
+        self._worker.onerror = self._on_worker_error
+        self._worker.onmessageerror = self._on_worker_error
+
+    def close(self):
+        """Stop the worker."""
+        self._worker.terminate()
+
+    def _post(self, msg):
+        if self._fallback is None:
+            self._worker.postMessage(msg)
+        elif msg.type == "put":
+            self._fallback._put(*msg.records)
+        elif msg.type == "drop":
+            self._fallback._drop(msg.key)
+
+    def _drop(self, key):
+        # Called by datastore to discard items that were not accepted by the server
+        cur_record = self._items.get(key, None)
+        if cur_record is not None:
+            self._running_records.pop(key, None)
+            self._items.pop(key, None)
+            self._update_sorted_index(cur_record, None)
+            self._update_tag_index(cur_record, None)
+            self._update_text_index(cur_record, None)
+            self._version += 1
+            self._post({"type": "drop", "key": key})
+
+    def _put(self, *records):
+        """Push records (or record mutations) into the store."""
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        if len(records) > 64:
+            self._sorted_index = {}  # Cheaper to rebuild when needed
+            self._tag_keys = None
+            self._text_index = None
+
+        for i in range(len(records)):
+            record = records[i]
+            if self.freeze_records:
+                record = _freeze(record)
+            cur_record = self._items.get(record.key, None)
+            self._items[record.key] = record
+            self.put_count += 1
+            self._update_sorted_index(cur_record, record)
+            self._update_tag_index(cur_record, record)
+            self._update_text_index(cur_record, record)
+            self._running_records.pop(record.key, None)
+            if record.t1 == record.t2 and not is_hidden(record):
+                self._running_records[record.key] = record
+
+        self._version += 1
+        self._post({"type": "put", "records": records})
+
+    def get_records_readonly(self, t1, t2):
+        """Like get_records(), but the returned dict contains the stored
+        records rather than copies, so they must not be modified. The
+        pyramid lives in the worker, so this uses the sorted index instead.
+        """
+        records = {}
+        for record in self.get_records_sorted(t1, t2):
+            records[record.key] = record
+        return records
+
+    def get_stats(self, t1, t2):
+        """Get the aggregate stats for the time range t1-t2. Returns a dict
+        mapping tags to time in seconds. The result may be outdated for
+        a short moment; use prefetch() if that matters.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        if self._fallback is not None:
+            return self._fallback.get_stats(t1, t2)
+
+        t1, t2 = dt.to_time_int(t1), dt.to_time_int(t2)
+        qkey = f"{t1} {t2}"
+        if t1 > t2:
+            return {}
+
+        if not self._stats_is_fresh(qkey):
+            self._request_stats(qkey, t1, t2)
+
+        # Use the last result for this range, if any. Results for other
+        # ranges would give wrong totals, so we rather show nothing until
+        # the worker replies.
+        entry = self._stats_cache.get(qkey, None)
+        if entry is None:
+            return {}
+        return entry[4].copy()
+
+    async def prefetch(self, t1, t2):
+        """Make sure that get_stats() gives an exact result for the given
+        range, by waiting for the worker to calculate it.
+        """
+        t1, t2 = dt.to_time_int(t1), dt.to_time_int(t2)
+        qkey = f"{t1} {t2}"
+        if t1 > t2 or self._fallback is not None or self._stats_is_fresh(qkey):
+            return
+
+        def executor(resolve):
+            self._stats_waiters.append([qkey, resolve])
+
+        promise = window.Promise(executor)
+        self._request_stats(qkey, t1, t2)
+        await promise
+
+    def _stats_is_fresh(self, qkey):
+        entry = self._stats_cache.get(qkey, None)
+        if entry is None or entry[0] != self._version:
+            return False
+        elif len(self._running_records.keys()) > 0:
+            return dt.now() - entry[1] < 1  # running records grow
+        return True
+
+    def _request_stats(self, qkey, t1, t2):
+        if not self._stats_pending.get(qkey, False):
+            self._stats_pending[qkey] = True
+            msg = {
+                "type": "stats",
+                "key": qkey,
+                "t1": t1,
+                "t2": t2,
+                "version": self._version,
+                "time": dt.now(),
+            }
+            self._worker.postMessage(msg)
+
+    def _on_worker_message(self, event):
+        msg = event.data
+        qkey = msg.key
+        self._stats_pending.pop(qkey, None)
+        prev_entry = self._stats_cache.get(qkey, None)
+        entry = [msg.version, msg.time, msg.t1, msg.t2, msg.result]
+        self._lru_set(self._stats_cache, qkey, entry, 32)
+        # Request again if the store has changed meanwhile, otherwise
+        # resolve the waiters, and redraw if the result has changed.
+        if msg.version != self._version:
+            self._request_stats(qkey, msg.t1, msg.t2)
+            return
+        if self._stats_is_fresh(qkey):
+            waiters = self._stats_waiters
+            self._stats_waiters = []
+            for waiter in waiters:
+                if waiter[0] == qkey:
+                    waiter[1]()
+                else:
+                    self._stats_waiters.append(waiter)
+        if prev_entry is None or not _stats_equal(prev_entry[4], msg.result):
+            if window.canvas:
+                window.canvas.update()
+
+    def _on_worker_error(self, event):
+        # E.g. the worker script failed to load. Build the pyramid here
+        # and calculate the stats in this thread from now on.
+        console.warn("Record worker failed, using main thread: " + event.message)
+        self._worker.terminate()
+        if self._fallback is not None:
+            return
+        self._fallback = RecordStore(self._datastore)
+        self._fallback._put(*self._items.values())
+        self._stats_pending = {}
+        waiters = self._stats_waiters
+        self._stats_waiters = []
+        for waiter in waiters:
+            waiter[1]()
+        if window.canvas:
+            window.canvas.update()
+
+
+def _stats_equal(stats1, stats2):
+    """Get whether two stats dicts are equal."""
+    if len(stats1.keys()) != len(stats2.keys()):
+        return False
+    for tagz, t in stats1.items():
+        if stats2.get(tagz, None) != t:
+            return False
+    return True
+
 
 # %% Main stores
 
@@ -730,7 +1429,15 @@ class BaseDataStore:
     def reset(self):
         # The sub stores
         self.settings = SettingsStore(self)
-        self.records = RecordStore(self)
+        if this_is_js():
+            if self.records and self.records.close:
+                self.records.close()  # stop the worker
+            if window.Worker and window.simplesettings.get("record_worker"):
+                self.records = RecordStoreProxy(self)
+            else:
+                self.records = RecordStore(self)
+        else:
+            self.records = RecordStore(self)
         # State that can be draw
         self.sync_time = 0, 0
         self.state = ""  # pending, sync, warning, error, ""
@@ -797,6 +1504,7 @@ class ConnectedDataStore(BaseDataStore):
         self._server_time = 0
         self._last_auth_get = 0
         self._pull_statuses = [0, 0, 0, 0, 0]
+        self._compress_pushes = True
         self._auth = window.tools.get_auth_info()
         self._auth_cantuse = None
 
@@ -898,13 +1606,24 @@ class ConnectedDataStore(BaseDataStore):
             return
         self._to_push[kind] = {}
 
+        # Compress large bodies, if the browser can and the server did not
+        # refuse it before. This helps e.g. imports on slow connections.
+        body = JSON.stringify(items.values())
+        headers = {"authtoken": authtoken}
+        compressed = False
+        if self._compress_pushes and len(body) > 16384 and window.CompressionStream:
+            try:
+                stream = window.Blob([body]).stream()
+                stream = stream.pipeThrough(window.CompressionStream("gzip"))
+                body = await window.Response(stream).arrayBuffer()
+                headers["content-encoding"] = "gzip"
+                compressed = True
+            except Exception as err:
+                console.warn(err)
+
         # Fetch and wait for response
         url = tools.build_api_url(kind)
-        init = dict(
-            method="PUT",
-            body=JSON.stringify(items.values()),
-            headers={"authtoken": authtoken},
-        )
+        init = dict(method="PUT", body=body, headers=headers)
         try:
             res = await window.fetch(url, init)
         except Exception as err:
@@ -912,6 +1631,9 @@ class ConnectedDataStore(BaseDataStore):
 
         # Process response
         if res.status != 200:
+            # If the server cannot handle the compressed body, don't compress again
+            if compressed and res.status in (400, 415, 500):
+                self._compress_pushes = False
             # The server was not able to process the request, maybe the
             # wifi is down or the server is restarting.
             # Put items back, but don't overwrite if the item was updated again.
@@ -953,40 +1675,34 @@ class ConnectedDataStore(BaseDataStore):
             # d.accepted -> list of ok keys
             for key in d.failed:
                 self[kind]._drop(key)
+            # Take the st of the items that the server stored, so we can
+            # recognize them in keys-only updates. Skip items that were
+            # modified in the mean time.
+            stored_items = []
+            for key, st in (d.stored or {}).items():
+                item = self[kind]._items.get(key, None)
+                if item is not None and item is items[key]:
+                    item = item.copy()
+                    item.st = st
+                    stored_items.append(item)
+            self[kind]._put_received(*stored_items)
             for err in d.errors:
                 self._set_state("warning")
                 self.last_error = f"Server dropped a {kind}: {err}"
                 console.warn(self.last_error)
 
     async def _pull(self, authtoken):
-        # Fetch and wait for response
-        url = tools.build_api_url("updates?since=" + self._server_time)
-        init = dict(method="GET", headers={"authtoken": authtoken})
-        try:
-            res = await window.fetch(url, init)
-        except Exception as err:
-            res = dict(status=0, statusText=str(err), text=lambda: "")
-        self._pull_statuses.append(res.status)
-        self._pull_statuses = self._pull_statuses[-5:]
+        # Once we have the data, we only ask for the versions of the items
+        # that changed, and then fetch the items that we don't have.
+        url = "updates?since=" + self._server_time
+        if self._server_time > 0:
+            url += "&keys_only=1"
+        ob = await self._fetch_json(url, authtoken)
+        if ob is not None and ob.keys_only:
+            ob = await self._pull_by_key(ob, authtoken)
 
         # Process response
-        if res.status != 200:
-            text = await res.text()
-            self._set_state("error")  # E.g. Wifi or server down, or 500
-            self.last_error = res.status + " (" + res.statusText + ")<br>" + text
-            console.warn(self.last_error)
-            if res.status == 401:
-                # Our token is probably expired. There may be local
-                # changes that have not yet been pushed, which would
-                # be lost if we logout. On the other hand, this may be
-                # a lost/stolen device and the user revoked the token.
-                # We can distinguish between these cases by determining
-                # that the 401 is due to a token seed mismatch (revoked).
-                self._auth_cantuse = text
-                if "revoked" in text:
-                    window.location.href = "../logout"
-        else:
-            ob = JSON.parse(await res.text())
+        if ob is not None:
             if ob.server_time:
                 self._log_load("server", ob)
                 # Reset?
@@ -1016,6 +1732,66 @@ class ConnectedDataStore(BaseDataStore):
                     if self.state != "warning":
                         self._set_state("ok")
 
+    async def _pull_by_key(self, ob, authtoken):
+        """Turn a keys-only update into a normal update, by fetching the
+        items that are newer than the ones we have. Returns None on failure.
+        """
+        keys = {}
+        count = 0
+        for kind in ["settings", "records"]:
+            keys[kind] = [x.key for x in ob[kind] if not self[kind]._is_outdated(x)]
+            count += len(keys[kind])
+        if count > 100:
+            # Many changes, e.g. an import on another device. Get all in one go.
+            return await self._fetch_json(
+                "updates?since=" + self._server_time, authtoken
+            )
+        for kind in ["settings", "records"]:
+            ob[kind] = []
+            if len(keys[kind]) > 0:
+                query = "&".join(
+                    ["key=" + window.encodeURIComponent(key) for key in keys[kind]]
+                )
+                ob2 = await self._fetch_json(kind + "?" + query, authtoken)
+                if ob2 is None:
+                    return None
+                ob[kind] = ob2[kind]
+        return ob
+
+    async def _fetch_json(self, url, authtoken):
+        """Do a GET request to the API and return the parsed JSON,
+        or None on failure.
+        """
+        # Fetch and wait for response
+        url = tools.build_api_url(url)
+        init = dict(method="GET", headers={"authtoken": authtoken})
+        try:
+            res = await window.fetch(url, init)
+        except Exception as err:
+            res = dict(status=0, statusText=str(err), text=lambda: "")
+        self._pull_statuses.append(res.status)
+        self._pull_statuses = self._pull_statuses[-5:]
+
+        # Process response
+        if res.status != 200:
+            text = await res.text()
+            self._set_state("error")  # E.g. Wifi or server down, or 500
+            self.last_error = res.status + " (" + res.statusText + ")<br>" + text
+            console.warn(self.last_error)
+            if res.status == 401:
+                # Our token is probably expired. There may be local
+                # changes that have not yet been pushed, which would
+                # be lost if we logout. On the other hand, this may be
+                # a lost/stolen device and the user revoked the token.
+                # We can distinguish between these cases by determining
+                # that the 401 is due to a token seed mismatch (revoked).
+                self._auth_cantuse = text
+                if "revoked" in text:
+                    window.location.href = "../logout"
+            return None
+        else:
+            return JSON.parse(await res.text())
+
 
 class SandboxDataStore(BaseDataStore):
     """A data store that is empty. Users can import records here and
@@ -1029,6 +1805,7 @@ class SandboxDataStore(BaseDataStore):
             self._to_push[kind] = {}
             if len(items) > 0:
                 await tools.sleepms(200)
+                items = [item.copy() for item in items]  # stored items may be frozen
                 for item in items:
                     item.st = dt.now()
                 self[kind]._put_received(*items)
@@ -1066,6 +1843,7 @@ class DemoDataStore(BaseDataStore):
             self._to_push[kind] = {}
             if len(items) > 0:
                 await tools.sleepms(200)
+                items = [item.copy() for item in items]  # stored items may be frozen
                 for item in items:
                     item.st = dt.now()
                 self[kind]._put_received(*items)
@@ -0,0 +1,31 @@
+// Web Worker for the TimeTagger app that holds the bin pyramid of the
+// record store. This means that updating the pyramid (e.g. on an import
+// or a resync) and calculating stats do not block drawing on the main thread.
+//
+// The worker runs a normal RecordStore, compiled from the same stores.py
+// as the main thread. The main thread uses a RecordStoreProxy, which
+// sends all record changes here, and requests stats for a given range.
+// Messages are processed in order, so a query always sees all preceding changes.
+
+self.window = self;  // the pscript modules attach themselves to window
+importScripts("utils.js", "dt.js", "stores.js");
+
+var datastore = {_put: function () {}};  // changes are synced by the main thread
+var records = new window.stores.RecordStore(datastore);
+
+self.onmessage = function (event) {
+    var msg = event.data;
+    if (msg.type == "put") {
+        records._put.apply(records, msg.records);
+    } else if (msg.type == "drop") {
+        records._drop(msg.key);
+    } else if (msg.type == "stats") {
+        var result = records.get_stats(msg.t1, msg.t2);
+        self.postMessage({
+            type: msg.type, key: msg.key, version: msg.version, time: msg.time,
+            t1: msg.t1, t2: msg.t2, result: result,
+        });
+    } else {
+        console.warn("[stores_worker] invalid message type: " + msg.type);
+    }
+};
@@ -14,36 +14,49 @@ def sleepms(ms):
     return RawJS("new Promise(resolve => setTimeout(resolve, ms))")
 
 
-def copy_dom_node(node):
-    global document
+def lines2blob(lines, type="text/plain", newline="\n"):
+    """Create a Blob from a list of lines of text. The text is passed
+    in chunks, to avoid building one huge string.
+    """
+    parts = []
+    for i in range(0, len(lines), 1000):
+        parts.push(lines.slice(i, i + 1000).join(newline) + newline)
+    return window.Blob(parts, {"type": type})
 
-    # Select the node (https://stackoverflow.com/questions/400212)
-    sel = None
-    if document.createRange and window.getSelection:  # FF, Chrome, Edge, ...
-        range = document.createRange()
-        sel = window.getSelection()
-        sel.removeAllRanges()
-        try:
-            range.selectNodeContents(node)
-            sel.addRange(range)
-        except Exception:
-            range.selectNode(node)
-            sel.addRange(range)
-    elif document.body.createTextRange:  # IE?
-        range = document.body.createTextRange()
-        range.moveToElementText(node)
-        range.select()
-
-    # Make a copy
+
+async def copy_blob(blob):
+    """Copy the text in a Blob to the clipboard. Returns whether it succeeded."""
+    clipboard = window.navigator.clipboard
     try:
-        successful = window.document.execCommand("copy")
-    except Exception:
-        successful = False
-
-    if not successful:
-        return  # Don't unselect, user can now copy
-    if sel is not None:
-        sel.removeAllRanges()
+        if window.ClipboardItem:
+            data = {}
+            data[blob.type] = blob
+            await clipboard.write([window.ClipboardItem(data)])
+        else:
+            await clipboard.writeText(await blob.text())
+    except Exception as err:
+        console.warn("Could not copy to clipboard: " + str(err))
+        return False
+    return True
+
+
+def download_blob(blob, filename):
+    """Let the user download the given Blob as a file."""
+    global document
+
+    # Get blob wrapped in an object url
+    obj_url = window.URL.createObjectURL(blob)
+    # Create a element to attach the download to
+    a = document.createElement("a")
+    a.style.display = "none"
+    a.setAttribute("download", filename)
+    a.href = obj_url
+    document.body.appendChild(a)
+    # Trigger the download by simulating click
+    a.click()
+    # Cleanup
+    window.URL.revokeObjectURL(a.href)
+    document.body.removeChild(a)
 
 
 def make_secure_random_string(n=8):
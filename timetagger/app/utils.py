@@ -50,6 +50,49 @@ if this_is_js():
     hsluv2rgb = _get_hsluv2rgb()
 
 
+class TextWidthCache:
+    """Cache for the width of pieces of text, as measured with
+    ctx.measureText(), per font. This is an approximate LRU: entries
+    live in two generations, and are moved to the new generation when
+    used. When the new generation is full, the old one is dropped.
+    """
+
+    def __init__(self, max_size=2000):
+        self._max_size = max_size
+        self.clear()
+
+    def clear(self):
+        """Clear the cache, e.g. when fonts or the pixel ratio changed."""
+        self._new = {}
+        self._old = {}
+        self._count = 0
+
+    def measure(self, ctx, text):
+        """Get the width of the text, using the current font of the context."""
+        PSCRIPT_OVERLOAD = False  # noqa
+        key = ctx.font + "|" + text
+        width = self._new.get(key, None)
+        if width is None:
+            width = self._old.get(key, None)
+            if width is None:
+                width = ctx.measureText(text).width
+            if self._count >= self._max_size:
+                self._old = self._new
+                self._new = {}
+                self._count = 0
+            self._new[key] = width
+            self._count += 1
+        return width
+
+
+text_widths = TextWidthCache()
+
+
+def measure_text(ctx, text):
+    """Get the width of the text, like ctx.measureText(text).width, but cached."""
+    return text_widths.measure(ctx, text)
+
+
 def fit_font_size(ctx, available_width, font, text, maxsize=100):
     """Fit a piece of text into a specified available space and return the size."""
     PSCRIPT_OVERLOAD = False  # noqa
@@ -62,7 +105,7 @@ def fit_font_size(ctx, available_width, font, text, maxsize=100):
         new_size = int(1.1 * size * available_width / width)
         size = new_size if new_size < size else size - 1
         ctx.font = str(size) + "px " + font
-        width = ctx.measureText(text).width
+        width = text_widths.measure(ctx, text)
     return size
 
 
@@ -579,7 +622,13 @@ class RoundedPath:
 
 
 class Picker:
-    """A class that helps with picking."""
+    """A class that helps with picking. Regions registered later are
+    considered to be on top. The regions are indexed in a uniform grid,
+    so that registering and picking is cheap, also for many regions.
+    """
+
+    _cell_size = 64  # in pixels
+    _max_cells = 64  # regions covering more cells are checked on each pick
 
     def __init__(self):
         self.clear()
@@ -587,20 +636,66 @@ class Picker:
     def clear(self):
         """Call this at the start of a draw."""
         self._regions = []
+        self._grid = {}  # iy -> ix -> list of region indices
+        self._large = []  # indices of regions that cover many cells
 
     def register(self, x1, y1, x2, y2, pick_object):
         """Register a clickable region for the given object.
         Use this during drawing.
         """
-        self._regions.insert(0, (x1, y1, x2, y2, pick_object))
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        index = len(self._regions)
+        self._regions.append((x1, y1, x2, y2, pick_object))
+        cs = self._cell_size
+        ix1, ix2 = x1 // cs, x2 // cs
+        iy1, iy2 = y1 // cs, y2 // cs
+        if (ix2 - ix1 + 1) * (iy2 - iy1 + 1) > self._max_cells:
+            self._large.append(index)
+            return
+        for iy in range(iy1, iy2 + 1):
+            row = self._grid.get(iy, None)
+            if row is None:
+                row = {}
+                self._grid[iy] = row
+            for ix in range(ix1, ix2 + 1):
+                cell = row.get(ix, None)
+                if cell is None:
+                    row[ix] = [index]
+                else:
+                    cell.append(index)
 
     def pick(self, x, y):
         """Get pick object for the given location. Returns None if nothing
         was picked.
         """
-        for x1, y1, x2, y2, ob in self._regions:
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        regions = self._regions
+        cs = self._cell_size
+        # Get the topmost region in the cell. Indices are in drawing order.
+        best = -1
+        row = self._grid.get(y // cs, None)
+        if row is not None:
+            cell = row.get(x // cs, None)
+            if cell is not None:
+                for i in range(len(cell) - 1, -1, -1):
+                    x1, y1, x2, y2, ob = regions[cell[i]]
+                    if y1 < y < y2 and x1 < x < x2:
+                        best = cell[i]
+                        break
+        # Large regions may be on top of it
+        for i in range(len(self._large) - 1, -1, -1):
+            index = self._large[i]
+            if index < best:
+                break
+            x1, y1, x2, y2, ob = regions[index]
             if y1 < y < y2 and x1 < x < x2:
-                return ob
+                best = index
+                break
+        if best >= 0:
+            return regions[best][4]
+        return None
 
 
 class SimpleSettings:
@@ -620,6 +715,7 @@ class SimpleSettings:
             "width_mode": "auto",
             "notifications": False,
             "pomodoro_enabled": False,
+            "record_worker": False,
             "report_grouping": "date",
             "report_groupperiod": "none",
             "report_hidesecondary": False,
@@ -640,6 +736,7 @@ class SimpleSettings:
         # The data store for synced source
         self._store = None
         # Init
+        self._version = 0  # Bumped on each change
         self._cache = {}
         self._load_local()
         self._load_synced()  # wont do anything except init the cache
@@ -648,6 +745,7 @@ class SimpleSettings:
 
     def update_store(self, store):
         """Called by the root store."""
+        self._version += 1
         self._store = store
         self._load_synced()
         self._flush_synced()
@@ -702,6 +800,7 @@ class SimpleSettings:
 
     def set(self, key, value):
         """Save a setting."""
+        self._version += 1
         self._cache[key] = value
         # Save
         if key in self._local_keys.keys():
@@ -712,7 +811,7 @@ class SimpleSettings:
             self._save_synced(key)
 
 
-if this_is_js():
+if this_is_js() and window.document:  # not in a Web Worker
     window.simplesettings = SimpleSettings()
 
 
@@ -725,7 +824,9 @@ class BaseCanvas:
         self.w = 0
         self.h = 0
         self._pending_draw = False
+        self._full_draw = True  # False if the pending draw is only for the tick
         self._mouse_tracking = False
+        self.pixel_ratio = 1
         self._init_events()
         self.has_mouse = False
         self.node.setAttribute("tabindex", -1)  # allow catching key events
@@ -778,6 +879,10 @@ class BaseCanvas:
         self.node.addEventListener("touchcancel", self._on_js_touch_event, 0)
         self.node.addEventListener("touchmove", self._on_js_touch_event, 0)
 
+        # Web fonts may load after text has been measured
+        if window.document.fonts:
+            window.document.fonts.addEventListener("loadingdone", self._on_fonts_loaded)
+
         # Keep track of window size
         # window.addEventListener("resize", self._on_js_resize_event, False)
         self._resize_observer = window.ResizeObserver(self._on_resize_observer)
@@ -876,11 +981,18 @@ class BaseCanvas:
         # so let's accept the flicker and use update() ...
         self.update()
 
+    def _on_fonts_loaded(self, e):
+        text_widths.clear()
+        self.update()
+
     def _apply_new_size(self, psize):
         # This is called JIT right before a draw, when a resize has happened
 
-        # Get and store pixel ratio
-        self.pixel_ratio = ratio = get_pixel_ratio()
+        # Get and store pixel ratio. Text may render differently at another ratio.
+        ratio = get_pixel_ratio()
+        if ratio != self.pixel_ratio:
+            text_widths.clear()
+        self.pixel_ratio = ratio
         # Use that to obtain the real number of logical pixels
         lsize = psize[0] / ratio, psize[1] / ratio
         # Apply
@@ -898,7 +1010,7 @@ class BaseCanvas:
         return Math.round(x * self.pixel_ratio) / self.pixel_ratio
 
     def _draw_tick(self):
-        """Function that calls update() to schedule a draw() on a regular interval.
+        """Function that calls on_tick() to schedule a draw() on a regular interval.
         Where regular is really regular, so that second-ticks don't "jump".
         This functon must *not* be called more than once.
         """
@@ -906,10 +1018,14 @@ class BaseCanvas:
         res = 1000  # 1 FPS
         etime = int(now / res) * res + res
         window.setTimeout(self._draw_tick, etime - now)
-        self.update()
+        self.on_tick()
 
     def update(self, asap=True):
         """Schedule an update."""
+        self._full_draw = True
+        self._schedule_draw(asap)
+
+    def _schedule_draw(self, asap=True):
         # The optional extra setTimeout is to make sure that there is
         # time for the browser to process events (like scrolling).
         if not self._pending_draw:
@@ -952,7 +1068,7 @@ class BaseCanvas:
             self._tooltipdiv.style.display = "none"
             return
         # Get tooltip object - if text is None it means no tooltip
-        ob = self._tooltips.pick(x, y)
+        ob = self.pick_tooltip(x, y)
         # Handle over. Schedule a new draw if the over-status changes.
         hash = "" if ob is None else ob.hash
         if hash != self._pointer_hover:
@@ -1038,8 +1154,16 @@ class BaseCanvas:
         self._tooltips.register(x1, y1, x2, y2, ob)
         return self._pointer_hover == ob.hash
 
+    def pick_tooltip(self, x, y):
+        """Get the tooltip object at the given position, or None."""
+        return self._tooltips.pick(x, y)
+
     # To overload
 
+    def on_tick(self):
+        """Called every second. By default this schedules a draw."""
+        self.update()
+
     def on_resize(self):
         pass
 
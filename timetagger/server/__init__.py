@@ -6,7 +6,19 @@ from ._apiserver import (
     AuthException,
     api_handler_triage,
     get_webtoken_unsafe,
+    get_change_stats,
 )
+from ._storage import (
+    StorageBackend,
+    UserStorage,
+    SqliteStorage,
+    SharedSqliteStorage,
+    CachedStorage,
+    get_storage,
+    set_storage,
+)
+from ._dbpool import DbThreadPool, get_db_pool
+from ._metrics import metrics, metrics_handler, instrument_asgi
 from ._assets import (
     md2html,
     create_assets_from_dir,
@@ -4,12 +4,15 @@ This implements the API side of the server.
 
 import json
 import time
+import zlib
 import logging
 import secrets
 
-import itemdb
-
-from ._utils import user2filename, create_jwt, decode_jwt
+from ._utils import create_jwt, decode_jwt
+from ._storage import get_storage
+from ._ratelimit import RateLimiter, AdmissionControl
+from .. import config
+from ._metrics import metrics, InstrumentedDB, API_ROUTES
 
 
 logger = logging.getLogger("asgineer")
@@ -63,13 +66,6 @@ REQS = {
     "settings": frozenset(SETTING_REQ),
 }
 
-# Database indices
-INDICES = {
-    "records": ("!key", "st", "t1", "t2"),
-    "settings": ("!key", "st"),
-    "userinfo": ("!key", "st"),
-}
-
 
 class AuthException(Exception):
     """Exception raised when authentication fails.
@@ -82,12 +78,101 @@ class AuthException(Exception):
 
 # %% Main handler
 
-# todo: rate limiting
+
+rate_limiter = RateLimiter(config.rate_limit)
+admission_control = AdmissionControl(config.max_expensive_requests)
+
+# PUT requests with a body larger than this count as expensive
+EXPENSIVE_PUT_SIZE = 256 * 2**10
+
+# The max size of PUT bodies, after decompression
+MAX_BODY_SIZE = 10 * 2**20
+
+# The supported content-encodings for PUT bodies -> zlib wbits
+CONTENT_ENCODINGS = {
+    "identity": None,
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+# The max number of items to get by key in one request
+MAX_KEYS = 1000
+
+# Per-user counts of synced items, to get insight in sync churn. These
+# are kept in memory for the most recently active users.
+MAX_STATS_USERS = 10000
+_change_stats = {}  # username -> dict
+
+
+def get_request_kind(request, path):
+    """Get the kind of request, and whether it's expensive. The kind
+    is used for rate limiting.
+    """
+    method = request.method
+    if path == "updates":
+        since = request.querydict.get("since", "").strip()
+        try:
+            full = float(since) <= 0
+        except ValueError:
+            full = False  # a 400, so cheap
+        return ("full", True) if full else ("poll", False)
+    elif path in ("records", "settings", "forcereset"):
+        if method == "GET":
+            return "read", False
+        size = request.headers.get("content-length", "")
+        if not size.isdigit():
+            return "write", True
+        size = int(size)
+        if request.headers.get("content-encoding", "identity") != "identity":
+            size *= 10  # a rough estimate of the size after decompression
+        return "write", size > EXPENSIVE_PUT_SIZE
+    elif path in ("webtoken", "apitoken"):
+        return "token", False
+    else:
+        return "other", False
 
 
 async def api_handler_triage(request, path, auth_info, db):
     """The API handler that triages over the API options."""
 
+    # Limit the rate of requests per user and kind of request
+    kind, expensive = get_request_kind(request, path)
+    retry_after = rate_limiter.check(auth_info["username"], kind)
+    if retry_after:
+        metrics.inc("timetagger_rate_limited_total", kind=kind)
+        headers = {"retry-after": str(retry_after)}
+        return 429, headers, f"too many requests: retry after {retry_after}s"
+
+    # Limit the number of expensive requests that run at the same time
+    if expensive:
+        if not await admission_control.acquire():
+            metrics.inc("timetagger_rate_limited_total", kind="busy")
+            return 503, {"retry-after": "5"}, "service unavailable: server is busy"
+        try:
+            return await _api_handler_triage_timed(request, path, auth_info, db)
+        finally:
+            admission_control.release()
+    else:
+        return await _api_handler_triage_timed(request, path, auth_info, db)
+
+
+async def _api_handler_triage_timed(request, path, auth_info, db):
+    if not metrics.enabled:
+        return await _api_handler_triage(request, path, auth_info, db)
+
+    t0 = time.perf_counter()
+    try:
+        return await _api_handler_triage(request, path, auth_info, db)
+    finally:
+        metrics.observe(
+            "timetagger_api_handler_seconds",
+            time.perf_counter() - t0,
+            route=path if path in API_ROUTES else "other",
+            method=request.method,
+        )
+
+
+async def _api_handler_triage(request, path, auth_info, db):
     if path == "updates":
         if request.method == "GET":
             return await get_updates(request, auth_info, db)
@@ -162,6 +247,7 @@ async def authenticate(request):
     #   "revoked" and handle revokation different from expiration.
 
     st = time.time()
+    t0 = time.perf_counter()
 
     # Get jwt from header. Validates that a token is provided.
     token = request.headers.get("authtoken", "")
@@ -173,18 +259,21 @@ async def authenticate(request):
         auth_info = decode_jwt(token)
     except Exception as err:
         raise AuthException(str(err))
+    t1 = time.perf_counter()
+    metrics.observe("timetagger_auth_seconds", t1 - t0, phase="jwt")
 
-    # Open the database, this creates it if it does not yet exist
-    dbname = user2filename(auth_info["username"])
-    db = await itemdb.AsyncItemDB(dbname)
-    await db.ensure_table("userinfo", *INDICES["userinfo"])
-    await db.ensure_table("records", *INDICES["records"])
-    await db.ensure_table("settings", *INDICES["settings"])
+    # Open the user's storage, this creates it if it does not yet exist
+    db = await get_storage().open_user(auth_info["username"])
+    if metrics.enabled:
+        db = InstrumentedDB(db)
+    t2 = time.perf_counter()
+    metrics.observe("timetagger_auth_seconds", t2 - t1, phase="db_open")
 
     # Get reference seed from db
     expires = auth_info["expires"]
     tokenkind = "apitoken" if expires > st + WEBTOKEN_LIFETIME else "webtoken"
     ref_seed = await _get_token_seed_from_db(db, tokenkind, False)
+    metrics.observe("timetagger_auth_seconds", time.perf_counter() - t2, phase="seed")
 
     # Compare seeds. Validates that the token is not revoked.
     if not ref_seed or ref_seed != auth_info["seed"]:
@@ -243,17 +332,12 @@ async def _get_any_token(auth_info, db, tokenkind, reset):
 
 async def _get_token_seed_from_db(db, tokenkind, reset):
     # Get seed
-    query = f"key = '{tokenkind}_seed'"
-    ob = await db.select_one("userinfo", query) or {}
-    seed = ob.get("value", "")
+    seed = await db.get_token_seed(tokenkind)
     # Create new seed if needed
     if reset or not seed:
         seed = secrets.token_urlsafe(8)  # new random seed
-        st = time.time()
         async with db:
-            await db.put_one(
-                "userinfo", key=f"{tokenkind}_seed", st=st, mt=st, value=seed
-            )
+            await db.set_token_seed(tokenkind, seed)
     return seed
 
 
@@ -272,10 +356,8 @@ async def get_webtoken_unsafe(username, reset=False):
     The provided webtoken expires in two weeks. It is recommended to
     use GET /api/v2/webtoken to get a fresh token once a day.
     """
-    # Open db
-    dbname = user2filename(username)
-    db = await itemdb.AsyncItemDB(dbname)
-    await db.ensure_table("userinfo", *INDICES["userinfo"])
+    # Open the user's storage
+    db = await get_storage().open_user(username)
     # Produce payload
     seed = await _get_token_seed_from_db(db, "webtoken", reset)
     payload = dict(
@@ -321,18 +403,28 @@ async def get_updates(request, auth_info, db):
     # Get reset time from userinfo. We set userinfo.reset_time when the
     # database is reset (or when we want to force a refresh). We make
     # the client reset if since < reset_time.
-    ob = await db.select_one("userinfo", "key == 'reset_time'")
-    reset_time = float((ob or {}).get("value", -1))
+    reset_time = await db.get_reset_time()
     reset = since <= reset_time
 
     # Get data
     if reset:
-        records = await db.select_all("records")
-        settings = await db.select_all("settings")
+        records = await db.get_items("records")
+        settings = await db.get_items("settings")
     else:
-        query = f"st >= {float(since)}"
-        records = await db.select("records", query)
-        settings = await db.select("settings", query)
+        records = await db.get_items("records", since)
+        settings = await db.get_items("settings", since)
+
+    # In keys-only mode we only send the versions, so the client can get
+    # the items that it does not have via /records and /settings. After
+    # a reset the client needs all items anyway.
+    keys_only = request.querydict.get("keys_only", "")
+    keys_only = keys_only.lower() not in ("", "false", "no", "0") and not reset
+    if keys_only:
+        records = [_get_version(item) for item in records]
+        settings = [_get_version(item) for item in settings]
+    sent = "sent_keys" if keys_only else "sent_items"
+    _count_changes(auth_info["username"], "records", {sent: len(records)})
+    _count_changes(auth_info["username"], "settings", {sent: len(settings)})
 
     # Return result
     result = dict(
@@ -341,10 +433,35 @@ async def get_updates(request, auth_info, db):
         records=records,
         settings=settings,
     )
+    if keys_only:
+        result["keys_only"] = True
     return 200, {}, result
 
 
+def _get_version(item):
+    return dict(key=item["key"], mt=item["mt"], st=item["st"])
+
+
+def _get_keys(request):
+    # Get the keys from the query, e.g. ?key=a&key=b, or None
+    keys = [value for key, value in request.querylist if key == "key"]
+    if not keys:
+        return None
+    elif len(keys) > MAX_KEYS:
+        raise ValueError(f"can get at most {MAX_KEYS} items by key")
+    return keys
+
+
 async def get_records(request, auth_info, db):
+    # Get records by key?
+    try:
+        keys = _get_keys(request)
+    except ValueError as err:
+        return 400, {}, f"bad request: /records {err}"
+    if keys is not None:
+        records = await db.get_items_by_key("records", keys)
+        return 200, {}, dict(records=list(records.values()))
+
     # Parse timerange option
     timerange_str = request.querydict.get("timerange", "").strip()
     if not timerange_str:
@@ -359,8 +476,7 @@ async def get_records(request, auth_info, db):
 
     # Collect records
     tr1, tr2 = int(timerange[0]), int(timerange[1])
-    query = f"(t2 >= {tr1} AND t1 <= {tr2}) OR (t1 == t2 AND t1 <= {tr2})"
-    records = await db.select("records", query)
+    records = await db.get_records_in_range(tr1, tr2)
 
     # Return result
     result = dict(records=records)
@@ -372,8 +488,15 @@ async def put_records(request, auth_info, db):
 
 
 async def get_settings(request, auth_info, db):
-    # Collect settings
-    settings = await db.select_all("settings")
+    # Collect settings, all or by key
+    try:
+        keys = _get_keys(request)
+    except ValueError as err:
+        return 400, {}, f"bad request: /settings {err}"
+    if keys is not None:
+        settings = list((await db.get_items_by_key("settings", keys)).values())
+    else:
+        settings = await db.get_items("settings")
 
     # Return result
     result = dict(settings=settings)
@@ -385,8 +508,17 @@ async def put_settings(request, auth_info, db):
 
 
 async def _push_items(request, auth_info, db, what):
-    # Download items
-    items = await request.get_json(10 * 2**20)  # 10 MiB limit
+    # Download items, the body may be compressed
+    encoding = request.headers.get("content-encoding", "identity").lower().strip()
+    if encoding not in CONTENT_ENCODINGS:
+        return 415, {}, f"unsupported media type: cannot decode {encoding} body"
+    try:
+        body = await _get_body(request, CONTENT_ENCODINGS[encoding], MAX_BODY_SIZE)
+    except zlib.error as err:
+        return 400, {}, f"bad request: invalid {encoding} body: {err}"
+    t0 = time.perf_counter()
+    items = json.loads(body.decode())
+    metrics.observe("timetagger_json_seconds", time.perf_counter() - t0, what=what)
     if not isinstance(items, list):
         raise TypeError(f"List of {what} must be a list")
 
@@ -399,21 +531,28 @@ async def _push_items(request, auth_info, db, what):
     failed = []  # keys of corrupt items
     errors = []  # error messages, matching up with failed
     errors2 = []  # error messages for items that did not even have a key
+    stored = {}  # key -> st, for items of which the incoming version was stored
+    counts = dict(new=0, changed=0, unchanged=0, outdated=0, failed=0)
 
     async with db:
-        ob = await db.select_one("userinfo", "key == 'reset_time'")
-        reset_time = float((ob or {}).get("value", -1))
+        reset_time = await db.get_reset_time()
+
+        # Get the current items in one go
+        keys = [item["key"] for item in items if _has_str_key(item)]
+        cur_items = await db.get_items_by_key(what, keys)
+        items_to_put = {}
 
         for item in items:
             # First check minimal requirement.
-            if not (isinstance(item, dict) and isinstance(item.get("key", None), str)):
+            if not _has_str_key(item):
                 errors2.append("Got item that is not a dict with str 'key' field.")
+                counts["failed"] += 1
                 continue
 
             # Get current item (or None). We will ALWAYS update the item's st
             # (except when cur_item is None and incoming is corrupt).
             # This helps guarantee consistency between server and client.
-            cur_item = await db.select_one(what, "key == ?", item["key"])
+            cur_item = cur_items.get(item["key"], None)
 
             # Validate and copy the item (only copy fields that we know)
             try:
@@ -430,16 +569,26 @@ async def _push_items(request, auth_info, db, what):
                 # Item is corrupt - mark it as failed
                 failed.append(item["key"])
                 errors.append(str(err))
+                result = "failed"
                 # Re-put the current item if there was one, otherwise ignore
                 if cur_item is not None:
                     item = cur_item
                 else:
+                    counts[result] += 1
                     continue
             else:
                 accepted.append(item["key"])
+                if cur_item is None:
+                    result = "new"
+                elif cur_item["mt"] > item["mt"]:
+                    result = "outdated"
+                elif all(item.get(key) == cur_item.get(key) for key in spec):
+                    result = "unchanged"
+                else:
+                    result = "changed"
 
             # Reput the current item if its mt is larger than the incoming item.
-            if cur_item is not None and cur_item["mt"] > item["mt"]:
+            if result == "outdated":
                 item = cur_item
 
             # Ensure that st is never equal, so that we can guarantee
@@ -450,23 +599,89 @@ async def _push_items(request, auth_info, db, what):
             else:
                 item["st"] = server_time
 
-            # Store it!
-            await db.put(what, item)
+            # Let the client know the st of its version, so it can
+            # recognize it in keys-only updates.
+            if result in ("failed", "outdated"):
+                stored.pop(item["key"], None)
+            else:
+                stored[item["key"]] = item["st"]
+            counts[result] += 1
+
+            # Store it! Items with the same key in one request follow each other
+            cur_items[item["key"]] = items_to_put[item["key"]] = item
+
+        await db.put_items(what, list(items_to_put.values()))
+
+    _count_changes(auth_info["username"], what, counts)
 
     # Return result
     result = dict(
         accepted=accepted,
         failed=failed,
         errors=errors + errors2,
+        stored=stored,
     )
     return 200, {}, result
 
 
+async def _get_body(request, wbits, limit):
+    """Get the body of the request, decompressing it if wbits is given.
+    The limit applies to the decompressed size. We stop decompressing
+    when the limit is reached, so that a small body that decompresses to
+    a huge size (a decompression bomb) does not consume much memory or time.
+    """
+    if wbits is None:
+        return await request.get_body(limit)
+    decompressor = zlib.decompressobj(wbits)
+    nbytes_in = nbytes_out = 0
+    parts = []
+    async for chunk in request.iter_body():
+        nbytes_in += len(chunk)
+        if nbytes_in > limit:
+            raise IOError("Request body too large.")
+        while chunk:
+            part = decompressor.decompress(chunk, limit + 1 - nbytes_out)
+            nbytes_out += len(part)
+            if nbytes_out > limit:
+                raise IOError("Request body too large (after decompression).")
+            parts.append(part)
+            chunk = decompressor.unconsumed_tail
+    if not decompressor.eof or decompressor.unused_data:
+        raise zlib.error("incomplete or trailing data")
+    return b"".join(parts)
+
+
+def _has_str_key(item):
+    return isinstance(item, dict) and isinstance(item.get("key", None), str)
+
+
+def get_change_stats(username):
+    """Get a dict with the number of items that the given user pushed,
+    by result (new, changed, unchanged, outdated, failed), and the number
+    of items and keys-only versions that were sent to the user. Counted
+    since the server started.
+    """
+    return dict(_change_stats.get(username, {}))
+
+
+def _count_changes(username, what, counts):
+    stats = _change_stats.pop(username, None)
+    if stats is None:
+        if len(_change_stats) >= MAX_STATS_USERS:
+            _change_stats.pop(next(iter(_change_stats)))  # least recently used
+        stats = {}
+    _change_stats[username] = stats
+    for result, n in counts.items():
+        if n:
+            stats[result] = stats.get(result, 0) + n
+            metrics.inc("timetagger_sync_items_total", n, what=what, result=result)
+
+
 async def put_forcereset(request, auth_info, db):
     st = time.time()
 
     async with db:
-        await db.put_one("userinfo", key="reset_time", st=st, mt=st, value=st)
+        await db.set_reset_time(st)
 
     result = dict(status="ok")
     return 200, {}, result
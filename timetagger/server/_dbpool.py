@@ -0,0 +1,111 @@
+"""
+A thread pool for database work. Users are assigned to shards by their
+username. Each shard has a worker thread per lane: a "fast" lane for cheap
+calls (e.g. polling for updates and looking up token seeds), and a "bulk"
+lane for heavy calls (e.g. getting all records, or large writes). This
+way, one user's import does not delay the polls of other users.
+"""
+
+import time
+import zlib
+import queue
+import asyncio
+import threading
+
+from .. import config
+from ._metrics import metrics
+
+
+LANES = ("fast", "bulk")
+
+
+class DbThreadPool:
+    """Runs (blocking) database calls in worker threads, per shard and lane.
+    The threads are started when they're first needed.
+    """
+
+    def __init__(self, shards):
+        self._shards = max(1, int(shards))
+        self._queues = {}  # (shard, lane) -> queue
+        self._lock = threading.Lock()
+        self._depths = {lane: 0 for lane in LANES}
+
+    @property
+    def shards(self):
+        """The number of shards."""
+        return self._shards
+
+    def get_queue_depths(self):
+        """Get a dict with the number of calls that are queued or
+        running, per lane.
+        """
+        return dict(self._depths)
+
+    def _get_queue(self, shard, lane):
+        key = shard, lane
+        q = self._queues.get(key, None)
+        if q is None:
+            with self._lock:
+                q = self._queues.get(key, None)
+                if q is None:
+                    q = queue.SimpleQueue()
+                    t = threading.Thread(
+                        target=self._worker,
+                        args=(q,),
+                        name=f"timetagger_db_{lane}_{shard}",
+                        daemon=True,
+                    )
+                    t.start()
+                    self._queues[key] = q
+        return q
+
+    async def run(self, username, lane, func, *args):
+        """Call func(*args) in the worker thread for the given user and lane."""
+        if lane not in LANES:
+            raise ValueError(f"Invalid lane {lane!r}")
+        shard = zlib.crc32(username.encode()) % self._shards
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._depths[lane] += 1
+        metrics.set("timetagger_db_queue_depth", self._depths[lane], lane=lane)
+        t0 = time.perf_counter()
+        self._get_queue(shard, lane).put((loop, future, lane, t0, func, args))
+        try:
+            return await future
+        finally:
+            self._depths[lane] -= 1
+            metrics.set("timetagger_db_queue_depth", self._depths[lane], lane=lane)
+
+    def _worker(self, q):
+        while True:
+            loop, future, lane, t0, func, args = q.get()
+            wait = time.perf_counter() - t0
+            result = error = None
+            try:
+                result = func(*args)
+            except BaseException as err:
+                error = err
+            try:
+                loop.call_soon_threadsafe(self._done, future, lane, wait, result, error)
+            except RuntimeError:
+                pass  # the loop is closed
+
+    def _done(self, future, lane, wait, result, error):
+        metrics.observe("timetagger_db_queue_seconds", wait, lane=lane)
+        if future.done():
+            pass
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+_pool = None
+
+
+def get_db_pool():
+    """Get the default DbThreadPool, with ``config.db_shards`` shards."""
+    global _pool
+    if _pool is None:
+        _pool = DbThreadPool(config.db_shards)
+    return _pool
@@ -0,0 +1,335 @@
+"""
+Opt-in instrumentation of the server, exposed in the Prometheus text format.
+
+Instrumentation is enabled with ``config.metrics_enabled``. When disabled,
+the calls to ``metrics.inc()`` and ``metrics.observe()`` return immediately,
+the database is not wrapped, and the ASGI wrapper calls the app directly.
+"""
+
+import time
+import bisect
+
+from .. import config
+
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+SIZE_BUCKETS = tuple(256 * 4**i for i in range(10))  # 256 B - 64 MiB
+
+# The known metrics: name -> (type, help, buckets)
+METRICS = {
+    "timetagger_requests_total": (
+        "counter",
+        "Number of HTTP requests, by endpoint and status.",
+        None,
+    ),
+    "timetagger_request_seconds": (
+        "histogram",
+        "Total time to handle an HTTP request, including sending the response.",
+        LATENCY_BUCKETS,
+    ),
+    "timetagger_request_bytes": (
+        "histogram",
+        "Size of the HTTP request bodies.",
+        SIZE_BUCKETS,
+    ),
+    "timetagger_response_bytes": (
+        "histogram",
+        "Size of the HTTP response bodies (after compression).",
+        SIZE_BUCKETS,
+    ),
+    "timetagger_api_handler_seconds": (
+        "histogram",
+        "Time spent in the API handler, after authentication.",
+        LATENCY_BUCKETS,
+    ),
+    "timetagger_auth_seconds": (
+        "histogram",
+        "Time spent in authentication, by phase.",
+        LATENCY_BUCKETS,
+    ),
+    "timetagger_db_query_seconds": (
+        "histogram",
+        "Time spent in storage calls (including waiting for the db thread).",
+        LATENCY_BUCKETS,
+    ),
+    "timetagger_db_queue_depth": (
+        "gauge",
+        "Number of database calls that are queued or running, by lane.",
+        None,
+    ),
+    "timetagger_db_queue_seconds": (
+        "histogram",
+        "Time that database calls wait for a worker thread, by lane.",
+        LATENCY_BUCKETS,
+    ),
+    "timetagger_json_seconds": (
+        "histogram",
+        "Time spent decoding JSON request bodies, by kind of items.",
+        LATENCY_BUCKETS,
+    ),
+    "timetagger_sync_items_total": (
+        "counter",
+        "Number of synced items, by kind of items and result (pushed or sent).",
+        None,
+    ),
+    "timetagger_rate_limited_total": (
+        "counter",
+        "Number of API requests that were refused (429 by kind, or 503 when busy).",
+        None,
+    ),
+    "timetagger_cache_requests_total": (
+        "counter",
+        "Number of reads from the user cache, by result (hit or miss).",
+        None,
+    ),
+    "timetagger_asset_requests_total": (
+        "counter",
+        "Number of requests for assets, by group and status.",
+        None,
+    ),
+}
+
+# The API routes, other paths are labeled "other" to limit the cardinality
+API_ROUTES = frozenset(
+    ["updates", "records", "settings", "forcereset", "webtoken", "apitoken"]
+)
+
+
+class Histogram:
+    """A Prometheus-style histogram with fixed buckets."""
+
+    __slots__ = ["buckets", "counts", "count", "sum"]
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is for +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Registry for counters, gauges and histograms, with labels."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._values = {}  # (name, labels) -> number or Histogram
+
+    def reset(self):
+        """Clear all collected values."""
+        self._values.clear()
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+        if not self.enabled:
+            return
+        key = name, tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set the value of a gauge."""
+        if not self.enabled:
+            return
+        self._values[name, tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        if not self.enabled:
+            return
+        key = name, tuple(sorted(labels.items()))
+        hist = self._values.get(key, None)
+        if hist is None:
+            hist = self._values[key] = Histogram(METRICS[name][2])
+        hist.observe(value)
+
+    def get(self, name, **labels):
+        """Get the value of a counter or gauge, or the Histogram object."""
+        return self._values.get((name, tuple(sorted(labels.items()))), None)
+
+    def render(self):
+        """Get the metrics in the Prometheus text format."""
+        lines = []
+        for name, (kind, help, _) in METRICS.items():
+            items = [(k[1], v) for k, v in self._values.items() if k[0] == name]
+            if not items:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(items, key=lambda x: x[0]):
+                if kind == "histogram":
+                    cumulative = 0
+                    for le, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        le_label = _format_labels(labels + (("le", repr(le)),))
+                        lines.append(f"{name}_bucket{le_label} {cumulative}")
+                    le_label = _format_labels(labels + (("le", "+Inf"),))
+                    lines.append(f"{name}_bucket{le_label} {value.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {value.sum!r}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+metrics = Metrics(config.metrics_enabled)
+
+
+async def metrics_handler(request):
+    """Handler that returns the metrics in the Prometheus text format."""
+    if not metrics.enabled:
+        return 404, {}, "metrics are not enabled"
+    headers = {"content-type": "text/plain; version=0.0.4; charset=utf-8"}
+    return 200, headers, metrics.render()
+
+
+def get_endpoint(path):
+    """Get the endpoint label for a request path."""
+    if path.startswith("/timetagger/api/v2/"):
+        route = path[19:].strip("/")
+        return "api/" + (route if route in API_ROUTES else "other")
+    elif path.startswith("/timetagger/app/"):
+        return "app"
+    elif path in ("/timetagger/status", "/timetagger/metrics"):
+        return path[12:]
+    elif path.startswith("/timetagger/"):
+        return "web"
+    else:
+        return "other"
+
+
+def instrument_asgi(app):
+    """Wrap an ASGI application to measure the total request time, and
+    the sizes of request and response bodies.
+    """
+
+    async def instrumented_app(scope, receive, send):
+        if not metrics.enabled or scope["type"] != "http":
+            return await app(scope, receive, send)
+
+        t0 = time.perf_counter()
+        state = {"status": 0, "request_bytes": 0, "response_bytes": 0}
+
+        async def counting_receive():
+            message = await receive()
+            state["request_bytes"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["response_bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await app(scope, counting_receive, counting_send)
+        finally:
+            endpoint = get_endpoint(scope["path"])
+            metrics.inc(
+                "timetagger_requests_total",
+                endpoint=endpoint,
+                method=scope["method"],
+                status=state["status"],
+            )
+            metrics.observe(
+                "timetagger_request_seconds",
+                time.perf_counter() - t0,
+                endpoint=endpoint,
+            )
+            metrics.observe(
+                "timetagger_request_bytes", state["request_bytes"], endpoint=endpoint
+            )
+            metrics.observe(
+                "timetagger_response_bytes",
+                state["response_bytes"],
+                endpoint=endpoint,
+            )
+
+    for attr in ("__module__", "__name__", "__doc__", "asgineer_handler"):
+        if hasattr(app, attr):
+            setattr(instrumented_app, attr, getattr(app, attr))
+    return instrumented_app
+
+
+class InstrumentedDB:
+    """Wraps a UserStorage to measure the time spent in each call."""
+
+    _OPS = frozenset(
+        [
+            "get_items",
+            "get_records_in_range",
+            "get_items_by_key",
+            "put_items",
+            "get_reset_time",
+            "set_reset_time",
+            "get_token_seed",
+            "set_token_seed",
+        ]
+    )
+
+    def __init__(self, db):
+        self._db = db
+
+    @property
+    def mtime(self):
+        return self._db.mtime
+
+    async def __aenter__(self):
+        await self._db.__aenter__()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        # Exiting the context commits the transaction
+        t0 = time.perf_counter()
+        try:
+            return await self._db.__aexit__(type, value, traceback)
+        finally:
+            metrics.observe(
+                "timetagger_db_query_seconds", time.perf_counter() - t0, op="commit"
+            )
+
+    def __getattr__(self, name):
+        func = getattr(self._db, name)
+        if name not in self._OPS:
+            return func
+
+        async def timed_func(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe(
+                    "timetagger_db_query_seconds", time.perf_counter() - t0, op=name
+                )
+
+        return timed_func
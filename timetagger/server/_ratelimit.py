@@ -0,0 +1,125 @@
+"""
+Rate limiting and admission control for the API. The rate of requests is
+limited per user and kind of request, using token buckets. The number of
+expensive requests (e.g. full syncs) that run at the same time is capped
+for all users together.
+"""
+
+import math
+import time
+import asyncio
+
+
+# The limits per kind of request: (requests per second, burst size)
+RATE_LIMITS = {
+    "poll": (1.0, 30),  # GET /updates, clients poll every 10 seconds
+    "full": (1 / 60, 10),  # GET /updates?since=0
+    "read": (1.0, 30),  # GET /records and /settings
+    "write": (2.0, 60),  # PUT /records, /settings and /forcereset
+    "token": (1 / 60, 10),  # GET /webtoken and /apitoken
+}
+
+
+class RateLimiter:
+    """Token bucket rate limiter, per user and kind of request. The
+    factor scales the rates and burst sizes; a factor of zero disables
+    rate limiting.
+    """
+
+    max_buckets = 10000
+
+    def __init__(self, factor=1.0, limits=None):
+        self.factor = factor
+        self._limits = limits or RATE_LIMITS
+        self._buckets = {}  # (username, kind) -> [tokens, last_time]
+
+    def reset(self):
+        """Forget all buckets."""
+        self._buckets.clear()
+
+    def check(self, username, kind, now=None):
+        """Take a token from the bucket for the given user and kind of
+        request. Returns 0 if the request is allowed, or the number of
+        seconds to wait otherwise.
+        """
+        if self.factor <= 0 or kind not in self._limits:
+            return 0
+        now = time.monotonic() if now is None else now
+        rate, burst = self._limits[kind]
+        rate, burst = rate * self.factor, max(1, burst * self.factor)
+
+        key = username, kind
+        bucket = self._buckets.get(key, None)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self._buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        else:
+            return max(1, math.ceil((1 - bucket[0]) / rate))
+
+    def _prune(self, now):
+        # Remove the buckets that would be full by now, they're the same as new
+        for key, (tokens, last_time) in list(self._buckets.items()):
+            rate, burst = self._limits[key[1]]
+            rate, burst = rate * self.factor, max(1, burst * self.factor)
+            if tokens + (now - last_time) * rate >= burst:
+                self._buckets.pop(key)
+
+
+class AdmissionControl:
+    """Limit the number of requests that run at the same time. Requests
+    wait for a slot for at most the given timeout. A max of zero disables
+    the limit.
+    """
+
+    def __init__(self, max_concurrent, timeout=10):
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self._count = 0
+        self._waiters = []
+
+    @property
+    def count(self):
+        """The number of requests that currently have a slot."""
+        return self._count
+
+    async def acquire(self):
+        """Wait for a slot. Returns False if the timeout passed."""
+        if self.max_concurrent <= 0:
+            self._count += 1
+            return True
+        if self._count < self.max_concurrent and not self._waiters:
+            self._count += 1
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            if future.done():  # we got the slot just in time
+                return True
+            self._waiters.remove(future)
+            return False
+        except BaseException:
+            if future.done():
+                self.release()
+            else:
+                self._waiters.remove(future)
+            raise
+        return True
+
+    def release(self):
+        """Release a slot, passing it on to the first waiter, if any."""
+        while self._waiters:
+            future = self._waiters.pop(0)
+            if not future.done():
+                future.set_result(None)  # the count stays the same
+                return
+        self._count -= 1
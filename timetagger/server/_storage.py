@@ -0,0 +1,689 @@
+"""
+The storage layer of the server. The API handlers talk to a storage
+backend, which provides a UserStorage object per user.
+
+The default backend stores the data of each user in its own SQLite file
+(resolved with ``user2filename``). The shared backend stores the data of
+all users in a single SQLite database (in WAL mode), with a user column.
+Other backends (e.g. an embedded key-value store) can be implemented by
+subclassing ``StorageBackend`` and ``UserStorage``, and activated with
+``set_storage()``. Any backend can be wrapped in a ``CachedStorage`` to
+keep the data of active users in memory.
+"""
+
+import os
+import json
+import time
+import bisect
+import asyncio
+import sqlite3
+import weakref
+from collections import OrderedDict
+
+import itemdb
+
+from .. import config
+from ._utils import ROOT_TT_DIR, user2filename
+from ._metrics import metrics
+from ._dbpool import get_db_pool
+
+
+# Database indices
+INDICES = {
+    "records": ("!key", "st", "t1", "t2"),
+    "settings": ("!key", "st"),
+    "userinfo": ("!key", "st"),
+}
+
+# Max number of keys to select in one query
+KEYS_PER_QUERY = 500
+
+# Reads and writes with more items than this are done in the bulk lane
+BULK_SIZE = 100
+
+# How long a db call waits for a lock held by another connection (ms)
+BUSY_TIMEOUT = 5000
+
+
+class StorageBackend:
+    """Base class for storage backends. A backend provides access to
+    the data of each user, via ``open_user()``.
+    """
+
+    async def open_user(self, username):
+        """Get the UserStorage for the given user. Creates the storage
+        for that user if it does not yet exist.
+        """
+        raise NotImplementedError()
+
+
+class UserStorage:
+    """Base class for the storage of the data of a single user.
+
+    The items are records and settings (dicts with at least a "key" and
+    "st" field). Writes must be done in a transaction, using ``async with``.
+    """
+
+    @property
+    def mtime(self):
+        """A timestamp at or after the last time that the data was
+        modified. Used to quickly check whether a sync is needed.
+        """
+        raise NotImplementedError()
+
+    async def __aenter__(self):
+        raise NotImplementedError()
+
+    async def __aexit__(self, type, value, traceback):
+        raise NotImplementedError()
+
+    async def get_items(self, what, since=None):
+        """Get all records or settings, or those with st >= since."""
+        raise NotImplementedError()
+
+    async def get_records_in_range(self, t1, t2):
+        """Get the records that overlap with the given time range."""
+        raise NotImplementedError()
+
+    async def get_items_by_key(self, what, keys):
+        """Get a dict that maps keys to the existing records or settings."""
+        raise NotImplementedError()
+
+    async def put_items(self, what, items):
+        """Insert or replace records or settings. Must be called in a transaction."""
+        raise NotImplementedError()
+
+    async def get_reset_time(self):
+        """Get the time of the last reset, or -1."""
+        raise NotImplementedError()
+
+    async def set_reset_time(self, st):
+        """Set the reset time. Must be called in a transaction."""
+        raise NotImplementedError()
+
+    async def get_token_seed(self, tokenkind):
+        """Get the seed for the given kind of token, or an empty string."""
+        raise NotImplementedError()
+
+    async def set_token_seed(self, tokenkind, seed):
+        """Set the seed for the given kind of token. Must be called in a transaction."""
+        raise NotImplementedError()
+
+
+def _check_what(what):
+    if what not in ("records", "settings"):
+        raise ValueError(f"Invalid item kind {what!r}")
+
+
+# %% SQLite with one file per user
+
+
+class SqliteStorage(StorageBackend):
+    """Backend that stores the data of each user in a separate SQLite file.
+    The database calls run in a DbThreadPool (by default the shared pool).
+    """
+
+    def __init__(self, pool=None):
+        self._pool = pool
+        self._locks = weakref.WeakValueDictionary()  # username -> asyncio.Lock
+
+    async def open_user(self, username):
+        pool = self._pool or get_db_pool()
+        filename = user2filename(username)
+        db = await pool.run(username, "fast", _open_sqlite, filename)
+        lock = self._locks.get(username, None)
+        if lock is None:
+            lock = self._locks[username] = asyncio.Lock()
+        return SqliteUserStorage(db, pool, username, lock)
+
+
+def _open_sqlite(filename):
+    db = itemdb.ItemDB(filename)
+    # The worker threads are shared, so don't wait long for locks
+    db._conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+    db.ensure_table("userinfo", *INDICES["userinfo"])
+    db.ensure_table("records", *INDICES["records"])
+    db.ensure_table("settings", *INDICES["settings"])
+    return db
+
+
+class SqliteUserStorage(UserStorage):
+    """The storage for one user, in its own SQLite database. Calls that
+    can take long are done in the bulk lane of the thread pool. The
+    transactions of a user are serialized with an asyncio lock, so that
+    a BEGIN never waits for the database lock in a (shared) worker thread.
+    """
+
+    def __init__(self, db, pool, username, lock):
+        self._db = db
+        self._pool = pool
+        self._username = username
+        self._lock = lock
+        self._commit_lane = "fast"
+
+    def _run(self, lane, func, *args):
+        return self._pool.run(self._username, lane, func, *args)
+
+    @property
+    def mtime(self):
+        return self._db.mtime
+
+    async def __aenter__(self):
+        await self._lock.acquire()
+        try:
+            self._commit_lane = "fast"
+            await self._run("fast", self._db.__enter__)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            lane = self._commit_lane
+            return await self._run(lane, self._db.__exit__, type, value, traceback)
+        finally:
+            self._lock.release()
+
+    async def get_items(self, what, since=None):
+        _check_what(what)
+        if since is None:
+            return await self._run("bulk", self._db.select_all, what)
+        else:
+            query = "st >= ?"
+            return await self._run("fast", self._db.select, what, query, float(since))
+
+    async def get_records_in_range(self, t1, t2):
+        query = "(t2 >= ? AND t1 <= ?) OR (t1 == t2 AND t1 <= ?)"
+        t1, t2 = int(t1), int(t2)
+        return await self._run("bulk", self._db.select, "records", query, t1, t2, t2)
+
+    async def get_items_by_key(self, what, keys):
+        _check_what(what)
+        keys = list(keys)
+        lane = "fast" if len(keys) <= BULK_SIZE else "bulk"
+        return await self._run(lane, self._select_by_key, what, keys)
+
+    def _select_by_key(self, what, keys):
+        result = {}
+        for i in range(0, len(keys), KEYS_PER_QUERY):
+            chunk = keys[i : i + KEYS_PER_QUERY]
+            query = "key IN (" + ",".join("?" for _ in chunk) + ")"
+            for item in self._db.select(what, query, *chunk):
+                result[item["key"]] = item
+        return result
+
+    async def put_items(self, what, items):
+        _check_what(what)
+        if items:
+            lane = "fast" if len(items) <= BULK_SIZE else "bulk"
+            if lane == "bulk":
+                self._commit_lane = "bulk"
+            await self._run(lane, self._db.put, what, *items)
+
+    async def get_reset_time(self):
+        query = "key == 'reset_time'"
+        ob = await self._run("fast", self._db.select_one, "userinfo", query)
+        return float((ob or {}).get("value", -1))
+
+    async def set_reset_time(self, st):
+        item = dict(key="reset_time", st=st, mt=st, value=st)
+        await self._run("fast", self._db.put, "userinfo", item)
+
+    async def get_token_seed(self, tokenkind):
+        key = f"{tokenkind}_seed"
+        ob = await self._run("fast", self._db.select_one, "userinfo", "key == ?", key)
+        return (ob or {}).get("value", "")
+
+    async def set_token_seed(self, tokenkind, seed):
+        st = time.time()
+        item = dict(key=f"{tokenkind}_seed", st=st, mt=st, value=seed)
+        await self._run("fast", self._db.put, "userinfo", item)
+
+
+# %% SQLite with one shared file
+
+
+class SharedSqliteStorage(StorageBackend):
+    """Backend that stores the data of all users in a single SQLite
+    database in WAL mode. Each item is stored with the username, and
+    a unique key that combines the username and the item key. This
+    avoids hitting limits on the number of files and file descriptors.
+    """
+
+    _indices = {
+        what: ("!_ukey", "_user") + tuple(i for i in indices if i != "!key")
+        for what, indices in INDICES.items()
+    }
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._db = None
+        self._lock = None
+        self._loop = None
+        self._start_time = time.time()
+        self._mtimes = {}
+
+    async def _open(self):
+        # The db is bound to the event loop, which can change in tests
+        loop = asyncio.get_running_loop()
+        if self._db is None or self._loop is not loop:
+            # The journal mode is persistent, so we can set it once
+            conn = sqlite3.connect(self._filename)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+            finally:
+                conn.close()
+            db = await itemdb.AsyncItemDB(self._filename)
+            for what, indices in self._indices.items():
+                await db.ensure_table(what, *indices)
+            # Another request may have opened the db in the mean time
+            if self._db is None or self._loop is not loop:
+                self._db, self._lock, self._loop = db, asyncio.Lock(), loop
+        return self._db
+
+    async def open_user(self, username):
+        db = await self._open()
+        return SharedSqliteUserStorage(self, db, username)
+
+
+class SharedSqliteUserStorage(UserStorage):
+    """The storage for one user, in a shared SQLite database."""
+
+    def __init__(self, backend, db, username):
+        self._backend = backend
+        self._db = db
+        self._username = username
+        self._prefix = f"{len(username)}:{username}:"
+
+    def _strip(self, items):
+        for item in items:
+            item.pop("_user", None)
+            item.pop("_ukey", None)
+        return items
+
+    @property
+    def mtime(self):
+        # The data was not modified since the start, or since the last write
+        backend = self._backend
+        return backend._mtimes.get(self._username, backend._start_time)
+
+    async def __aenter__(self):
+        # There is one connection, so transactions of all users are serialized
+        await self._backend._lock.acquire()
+        try:
+            await self._db.__aenter__()
+        except BaseException:
+            self._backend._lock.release()
+            raise
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            return await self._db.__aexit__(type, value, traceback)
+        finally:
+            self._backend._mtimes[self._username] = time.time()
+            self._backend._lock.release()
+
+    async def get_items(self, what, since=None):
+        _check_what(what)
+        if since is None:
+            items = await self._db.select(what, "_user == ?", self._username)
+        else:
+            # The unary + makes SQLite use the st index, since changes are recent
+            query = "+_user == ? AND st >= ?"
+            items = await self._db.select(what, query, self._username, float(since))
+        return self._strip(items)
+
+    async def get_records_in_range(self, t1, t2):
+        query = "_user == ? AND ((t2 >= ? AND t1 <= ?) OR (t1 == t2 AND t1 <= ?))"
+        t1, t2 = int(t1), int(t2)
+        items = await self._db.select("records", query, self._username, t1, t2, t2)
+        return self._strip(items)
+
+    async def get_items_by_key(self, what, keys):
+        _check_what(what)
+        ukeys = [self._prefix + key for key in keys]
+        result = {}
+        for i in range(0, len(ukeys), KEYS_PER_QUERY):
+            chunk = ukeys[i : i + KEYS_PER_QUERY]
+            query = "_ukey IN (" + ",".join("?" for _ in chunk) + ")"
+            for item in self._strip(await self._db.select(what, query, *chunk)):
+                result[item["key"]] = item
+        return result
+
+    async def put_items(self, what, items):
+        _check_what(what)
+        user, prefix = self._username, self._prefix
+        items = [dict(item, _user=user, _ukey=prefix + item["key"]) for item in items]
+        if items:
+            await self._db.put(what, *items)
+
+    async def _get_userinfo(self, key):
+        ob = await self._db.select_one("userinfo", "_ukey == ?", self._prefix + key)
+        return (ob or {}).get("value", None)
+
+    async def _set_userinfo(self, key, value, st):
+        item = dict(key=key, st=st, mt=st, value=value)
+        item.update(_user=self._username, _ukey=self._prefix + key)
+        await self._db.put("userinfo", item)
+
+    async def get_reset_time(self):
+        value = await self._get_userinfo("reset_time")
+        return -1.0 if value is None else float(value)
+
+    async def set_reset_time(self, st):
+        await self._set_userinfo("reset_time", st, st)
+
+    async def get_token_seed(self, tokenkind):
+        return (await self._get_userinfo(f"{tokenkind}_seed")) or ""
+
+    async def set_token_seed(self, tokenkind, seed):
+        await self._set_userinfo(f"{tokenkind}_seed", seed, time.time())
+
+
+# %% Caching
+
+
+def _get_item_size(item):
+    """Rough estimate of the memory used by a cached item."""
+    size = 400  # the dict, its keys and numbers, and the index entries
+    for value in item.values():
+        if isinstance(value, str):
+            size += len(value)
+        elif not isinstance(value, (int, float)):
+            size += len(json.dumps(value))
+    return size
+
+
+class UserCache:
+    """The records and settings of one user, in memory. Indexed by key,
+    by st (for getting updates), and by t1 (for range queries).
+    """
+
+    def __init__(self, mtime, reset_time, seeds):
+        self.mtime = mtime
+        self.reset_time = reset_time
+        self.seeds = seeds
+        self.nbytes = 0
+        self._items = {"records": {}, "settings": {}}
+        # Sorted lists of (st, key), with stale entries that are skipped
+        self._st_index = {"records": [], "settings": []}
+        self._stale = {"records": 0, "settings": 0}
+        # Sorted list of (t1, key), built when needed
+        self._t1_index = None
+        self._running = None
+        self._max_duration = 0
+
+    def put(self, what, item):
+        """Add or replace an item. Returns the change in size."""
+        items = self._items[what]
+        st_index = self._st_index[what]
+        old_item = items.get(item["key"], None)
+        items[item["key"]] = item
+        # Update the st index. The st of new items is mostly the largest.
+        entry = item["st"], item["key"]
+        if not st_index or entry > st_index[-1]:
+            st_index.append(entry)
+        else:
+            bisect.insort(st_index, entry)
+        if what == "records":
+            self._t1_index = None
+        # Remove stale index entries if there are many
+        delta = _get_item_size(item)
+        if old_item is not None:
+            delta -= _get_item_size(old_item)
+            self._stale[what] += 1
+            if self._stale[what] > len(st_index) // 2:
+                st_index[:] = sorted((i["st"], k) for k, i in items.items())
+                self._stale[what] = 0
+        self.nbytes += delta
+        return delta
+
+    def get_all(self, what):
+        return [dict(item) for item in self._items[what].values()]
+
+    def get_since(self, what, since):
+        items = self._items[what]
+        st_index = self._st_index[what]
+        result = []
+        for i in range(bisect.bisect_left(st_index, (since,)), len(st_index)):
+            st, key = st_index[i]
+            item = items[key]
+            if item["st"] == st:
+                result.append(dict(item))
+        return result
+
+    def get_by_key(self, what, keys):
+        items = self._items[what]
+        return {key: dict(items[key]) for key in keys if key in items}
+
+    def get_records_in_range(self, t1, t2):
+        if self._t1_index is None:
+            self._build_t1_index()
+        items = self._items["records"]
+        # Records that overlap, found via the max duration
+        index = self._t1_index
+        i1 = bisect.bisect_left(index, (t1 - self._max_duration,))
+        i2 = bisect.bisect_left(index, (t2 + 1,))
+        result = []
+        for i in range(i1, i2):
+            item = items[index[i][1]]
+            if item["t2"] >= t1:
+                result.append(dict(item))
+        # Running records that started before t2
+        for rt1, key in self._running:
+            if rt1 > t2:
+                break
+            result.append(dict(items[key]))
+        return result
+
+    def _build_t1_index(self):
+        index, running = [], []
+        max_duration = 0
+        for key, item in self._items["records"].items():
+            if item["t1"] == item["t2"]:
+                running.append((item["t1"], key))
+            else:
+                index.append((item["t1"], key))
+                max_duration = max(max_duration, item["t2"] - item["t1"])
+        index.sort()
+        running.sort()
+        self._t1_index, self._running = index, running
+        self._max_duration = max_duration
+
+
+class CachedStorage(StorageBackend):
+    """Backend that wraps another backend, and keeps the records and
+    settings of recently active users in memory, within the given memory
+    budget. Reads for cached users need no disk I/O, and writes go
+    through to the wrapped backend. This assumes that all writes go
+    through this server process.
+    """
+
+    def __init__(self, backend, max_bytes):
+        self._backend = backend
+        self._max_bytes = max_bytes
+        self._caches = OrderedDict()  # username -> UserCache, in LRU order
+        self._nbytes = 0
+        self._commits = {}  # username -> number of commits
+
+    @property
+    def nbytes(self):
+        """The estimated memory used by the cache, in bytes."""
+        return self._nbytes
+
+    async def open_user(self, username):
+        # For cached users, the wrapped storage is opened only when needed
+        cache = self._get_cache(username)
+        if cache is not None:
+            return CachedUserStorage(self, username, None, cache.mtime)
+        db = await self._backend.open_user(username)
+        return CachedUserStorage(self, username, db, db.mtime)
+
+    def _get_cache(self, username):
+        cache = self._caches.get(username, None)
+        if cache is not None:
+            self._caches.move_to_end(username)
+        return cache
+
+    async def _load_cache(self, storage):
+        username = storage._username
+        cache = self._get_cache(username)
+        if cache is not None:
+            metrics.inc("timetagger_cache_requests_total", result="hit")
+            return cache
+        metrics.inc("timetagger_cache_requests_total", result="miss")
+        # Load all data. If there was a commit in the mean time, the cache
+        # may be outdated, so we don't store it.
+        commits = self._commits.get(username, 0)
+        db = await storage._get_db()
+        seeds = {}
+        for tokenkind in ("webtoken", "apitoken"):
+            seeds[tokenkind] = await db.get_token_seed(tokenkind)
+        cache = UserCache(db.mtime, await db.get_reset_time(), seeds)
+        for what in ("records", "settings"):
+            for item in await db.get_items(what):
+                cache.put(what, item)
+        if commits == self._commits.get(username, 0):
+            self._caches[username] = cache
+            self._nbytes += cache.nbytes
+            self._evict()
+        return cache
+
+    def _evict(self):
+        # Evict least recently used users until within budget
+        while self._nbytes > self._max_bytes and self._caches:
+            _, cache = self._caches.popitem(last=False)
+            self._nbytes -= cache.nbytes
+
+    def _commit(self, username, changes):
+        self._commits[username] = self._commits.get(username, 0) + 1
+        cache = self._caches.get(username, None)
+        if cache is None:
+            return
+        cache.mtime = time.time()
+        for kind, what, value in changes:
+            if kind == "items":
+                for item in value:
+                    self._nbytes += cache.put(what, item)
+            elif kind == "reset_time":
+                cache.reset_time = value
+            elif kind == "seed":
+                cache.seeds[what] = value
+        self._evict()
+
+
+class CachedUserStorage(UserStorage):
+    """The storage for one user, served from the cache when possible."""
+
+    def __init__(self, backend, username, db, mtime):
+        self._backend = backend
+        self._username = username
+        self._db = db
+        self._mtime = mtime
+        self._changes = None
+
+    async def _get_db(self):
+        if self._db is None:
+            self._db = await self._backend._backend.open_user(self._username)
+        return self._db
+
+    @property
+    def mtime(self):
+        return self._mtime
+
+    async def __aenter__(self):
+        db = await self._get_db()
+        await db.__aenter__()
+        self._changes = []
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        changes, self._changes = self._changes, None
+        result = await self._db.__aexit__(type, value, traceback)
+        if not value:
+            self._backend._commit(self._username, changes)
+        return result
+
+    async def get_items(self, what, since=None):
+        _check_what(what)
+        cache = await self._backend._load_cache(self)
+        if since is None:
+            return cache.get_all(what)
+        else:
+            return cache.get_since(what, float(since))
+
+    async def get_records_in_range(self, t1, t2):
+        cache = await self._backend._load_cache(self)
+        return cache.get_records_in_range(int(t1), int(t2))
+
+    async def get_items_by_key(self, what, keys):
+        _check_what(what)
+        cache = await self._backend._load_cache(self)
+        return cache.get_by_key(what, keys)
+
+    async def put_items(self, what, items):
+        db = await self._get_db()
+        await db.put_items(what, items)
+        self._changes.append(("items", what, [dict(item) for item in items]))
+
+    async def get_reset_time(self):
+        # Userinfo is served from the cache, but does not trigger loading it
+        cache = self._backend._get_cache(self._username)
+        if cache is not None:
+            return cache.reset_time
+        return await (await self._get_db()).get_reset_time()
+
+    async def set_reset_time(self, st):
+        db = await self._get_db()
+        await db.set_reset_time(st)
+        self._changes.append(("reset_time", None, st))
+
+    async def get_token_seed(self, tokenkind):
+        cache = self._backend._get_cache(self._username)
+        if cache is not None and tokenkind in cache.seeds:
+            return cache.seeds[tokenkind]
+        return await (await self._get_db()).get_token_seed(tokenkind)
+
+    async def set_token_seed(self, tokenkind, seed):
+        db = await self._get_db()
+        await db.set_token_seed(tokenkind, seed)
+        self._changes.append(("seed", tokenkind, seed))
+
+
+# %% Selecting the backend
+
+
+def create_storage(name):
+    """Create a storage backend by name: "sqlite" or "sqlite_shared"."""
+    if name == "sqlite":
+        return SqliteStorage()
+    elif name == "sqlite_shared":
+        return SharedSqliteStorage(os.path.join(ROOT_TT_DIR, "timetagger.db"))
+    else:
+        raise ValueError(f"Invalid storage backend {name!r}")
+
+
+_storage = None
+
+
+def get_storage():
+    """Get the storage backend that the server uses. By default this
+    is the backend specified by ``config.storage``, wrapped in a
+    CachedStorage if ``config.cache_size`` is nonzero.
+    """
+    global _storage
+    if _storage is None:
+        _storage = create_storage(config.storage)
+        if config.cache_size > 0:
+            _storage = CachedStorage(_storage, config.cache_size * 2**20)
+    return _storage
+
+
+def set_storage(storage):
+    """Set the storage backend that the server uses."""
+    global _storage
+    if not isinstance(storage, StorageBackend):
+        raise TypeError("set_storage() needs a StorageBackend instance.")
+    _storage = storage